@@ -10,23 +10,35 @@
 #
 
 import os
+import sys
 from os.path import exists, join, isdir
 
 import stat
+import time
 
 import shutil
+from operator import attrgetter
 import simplejson
 
+import threading
+import traceback
+from StringIO import StringIO
+
 from paths import Paths
 
-from dirindex import read_paths
-from changes import whatchanged
+from dirindex import DirIndex, read_paths
+from dirwalk import ReaddirCache
+from changetracker import TrackedIndex, Unusable
+from digestcache import DigestCache
+from changes import Changes, ChangesWriter, whatchanged, iter_whatchanged
 from pkgman import Packages
 
 import mysql
 import pgsql
 
-from utils import AttrDict, fmt_title, apply_overlay
+from utils import AttrDict, fmt_title, fmt_size
+from overlay import apply_overlay
+from metrics import metrics
 
 class ProfilePaths(Paths):
     files = [ 'dirindex', 'dirindex.conf', 'packages' ]
@@ -42,7 +54,8 @@ class ExtrasPaths(Paths):
     def __new__(cls, root_path=None):
         return str.__new__(cls, root_path)
 
-    files = [ 'backup-conf', 'fsdelta', 'fsdelta-olist', 'newpkgs', 'pgfs', 'myfs', 'etc', 'etc/mysql' ]
+    files = [ 'backup-conf', 'fsdelta', 'fsdelta-olist', 'newpkgs', 'pgfs', 'myfs', 'etc', 'etc/mysql',
+              'checkpoints' ]
 
 def _rmdir(path):
     if exists(path):
@@ -58,6 +71,71 @@ def _fpaths(dpath):
 def _filter_deleted(files):
     return [ f for f in files if exists(f) ]
 
+class _StageOutput:
+    """Stands in for sys.stdout or sys.stderr while backup stages run.
+    What a stage thread writes goes to its buffer (the attribute of the
+    thread-local stage), everything else to the real file"""
+
+    def __init__(self, stage, attr, fh):
+        self.stage = stage
+        self.attr = attr
+        self.fh = fh
+
+    def _fh(self):
+        return getattr(self.stage, self.attr, None) or self.fh
+
+    def write(self, s):
+        self._fh().write(s)
+
+    def writelines(self, lines):
+        self._fh().writelines(lines)
+
+    def flush(self):
+        self._fh().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.fh, attr)
+
+
+class Checkpoints:
+    """Names of the finished stages of creating the backup extras, saved
+    as soon as they finish so an aborted backup can resume without redoing
+    them. sub() returns the checkpoints of the parts of a stage (e.g., the
+    databases of the MySQL stage)."""
+
+    LOCK = threading.Lock()
+
+    def __init__(self, path, prefix="", names=None):
+        self.path = path
+        self.prefix = prefix
+
+        if names is None:
+            names = set(file(path).read().splitlines()) if exists(path) else set()
+        self.names = names
+
+    def sub(self, prefix):
+        return Checkpoints(self.path, self.prefix + prefix + "/", self.names)
+
+    def create(self):
+        file(self.path, "a").close()
+
+    def __contains__(self, name):
+        return self.prefix + name in self.names
+
+    def add(self, name):
+        name = self.prefix + name
+
+        self.LOCK.acquire()
+        try:
+            fh = file(self.path, "a")
+            print >> fh, name
+            fh.flush()
+            os.fsync(fh.fileno())
+            fh.close()
+
+            self.names.add(name)
+        finally:
+            self.LOCK.release()
 
 class BackupConf(AttrDict):
     def __init__(self, profile_id, overrides, skip_files, skip_packages, skip_database):
@@ -103,13 +181,108 @@ class Backup:
 
         fh.close()
 
+    def _log_actions(self, changes, umask):
+        actions = list(changes.deleted(optimized=False)) + list(changes.statfixes(optimized=False))
+        actions.sort(lambda a,b: cmp(a.args[0], b.args[0]))
+
+        for action in actions:
+            if action.func is os.chmod:
+                path, mode = action.args
+                default_mode = (0777 if isdir(path) else 0666) ^ umask
+                if default_mode == stat.S_IMODE(mode):
+                    continue
+            elif action.func is os.lchown:
+                path, uid, gid = action.args
+                if uid == 0 and gid == 0:
+                    continue
+
+            self._log("  " + str(action))
+
+    def _stream_whatchanged(self, dest, dest_olist, dirindex, paths, umask):
+        # writes (and logs) changes as they're found in path order, so we
+        # never hold the saved index, the walk or the changes in memory
+        writer = ChangesWriter(dest)
+        fh_olist = file(dest_olist, "w", ChangesWriter.BUFSIZE)
+
+        changed = False
+        olist = False
+        for change in iter_whatchanged(dirindex, paths):
+            writer.write(change)
+            if change.OP == 'o':
+                print >> fh_olist, change.path
+                olist = True
+
+            if self.verbose:
+                if not changed:
+                    self._log("Save list of filesystem changes to %s:\n" % dest)
+
+                self._log_actions(Changes([ change ]), umask)
+
+            changed = True
+
+        writer.close()
+        fh_olist.close()
+
+        if self.verbose and olist:
+            self._log("\nSave list of new files to %s:\n" % dest_olist)
+            for line in file(dest_olist):
+                self._log("  " + line.rstrip("\n"))
+
     def _write_whatchanged(self, dest, dest_olist, dirindex, dirindex_conf,
-                           overrides=[]):
+                           umask, overrides=[]):
         paths = read_paths(file(dirindex_conf))
         paths += overrides
 
-        changes = whatchanged(dirindex, paths)
-        changes.sort(lambda a,b: cmp(a.path, b.path))
+        # if the change tracker is running we only need to lstat the paths
+        # it journaled since the last backup
+        tracked = None
+        di_fs = None
+        if self.change_tracker:
+            try:
+                tracked = TrackedIndex(self.change_tracker, paths)
+                di_fs = tracked.load()
+                self._log("Using change journal (%d changes since last backup)\n" % tracked.changed)
+            except Unusable, e:
+                if tracked:
+                    self._log("Can't use change journal (%s), walking filesystem\n" % e)
+
+        if self.stream_fsdelta and tracked:
+            self._log("Not streaming filesystem changes (the change tracker needs a full index)\n")
+
+        if self.stream_fsdelta and not tracked:
+            # walks and compares in a single pass. The readdir cache holds
+            # every listing in memory, so we don't use it here
+            with metrics.phase('whatchanged'):
+                self._stream_whatchanged(dest, dest_olist, dirindex, paths, umask)
+        else:
+            if di_fs is None:
+                # listings of unchanged directories are reused from the
+                # last backup. Only a walk updates them
+                readdir_cache = ReaddirCache(self.readdir_cache) if self.readdir_cache else None
+
+                with metrics.phase('walk'):
+                    di_fs = DirIndex()
+                    di_fs.walk(readdir_cache=readdir_cache, *paths)
+
+                if readdir_cache:
+                    readdir_cache.save()
+
+            # edited files with the same content as in the profile don't
+            # need to be uploaded again
+            digests = DigestCache(self.digest_cache) if self.digest_cache else None
+
+            with metrics.phase('diff'):
+                self._write_changes(dest, dest_olist,
+                                    whatchanged(dirindex, paths, di_fs=di_fs, digests=digests), umask)
+
+            if tracked:
+                tracked.save(di_fs)
+
+            if digests:
+                digests.save()
+
+    def _write_changes(self, dest, dest_olist, changes, umask):
+        changes.sort(key=attrgetter('path'))
 
         changes.tofile(dest)
         olist = [ change.path for change in changes if change.OP == 'o' ]
@@ -119,87 +292,210 @@ class Backup:
             if changes:
                 self._log("Save list of filesystem changes to %s:\n" % dest)
 
-            actions = list(changes.deleted(optimized=False)) + list(changes.statfixes(optimized=False))
-            actions.sort(lambda a,b: cmp(a.args[0], b.args[0]))
-
-            umask = os.umask(0)
-            os.umask(umask)
-
-            for action in actions:
-                if action.func is os.chmod:
-                    path, mode = action.args
-                    default_mode = (0777 if isdir(path) else 0666) ^ umask
-                    if default_mode == stat.S_IMODE(mode):
-                        continue
-                elif action.func is os.lchown:
-                    path, uid, gid = action.args
-                    if uid == 0 and gid == 0:
-                        continue
-
-                self._log("  " + str(action))
+            self._log_actions(changes, umask)
 
             if olist:
                 self._log("\nSave list of new files to %s:\n" % dest_olist)
                 for path in olist:
                     self._log("  " + path)
 
-    def _create_extras(self, extras, profile, conf):
-        os.mkdir(extras.path)
-        os.chmod(extras.path, 0700)
+    def _create_extras(self, extras, profile, conf, checkpoints):
+        if not exists(extras.path):
+            os.mkdir(extras.path)
+            os.chmod(extras.path, 0700)
+
+        # the backup conf tells a resumed backup if these extras match
+        checkpoints.create()
+        conf.tofile(extras.backup_conf)
+
+        if 'etc' not in checkpoints:
+            etc = str(extras.etc)
+            if not exists(etc):
+                os.mkdir(etc)
+            self._log("  mkdir " + etc)
 
-        etc = str(extras.etc)
-        os.mkdir(etc)
-        self._log("  mkdir " + etc)
+            self._log("\n// needed to automatically detect and fix file ownership issues\n")
 
-        self._log("\n// needed to automatically detect and fix file ownership issues\n")
+            shutil.copy("/etc/passwd", etc)
+            self._log("  cp /etc/passwd " + etc)
 
-        shutil.copy("/etc/passwd", etc)
-        self._log("  cp /etc/passwd " + etc)
+            shutil.copy("/etc/group", etc)
+            self._log("  cp /etc/group " + etc)
 
-        shutil.copy("/etc/group", etc)
-        self._log("  cp /etc/group " + etc)
+            checkpoints.add('etc')
 
         if not conf.skip_packages or not conf.skip_files:
             self._log("\n" + fmt_title("Comparing current system state to the base state in the backup profile", '-'))
 
-        if not conf.skip_packages and exists(profile.packages):
-            self._write_new_packages(extras.newpkgs, profile.packages)
+        # os.umask() can only be read by setting it, so we don't do that
+        # while the stages are running
+        umask = os.umask(0)
+        os.umask(umask)
 
-        if not conf.skip_files:
-            # support empty profiles
-            dirindex = profile.dirindex if exists(profile.dirindex) else "/dev/null"
-            dirindex_conf = profile.dirindex_conf if exists(profile.dirindex_conf) else "/dev/null"
+        # the stages are independent and bound by different resources, so
+        # they run concurrently
+        stages = []
 
-            self._write_whatchanged(extras.fsdelta, extras.fsdelta_olist,
-                                    dirindex, dirindex_conf,
-                                    conf.overrides.fs)
+        if not conf.skip_packages and exists(profile.packages):
+            def packages():
+                self._write_new_packages(extras.newpkgs, profile.packages)
 
-        if not conf.skip_database:
+            stages.append(packages)
 
-            try:
-                if mysql.MysqlService.is_running():
-                    self._log("\n" + fmt_title("Serializing MySQL database to " + extras.myfs, '-'))
-                    mysql.backup(extras.myfs, extras.etc.mysql,
-                                 limits=conf.overrides.mydb, callback=mysql.cb_print()) if self.verbose else None
+        if not conf.skip_files:
+            def files():
+                # support empty profiles
+                dirindex = profile.dirindex if exists(profile.dirindex) else "/dev/null"
+                dirindex_conf = profile.dirindex_conf if exists(profile.dirindex_conf) else "/dev/null"
 
-            except mysql.Error:
-                pass
+                self._write_whatchanged(extras.fsdelta, extras.fsdelta_olist,
+                                        dirindex, dirindex_conf,
+                                        umask, conf.overrides.fs)
 
-            try:
-                if pgsql.PgsqlService.is_running():
-                    self._log("\n" + fmt_title("Serializing PgSQL databases to " + extras.pgfs, '-'))
-                    pgsql.backup(extras.pgfs, conf.overrides.pgdb, callback=pgsql.cb_print() if self.verbose else None)
-            except pgsql.Error:
-                pass
+            stages.append(files)
+
+        if not conf.skip_database:
+            def mysql_database():
+                try:
+                    if mysql.MysqlService.is_running():
+                        self._log("\n" + fmt_title("Serializing MySQL database to " + extras.myfs, '-'))
+                        mysql.backup(extras.myfs, extras.etc.mysql,
+                                     limits=conf.overrides.mydb,
+                                     callback=mysql.cb_print(self._log_fh()) if self.verbose else None,
+                                     checkpoints=checkpoints.sub('mysql'),
+                                     compress=self.compress_databases,
+                                     parallel=self.mysql_parallel)
+
+                except mysql.Error:
+                    # unfinished, so a resumed backup tries again
+                    return False
+
+            def pgsql_databases():
+                try:
+                    if pgsql.PgsqlService.is_running():
+                        self._log("\n" + fmt_title("Serializing PgSQL databases to " + extras.pgfs, '-'))
+                        pgsql.backup(extras.pgfs, conf.overrides.pgdb,
+                                     callback=pgsql.cb_print(self._log_fh()) if self.verbose else None,
+                                     checkpoints=checkpoints.sub('pgsql'),
+                                     compress=self.compress_databases)
+                except pgsql.Error:
+                    # the databases that were dumped are kept for a resumed
+                    # backup. The globals are only written once they're all
+                    # dumped, and a pgfs without them isn't restored
+                    return False
+
+            stages += [ mysql_database, pgsql_databases ]
+
+        if self._run_stages(stages, checkpoints):
+            checkpoints.add('extras')
+
+    def _run_stages(self, stages, checkpoints):
+        """Run stages (functions) in parallel threads, skipping the ones
+        in checkpoints and adding the ones that finish. A stage that
+        returns False didn't finish (e.g., it skipped a database it failed
+        to dump) and isn't added, so a resumed backup runs it again.
+        Returns True if every stage finished.
+
+        A stage's output (its log and whatever it prints to sys.stdout or
+        sys.stderr) is buffered and printed in the order of the stages, as
+        soon as it and the stages before it are done. Subprocesses that
+        write to the terminal themselves bypass the buffers, so the stages
+        pipe the stderr of theirs (e.g., mysqldump, pg_dump) and report it
+        in the errors they raise.
+
+        A failed stage doesn't stop the others. Once they're all done we
+        raise the error of the first stage that failed."""
+
+        class Stage(threading.Thread):
+            def __init__(self, backup, func):
+                threading.Thread.__init__(self, name=func.__name__)
+                self.daemon = True
+
+                self.backup = backup
+                self.func = func
+                self.log = StringIO()
+                self.err = StringIO()
+                self.exc_info = None
+                self.finished = False
+
+            def run(self):
+                self.backup._stage.log = self.log
+                self.backup._stage.err = self.err
+                with metrics.phase(self.name):
+                    try:
+                        if self.func() is not False:
+                            checkpoints.add(self.name)
+                            self.finished = True
+                    except:
+                        self.exc_info = sys.exc_info()
+
+        for func in stages:
+            if func.__name__ in checkpoints:
+                self._log("\n// %s already done by the aborted backup" % func.__name__)
+
+        threads = [ Stage(self, func) for func in stages
+                    if func.__name__ not in checkpoints ]
+
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = _StageOutput(self._stage, 'log', stdout)
+        sys.stderr = _StageOutput(self._stage, 'err', stderr)
+
+        try:
+            for thread in threads:
+                thread.start()
+
+            exc_info = None
+            for thread in threads:
+                # a join() without a timeout can't be interrupted by signals
+                while thread.is_alive():
+                    thread.join(0xffff)
+
+                stdout.write(thread.log.getvalue())
+                stdout.flush()
+
+                stderr.write(thread.err.getvalue())
+                stderr.flush()
+
+                if not thread.exc_info:
+                    continue
+
+                if exc_info:
+                    # we can only raise one error, but don't hide the others
+                    print >> stderr, "error in %s stage:" % thread.name
+                    traceback.print_exception(*(thread.exc_info + (None, stderr)))
+                else:
+                    exc_info = thread.exc_info
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return all(thread.finished for thread in threads)
+
+    def _log_fh(self):
+        # inside a stage we log to its buffer
+        return getattr(self._stage, 'log', None) or sys.stdout
 
     def _log(self, s=""):
         if self.verbose:
-            print s
+            print >> self._log_fh(), s
 
     def __init__(self, profile, overrides, 
-                 skip_files=False, skip_packages=False, skip_database=False, resume=False, verbose=True, extras_root="/"):
+                 skip_files=False, skip_packages=False, skip_database=False, resume=False, verbose=True, extras_root="/",
+                 stream_fsdelta=False, readdir_cache=None, change_tracker=None,
+                 digest_cache=None, compress_databases=False, mysql_parallel=1):
 
         self.verbose = verbose
+        self._stage = threading.local()
+
+        self.compress_databases = compress_databases
+        self.mysql_parallel = mysql_parallel
+
+        self.stream_fsdelta = stream_fsdelta
+        self.readdir_cache = readdir_cache
+        self.change_tracker = change_tracker
+        self.digest_cache = digest_cache
 
         if not profile:
             raise self.Error("can't backup without a profile")
@@ -227,47 +523,59 @@ class Backup:
 
         self.resume = resume
 
-        # create or re-use /TKLBAM
-        if not exists(extras_paths.path):
+        # create /TKLBAM, finish creating it or re-use it. Extras of older
+        # versions don't have checkpoints, but they were only left complete
+        checkpoints = Checkpoints(extras_paths.checkpoints)
+        complete = exists(extras_paths.path) and \
+                   ('extras' in checkpoints or not exists(extras_paths.checkpoints))
+
+        if not complete:
+            if exists(extras_paths.path):
+                self._log(fmt_title("Resuming creation of %s (skipping finished stages)" % extras_paths.path))
+            else:
+                self._log(fmt_title("Creating %s (contains backup metadata and database dumps)" % extras_paths.path))
+                self._log("  mkdir -p " + extras_paths.path)
 
-            self._log(fmt_title("Creating %s (contains backup metadata and database dumps)" % extras_paths.path))
-            self._log("  mkdir -p " + extras_paths.path)
+            # if we fail, finished stages are kept so that a resumed backup
+            # can skip them. Otherwise the next backup starts over
+            with metrics.phase('extras'):
+                self._create_extras(extras_paths, profile_paths, backup_conf, checkpoints)
 
-            try:
-                self._create_extras(extras_paths, profile_paths, backup_conf)
-                backup_conf.tofile(extras_paths.backup_conf)
-            except:
-                # destroy potentially incomplete extras
-                _rmdir(extras_paths.path)
-                raise
+        # files in /TKLBAM
+        fpaths = _fpaths(extras_paths.path)
+        staged = sum([ os.lstat(fpath).st_size for fpath in fpaths ])
+        metrics.count('bytes_staged', staged)
 
         # print uncompressed footprint
         if verbose:
 
-            # files in /TKLBAM + /TKLBAM/fsdelta-olist
-            fpaths= _fpaths(extras_paths.path)
-
+            # + /TKLBAM/fsdelta-olist
             if not skip_files:
                 fsdelta_olist = file(extras_paths.fsdelta_olist).read().splitlines()
-                fpaths += _filter_deleted(fsdelta_olist)
+                fsdelta_olist = _filter_deleted(fsdelta_olist)
 
-            size = sum([ os.lstat(fpath).st_size
-                         for fpath in fpaths ])
-
-            if size > 1024 * 1024 * 1024:
-                size_fmt = "%.2f GB" % (float(size) / (1024 * 1024 * 1024))
-            elif size > 1024 * 1024:
-                size_fmt = "%.2f MB" % (float(size) / (1024 * 1024))
+                fpaths += fsdelta_olist
+                size = staged + sum([ os.lstat(fpath).st_size
+                                      for fpath in fsdelta_olist ])
             else:
-                size_fmt = "%.2f KB" % (float(size) / 1024)
+                size = staged
 
-            self._log("\nUNCOMPRESSED BACKUP SIZE: %s in %d files" % (size_fmt, len(fpaths)))
+            self._log("\nUNCOMPRESSED BACKUP SIZE: %s in %d files" % (fmt_size(size), len(fpaths)))
 
         self.extras_paths = extras_paths
 
+    @metrics.timed('dump')
     def dump(self, path):
         def r(p):
             return join(path, p.lstrip('/'))
 
         if exists(self.extras_paths.fsdelta_olist):
-            apply_overlay('/', path, self.extras_paths.fsdelta_olist)
+            olist = file(self.extras_paths.fsdelta_olist).read().splitlines()
+
+            started = time.time()
+            size = apply_overlay('/', path, olist)
+            elapsed = time.time() - started
+
+            self._log("\nDUMPED %d files (%s) to %s in %.1f seconds (%s/s)" %
+                      (len(olist), fmt_size(size), path, elapsed,
+                       fmt_size(size / elapsed if elapsed else 0)))
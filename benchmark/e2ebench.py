@@ -0,0 +1,526 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Benchmark backup and restore end-to-end against the dummy Hub
+
+Provisions a scratch registry, configuration and dummy Hub account,
+generates a workload (a synthetic tree and optionally MySQL/PostgreSQL
+databases) and times these cycles:
+
+    full           first backup of the workload
+    incremental    backup after churning the workload
+    restore        restore of the latest backup after deleting the workload
+
+Backups are stored by the dummy Hub in file:// targets, so no network is
+involved. We report the wall time of each cycle and of its phases (from
+the --statsfile of tklbam-backup and tklbam-restore), how many bytes each
+backup uploaded and the restore throughput, and check that the restored
+workload is identical to what we backed up.
+
+Warning: like the regtest, run this on a disposable test system. Besides
+the workload, a restore restores the system configuration in the backup
+extras (e.g., users, groups).
+
+Options:
+    --workdir=PATH     Where we create the scratch registry and workload
+                       default: a temporary directory
+    --keep             Don't remove workdir and the backup target when we're done
+
+    --output=PATH      Write the results to PATH as JSON (- for stdout)
+    --baseline=PATH    Compare the results with a previous output and exit
+                       with a non-zero exitcode if anything regressed
+    --tolerance=PERCENT  How much slower, bigger or lower throughput than
+                         the baseline is a regression (default: %(tolerance)d)
+
+Workload options:
+    --files=N          Number of entries in the synthetic tree
+                       default: %(files)d
+    --churn=PERCENT    Percentage of the workload changed before the
+                       incremental backup (default: %(churn)d)
+
+    --mysql=ROWS       Create a MySQL database with ROWS rows
+                       (needs a running MySQL server)
+    --pgsql=ROWS       Create a PostgreSQL database with ROWS rows
+                       (needs a running PostgreSQL server)
+
+    --depth=N --fanout=N --symlinks=PERCENT --sockets=PERCENT --max-size=BYTES
+    --seed=N           See synthfs.py
+
+Environment variables:
+
+    BIN                Path to tklbam source (default: ..)
+"""
+import os
+import sys
+import stat
+import time
+import getopt
+import shutil
+import platform
+import tempfile
+from os.path import *
+from subprocess import Popen, PIPE, STDOUT
+
+import simplejson
+
+BIN = os.environ.get('BIN', join(dirname(abspath(__file__)), '..'))
+sys.path.insert(0, BIN)
+
+import mysql
+import pgsql
+from dummyhub import dummydb
+from utils import fmt_size
+
+from synthfs import SynthFS
+
+FILES = 10000
+CHURN = 10
+TOLERANCE = 20
+
+# differences smaller than these are noise
+MIN_DELTA = dict(seconds=0.5, bytes_uploaded=256 * 1024, throughput=1024 * 1024)
+
+# metrics for which lower is worse
+HIGHER_IS_BETTER = ('throughput',)
+
+class Error(Exception):
+    pass
+
+class Database:
+    """a database of rows we can churn, backup and restore"""
+
+    NAME = "tklbam_bench"
+    BATCH = 500
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def _sql(self, sql, database=None):
+        raise NotImplementedError
+
+    def _insert(self, first, last):
+        sql = []
+        for start in xrange(first, last, self.BATCH):
+            values = [ "(%d, 'row%d', '%s')" % (i, i, ("%08x" % (i * 2654435761 % 2**32)) * 8)
+                       for i in xrange(start, min(start + self.BATCH, last)) ]
+            sql.append("INSERT INTO bench VALUES %s;" % ", ".join(values))
+
+        self._sql("\n".join(sql), self.NAME)
+
+    def create(self):
+        self.drop()
+        self._sql("CREATE DATABASE %s;" % self.NAME)
+        self._sql("CREATE TABLE bench (id INTEGER PRIMARY KEY, name VARCHAR(64), data TEXT);", self.NAME)
+        self._insert(0, self.rows)
+
+    def churn(self, percent):
+        """update percent of the rows and add as many new rows as one in
+        four of those"""
+        count = self.rows * percent / 100
+        if count:
+            self._sql("UPDATE bench SET data = CONCAT(data, 'x') WHERE MOD(id, %d) = 0;" %
+                      (self.rows / count), self.NAME)
+
+        self._insert(self.rows, self.rows + count / 4)
+
+    def snapshot(self):
+        return self._sql("SELECT COUNT(*), SUM(LENGTH(data)) FROM bench;", self.NAME).strip()
+
+    def drop(self):
+        self._sql("DROP DATABASE IF EXISTS %s;" % self.NAME)
+
+class MySQL(Database):
+    name = "mysql"
+
+    @staticmethod
+    def is_running():
+        return mysql.MysqlService.is_running()
+
+    def _sql(self, sql, database=None):
+        command = [ "mysql", "--batch", "--skip-column-names" ]
+        if os.access(mysql.PATH_DEBIAN_CNF, os.R_OK):
+            command.insert(1, "--defaults-file=" + mysql.PATH_DEBIAN_CNF)
+        if database:
+            command.append(database)
+
+        return _communicate(command, sql)
+
+class PgSQL(Database):
+    name = "pgsql"
+
+    @staticmethod
+    def is_running():
+        return pgsql.PgsqlService.is_running()
+
+    def _sql(self, sql, database=None):
+        command = "psql -q -t -A -v ON_ERROR_STOP=1"
+        if database:
+            command += " -d " + database
+
+        return _communicate(pgsql.su(command), sql)
+
+def _communicate(command, input):
+    popen = Popen(command, shell=isinstance(command, str), stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    output, error = popen.communicate(input)
+    if popen.returncode != 0:
+        raise Error("%s failed: %s" % (command, error.strip()))
+
+    return output
+
+def _snapshot(root):
+    """returns (snapshot, bytes) of the non-directory entries in root.
+    Sockets are ignored because backups don't include them"""
+    snapshot = {}
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            path = join(dirpath, fname)
+            st = os.lstat(path)
+            if stat.S_ISSOCK(st.st_mode):
+                continue
+
+            linkto = os.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+            snapshot[path] = (st.st_mode, st.st_uid, st.st_gid, st.st_size, int(st.st_mtime), linkto)
+
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+
+    return snapshot, size
+
+def _dirsize(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for fname in filenames:
+            size += os.lstat(join(dirpath, fname)).st_size
+
+    return size
+
+class Scratch:
+    """scratch registry, configuration and hooks that the tklbam commands
+    we run use instead of the system's"""
+
+    def __init__(self, path, overrides):
+        self.path = path
+
+        self.registry = join(path, "registry")
+        self.conf = join(path, "conf")
+        self.hooks = join(path, "hooks.d")
+        self.log = join(path, "log")
+
+        for dir in (self.registry, self.conf, self.hooks):
+            os.mkdir(dir)
+
+        fh = file(join(self.conf, "overrides"), "w")
+        for limit in overrides:
+            print >> fh, limit
+        fh.close()
+
+        self.env = os.environ.copy()
+        self.env.update(TKLBAM_REGISTRY=self.registry,
+                        TKLBAM_CONF=self.conf,
+                        TKLBAM_HOOKS=self.hooks,
+                        TKLBAM_DUMMYHUB="yes")
+
+    def statsfile(self, command):
+        return join(self.path, "tklbam-%s.json" % command)
+
+    def run(self, command, *args):
+        """run a tklbam command. Returns its wall time in seconds and the
+        metrics it recorded, if any"""
+        args = [ sys.executable, join(BIN, "cmd_%s.py" % command) ] + list(args)
+        statsfile = self.statsfile(command)
+        if command in ('backup', 'restore'):
+            args += [ "--logfile=" + join(self.path, "tklbam-%s.log" % command),
+                      "--statsfile=" + statsfile ]
+
+        log = file(self.log, "a")
+        print >> log, "# " + " ".join(args)
+        log.flush()
+
+        started = time.time()
+        returncode = Popen(args, env=self.env, stdin=file("/dev/null"), stdout=log, stderr=STDOUT).wait()
+        elapsed = time.time() - started
+        log.close()
+
+        if returncode != 0:
+            tail = "".join(file(self.log).readlines()[-20:])
+            raise Error("tklbam-%s failed:\n%s" % (command, tail))
+
+        stats = None
+        if exists(statsfile):
+            lines = file(statsfile).readlines()
+            if lines:
+                stats = simplejson.loads(lines[-1])
+
+        return elapsed, stats
+
+    def backup_record(self):
+        """returns (address, backup_id) of the backup record in the registry"""
+        d = dict([ line.strip().split("=", 1)
+                   for line in file(join(self.registry, "hbr")).readlines() if "=" in line ])
+        return d['address'], d['backup_id']
+
+def _phases(stats):
+    """returns a dict of phase name -> elapsed seconds (summed)"""
+    phases = {}
+    if not stats:
+        return phases
+
+    for phase in stats['phases']:
+        if phase['elapsed'] is not None:
+            phases[phase['name']] = round(phases.get(phase['name'], 0) + phase['elapsed'], 3)
+
+    return phases
+
+def provision(scratch):
+    user = dummydb.add_user()
+    user.subscribe()
+    dummydb.save()
+
+    scratch.run('init', '--force-profile=empty', str(user.apikey))
+
+def _print_cycle(name, result):
+    line = "  %-12s %8.3fs" % (name, result['seconds'])
+    if 'bytes_uploaded' in result:
+        line += "  %10s uploaded" % fmt_size(result['bytes_uploaded'])
+    if 'throughput' in result:
+        line += "  %10s/s" % fmt_size(result['throughput'])
+    print >> sys.stderr, line
+
+    for phase, seconds in sorted(result['phases'].items()):
+        print >> sys.stderr, "    %-22s %8.3fs" % (phase, seconds)
+
+def benchmark(workdir, synthfs, churn, databases, keep=False):
+    """Returns (setup, results) dicts of cycle name -> results"""
+    overrides = [ synthfs.root, "mysql:" + Database.NAME, "pgsql:" + Database.NAME ]
+    scratch = Scratch(workdir, overrides)
+
+    setup = {}
+    results = {}
+
+    target = None
+    try:
+        started = time.time()
+        provision(scratch)
+        synthfs.create()
+        for database in databases:
+            database.create()
+        setup['generate'] = dict(seconds=round(time.time() - started, 3))
+
+        backup_args = [] if databases else [ "--skip-database" ]
+
+        def backup(name):
+            size_before = _dirsize(target[len("file://"):]) if target else 0
+            elapsed, stats = scratch.run('backup', *backup_args)
+
+            address, backup_id = scratch.backup_record()
+            result = dict(seconds=round(elapsed, 3),
+                          phases=_phases(stats),
+                          bytes_uploaded=_dirsize(address[len("file://"):]) - size_before)
+
+            _print_cycle(name, result)
+            return address, backup_id, result
+
+        target, backup_id, results['full'] = backup('full')
+
+        started = time.time()
+        setup['churn'] = synthfs.churn(churn)
+        for database in databases:
+            database.churn(churn)
+        setup['churn']['seconds'] = round(time.time() - started, 3)
+
+        target, backup_id, results['incremental'] = backup('incremental')
+
+        # simulate losing the workload
+        snapshot, size = _snapshot(synthfs.root)
+        shutil.rmtree(synthfs.root)
+
+        db_snapshots = {}
+        for database in databases:
+            db_snapshots[database.name] = database.snapshot()
+            database.drop()
+
+        args = [ backup_id, "--noninteractive", "--force", "--skip-packages", "--no-rollback" ]
+        if not databases:
+            args.append("--skip-database")
+        elapsed, stats = scratch.run('restore', *args)
+
+        verified = _snapshot(synthfs.root)[0] == snapshot
+        for database in databases:
+            if database.snapshot() != db_snapshots[database.name]:
+                verified = False
+
+        results['restore'] = dict(seconds=round(elapsed, 3),
+                                  phases=_phases(stats),
+                                  bytes_restored=size,
+                                  throughput=int(size / elapsed),
+                                  verified=verified)
+        _print_cycle('restore', results['restore'])
+
+        if not verified:
+            raise Error("restored workload differs from the backup")
+
+    finally:
+        if not keep:
+            for database in databases:
+                try:
+                    database.drop()
+                except Error:
+                    pass
+
+            if target:
+                shutil.rmtree(target[len("file://"):], ignore_errors=True)
+
+    return setup, results
+
+def compare(baseline, results, tolerance):
+    """Returns a list of regressions (cycle, metric, old, new)"""
+    def regressed(metric, old, new):
+        if metric in HIGHER_IS_BETTER:
+            old, new = new, old
+        elif metric not in MIN_DELTA:
+            metric = 'seconds'
+
+        return new - old > MIN_DELTA[metric] and new > old * (1 + tolerance / 100.0)
+
+    regressions = []
+    for cycle in sorted(results):
+        if cycle not in baseline:
+            continue
+
+        old = baseline[cycle]
+        new = results[cycle]
+
+        for metric in ('seconds', 'bytes_uploaded', 'throughput'):
+            if metric in old and metric in new and regressed(metric, old[metric], new[metric]):
+                regressions.append((cycle, metric, old[metric], new[metric]))
+
+        for phase in sorted(new['phases']):
+            if phase in old['phases'] and regressed(phase, old['phases'][phase], new['phases'][phase]):
+                regressions.append((cycle, phase, old['phases'][phase], new['phases'][phase]))
+
+    return regressions
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ]" % sys.argv[0]
+    print >> sys.stderr, (__doc__ % dict(files=FILES, churn=CHURN, tolerance=TOLERANCE)).strip()
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                                       ['workdir=', 'keep', 'output=', 'baseline=', 'tolerance=',
+                                        'files=', 'churn=', 'mysql=', 'pgsql=',
+                                        'depth=', 'fanout=', 'symlinks=', 'sockets=',
+                                        'max-size=', 'seed='])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    if args:
+        usage()
+
+    workdir = None
+    keep = False
+    output = "-"
+    baseline = None
+    tolerance = TOLERANCE
+    churn = CHURN
+
+    databases = []
+    kws = dict(files=FILES)
+    for opt, val in opts:
+        if opt == '-h':
+            usage()
+
+        elif opt == '--workdir':
+            workdir = val
+
+        elif opt == '--keep':
+            keep = True
+
+        elif opt == '--output':
+            output = val
+
+        elif opt == '--baseline':
+            baseline = simplejson.loads(file(val).read())
+
+        else:
+            try:
+                val = int(val)
+            except ValueError:
+                usage("illegal %s value '%s'" % (opt, val))
+
+            if opt == '--tolerance':
+                tolerance = val
+            elif opt == '--churn':
+                churn = val
+            elif opt == '--mysql':
+                databases.append(MySQL(val))
+            elif opt == '--pgsql':
+                databases.append(PgSQL(val))
+            else:
+                kws[opt[2:].replace('-', '_')] = val
+
+    for database in databases:
+        if not database.is_running():
+            usage("--%s needs a running %s server" % (database.name, database.name))
+
+    if workdir:
+        if not exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="e2ebench-")
+
+    synthfs = SynthFS(join(workdir, "workload"), **kws)
+
+    params = dict(synthfs.params(), churn=churn)
+    for database in databases:
+        params[database.name] = database.rows
+
+    report = dict(created=time.time(),
+                  host=platform.node(),
+                  python=platform.python_version(),
+                  cpus=os.sysconf('SC_NPROCESSORS_ONLN'),
+                  params=params)
+
+    try:
+        print >> sys.stderr, "%d entries:" % synthfs.files
+        report['setup'], report['results'] = benchmark(workdir, synthfs, churn, databases, keep)
+    finally:
+        if not keep:
+            shutil.rmtree(workdir)
+
+    if output == "-":
+        print simplejson.dumps(report, indent=2, sort_keys=True)
+    else:
+        file(output, "w").write(simplejson.dumps(report, indent=2, sort_keys=True) + "\n")
+
+    if baseline:
+        if baseline['params'] != report['params']:
+            print >> sys.stderr, "warning: baseline created with different parameters"
+
+        regressions = compare(baseline['results'], report['results'], tolerance)
+        for cycle, metric, old, new in regressions:
+            if metric in ('bytes_uploaded', 'throughput'):
+                old, new = fmt_size(old), fmt_size(new)
+            print >> sys.stderr, "REGRESSION: %s: %s %s -> %s" % (cycle, metric, old, new)
+
+        if regressions:
+            sys.exit(1)
+
+        print >> sys.stderr, "OK: no regressions"
+
+if __name__ == "__main__":
+    main()
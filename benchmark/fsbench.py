@@ -0,0 +1,392 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Benchmark dirindex, whatchanged and overlay on synthetic filesystems
+
+For each scale (number of entries) we create a synthetic tree, index it,
+churn it and compare it to the index. Each benchmark runs in a child
+process so we can measure its peak RSS.
+
+Arguments:
+    scale ...          Number of entries in the synthetic trees
+                       default: %(scales)s
+
+Options:
+    --workdir=PATH     Where we create the trees (default: a temporary directory)
+    --keep             Don't remove workdir when we're done
+
+    --output=PATH      Write the results to PATH as JSON (- for stdout)
+    --baseline=PATH    Compare the results with a previous output and exit
+                       with a non-zero exitcode if anything regressed
+    --tolerance=PERCENT  How much slower or bigger than the baseline is a
+                         regression (default: %(tolerance)d)
+
+Synthetic tree options (see synthfs.py):
+    --depth=N --fanout=N --symlinks=PERCENT --sockets=PERCENT --max-size=BYTES
+    --seed=N
+
+    --churn=PERCENT    Percentage of entries changed after indexing
+                       default: %(churn)d
+
+Environment variables:
+
+    BIN                Path to tklbam source (default: ..)
+"""
+import os
+import sys
+import time
+import getopt
+import shutil
+import platform
+import tempfile
+import traceback
+from os.path import *
+
+import simplejson
+
+sys.path.insert(0, os.environ.get('BIN', join(dirname(abspath(__file__)), '..')))
+
+from dirindex import DirIndex
+from changes import Changes, Executor, whatchanged
+from overlay import apply_overlay
+from utils import fmt_size
+
+from synthfs import SynthFS
+
+SCALES = [ 10000, 100000, 1000000 ]
+CHURN = 10
+TOLERANCE = 20
+
+# differences smaller than these are noise
+MIN_DELTA = dict(seconds=0.05, peak_rss=4 * 1024 * 1024)
+
+class Error(Exception):
+    pass
+
+class Timer:
+    def __init__(self):
+        self.elapsed = 0.0
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+
+    def stop(self):
+        self.elapsed += time.time() - self.started
+
+class Context:
+    def __init__(self, path, synthfs):
+        self.synthfs = synthfs
+        self.root = synthfs.root
+        self.index = join(path, "index")
+        self.fsdelta = join(path, "fsdelta")
+        self.overlay = join(path, "overlay")
+
+# the benchmarks (and the setup they need) in the order they run.
+# Each is passed a Context and a Timer and returns a dict of extra results
+
+def setup_generate(ctx, timer):
+    timer.start()
+    ctx.synthfs.create()
+    timer.stop()
+
+def bench_walk(ctx, timer):
+    di = DirIndex()
+    timer.start()
+    di.walk(ctx.root)
+    timer.stop()
+
+    return dict(entries=len(di))
+
+def bench_save(ctx, timer):
+    di = DirIndex()
+    di.walk(ctx.root)
+
+    timer.start()
+    di.save(ctx.index)
+    timer.stop()
+
+    return dict(bytes=os.lstat(ctx.index).st_size)
+
+def bench_load(ctx, timer):
+    timer.start()
+    di = DirIndex(ctx.index)
+    timer.stop()
+
+    return dict(entries=len(di))
+
+def setup_churn(ctx, timer):
+    timer.start()
+    counts = ctx.synthfs.churn(ctx.churn)
+    timer.stop()
+
+    return counts
+
+def bench_diff(ctx, timer):
+    di_saved = DirIndex(ctx.index)
+    di_fs = DirIndex()
+    di_fs.walk(ctx.root)
+
+    timer.start()
+    new, edited, statfix = di_saved.diff(di_fs)
+    timer.stop()
+
+    return dict(new=len(new), edited=len(edited), statfix=len(statfix))
+
+def bench_whatchanged(ctx, timer):
+    timer.start()
+    changes = whatchanged(ctx.index, [ ctx.root ])
+    timer.stop()
+
+    changes.tofile(ctx.fsdelta)
+    return dict(changes=len(changes))
+
+def bench_changes_fromfile(ctx, timer):
+    timer.start()
+    changes = Changes.fromfile(ctx.fsdelta)
+    timer.stop()
+
+    return dict(changes=len(changes))
+
+def bench_statfixes(ctx, timer):
+    changes = Changes.fromfile(ctx.fsdelta)
+    executor = Executor()
+
+    # the tree is already what fsdelta says it should be, so we don't
+    # optimize away the actions that would have nothing to do
+    timer.start()
+    for action, error in executor.statfixes(changes, optimized=False):
+        pass
+    timer.stop()
+
+    return dict(actions=executor.actions, errors=executor.errors)
+
+def bench_apply_overlay(ctx, timer):
+    # the whole (churned) tree, like restoring a full backup
+    di = DirIndex()
+    di.walk(ctx.root)
+    paths = [ path for path in di if not isdir(path) ]
+
+    os.mkdir(ctx.overlay)
+
+    timer.start()
+    size = apply_overlay('/', ctx.overlay, paths)
+    timer.stop()
+
+    return dict(entries=len(paths), bytes=size)
+
+STEPS = [ setup_generate, bench_walk, bench_save, bench_load,
+          setup_churn, bench_diff, bench_whatchanged, bench_changes_fromfile,
+          bench_statfixes, bench_apply_overlay ]
+
+def _name(step):
+    return step.__name__.split('_', 1)[1]
+
+def run(step, ctx):
+    """run step in a child process. Returns its results"""
+    r, w = os.pipe()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+
+        exitcode = 0
+        try:
+            timer = Timer()
+            result = step(ctx, timer) or {}
+            result['seconds'] = round(timer.elapsed, 3)
+
+            fh = os.fdopen(w, "w")
+            fh.write(simplejson.dumps(result))
+            fh.close()
+        except:
+            traceback.print_exc()
+            exitcode = 1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exitcode)
+
+    os.close(w)
+    fh = os.fdopen(r)
+    output = fh.read()
+    fh.close()
+
+    pid, status, rusage = os.wait4(pid, 0)
+    if status != 0:
+        raise Error("%s failed" % step.__name__)
+
+    result = simplejson.loads(output)
+
+    # kilobytes on Linux
+    result['peak_rss'] = rusage.ru_maxrss * 1024
+    return result
+
+def benchmark(workdir, scale, churn, **kws):
+    """Returns (setup, results) dicts of step name -> results"""
+    path = join(workdir, str(scale))
+    os.mkdir(path)
+
+    synthfs = SynthFS(join(path, "tree"), files=scale, **kws)
+    ctx = Context(path, synthfs)
+    ctx.churn = churn
+
+    setup = {}
+    results = {}
+    try:
+        for step in STEPS:
+            name = _name(step)
+            result = run(step, ctx)
+
+            if step.__name__.startswith('setup_'):
+                setup[name] = result
+            else:
+                results[name] = result
+
+            print >> sys.stderr, "  %-16s %8.3fs  %10s" % (name, result['seconds'],
+                                                            fmt_size(result['peak_rss']))
+    finally:
+        shutil.rmtree(path)
+
+    return setup, results
+
+def compare(baseline, results, tolerance):
+    """Returns a list of regressions (scale, benchmark, metric, old, new)"""
+    regressions = []
+    for scale in sorted(results, key=int):
+        if scale not in baseline:
+            continue
+
+        for name in sorted(results[scale]):
+            if name not in baseline[scale]:
+                continue
+
+            for metric in ('seconds', 'peak_rss'):
+                old = baseline[scale][name][metric]
+                new = results[scale][name][metric]
+
+                if new - old > MIN_DELTA[metric] and new > old * (1 + tolerance / 100.0):
+                    regressions.append((scale, name, metric, old, new))
+
+    return regressions
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ] [ scale ... ]" % sys.argv[0]
+    print >> sys.stderr, (__doc__ % dict(scales=" ".join(map(str, SCALES)),
+                                         tolerance=TOLERANCE, churn=CHURN)).strip()
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                                       ['workdir=', 'keep', 'output=', 'baseline=', 'tolerance=',
+                                        'depth=', 'fanout=', 'symlinks=', 'sockets=',
+                                        'max-size=', 'seed=', 'churn='])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    workdir = None
+    keep = False
+    output = "-"
+    baseline = None
+    tolerance = TOLERANCE
+    churn = CHURN
+
+    kws = {}
+    for opt, val in opts:
+        if opt == '-h':
+            usage()
+
+        elif opt == '--workdir':
+            workdir = val
+
+        elif opt == '--keep':
+            keep = True
+
+        elif opt == '--output':
+            output = val
+
+        elif opt == '--baseline':
+            baseline = simplejson.loads(file(val).read())
+
+        else:
+            try:
+                val = int(val)
+            except ValueError:
+                usage("illegal %s value '%s'" % (opt, val))
+
+            if opt == '--tolerance':
+                tolerance = val
+            elif opt == '--churn':
+                churn = val
+            else:
+                kws[opt[2:].replace('-', '_')] = val
+
+    try:
+        scales = map(int, args) if args else SCALES
+    except ValueError, e:
+        usage(e)
+
+    if workdir:
+        if not exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="fsbench-")
+
+    report = dict(created=time.time(),
+                  host=platform.node(),
+                  python=platform.python_version(),
+                  cpus=os.sysconf('SC_NPROCESSORS_ONLN'),
+                  params=dict(SynthFS(None, **kws).params(), churn=churn),
+                  setup={},
+                  results={})
+    del report['params']['files']
+
+    try:
+        for scale in scales:
+            print >> sys.stderr, "%d entries:" % scale
+            setup, results = benchmark(workdir, scale, churn, **kws)
+
+            report['setup'][str(scale)] = setup
+            report['results'][str(scale)] = results
+    finally:
+        if not keep:
+            shutil.rmtree(workdir)
+
+    if output == "-":
+        print simplejson.dumps(report, indent=2, sort_keys=True)
+    else:
+        file(output, "w").write(simplejson.dumps(report, indent=2, sort_keys=True) + "\n")
+
+    if baseline:
+        if baseline['params'] != report['params']:
+            print >> sys.stderr, "warning: baseline created with different parameters"
+
+        regressions = compare(baseline['results'], report['results'], tolerance)
+        for scale, name, metric, old, new in regressions:
+            if metric == 'peak_rss':
+                old, new = fmt_size(old), fmt_size(new)
+            print >> sys.stderr, "REGRESSION: %s entries: %s %s %s -> %s" % (scale, name, metric, old, new)
+
+        if regressions:
+            sys.exit(1)
+
+        print >> sys.stderr, "OK: no regressions"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Benchmark mysql2fs and fs2mysql on synthetic mysqldumps
+
+For each size (in megabytes) we write a synthetic mysqldump (with
+mysqlcorpus.py), parse it into statements, convert it to a MyFS
+(MyFS_Writer.fromfile) and back (MyFS_Reader.tofile). No MySQL server is
+needed. Each benchmark runs in a child process so we can measure its
+peak RSS.
+
+Arguments:
+    size ...           Sizes of the synthetic mysqldumps in MB
+                       default: %(sizes)s
+
+Options:
+    --corpus=PATH      Benchmark an existing mysqldump instead
+                       (e.g., mysqldump --all-databases --compact --skip-extended-insert)
+    --compress         Compress the rows in the MyFS (like --compress-databases)
+
+    --workdir=PATH     Where we write the dumps (default: a temporary directory)
+    --keep             Don't remove workdir when we're done
+
+    --output=PATH      Write the results to PATH as JSON (- for stdout)
+    --baseline=PATH    Compare the results with a previous output and exit
+                       with a non-zero exitcode if anything regressed
+    --tolerance=PERCENT  How much slower or bigger than the baseline is a
+                         regression (default: %(tolerance)d)
+
+Synthetic mysqldump options (see mysqlcorpus.py):
+    --databases=N --tables=N --columns=N --text-size=BYTES --blob-size=BYTES
+    --blobs=PERCENT --triggers=N --views=N --seed=N
+
+Environment variables:
+
+    BIN                Path to tklbam source (default: ..)
+"""
+import os
+import sys
+import time
+import getopt
+import shutil
+import platform
+import tempfile
+from os.path import *
+
+import simplejson
+
+sys.path.insert(0, os.environ.get('BIN', join(dirname(abspath(__file__)), '..')))
+
+from fsbench import run, compare, TOLERANCE
+from mysqlcorpus import MysqlCorpus
+
+from mysql import MyFS_Writer, MyFS_Reader, _parse_statements
+from utils import fmt_size
+
+SIZES = [ 64, 1024 ]
+
+class Context:
+    def __init__(self, path, corpus):
+        self.corpus = corpus
+        self.dump = join(path, "dump.sql")
+        self.myfs = join(path, "myfs")
+        self.restore = join(path, "restore.sql")
+
+        self.compress = False
+
+        # how many statements the dump has (counted by the parse benchmark)
+        self.statements = None
+
+# the benchmarks (and the setup they need) in the order they run.
+# Each is passed a Context and a Timer and returns a dict of extra results
+
+def setup_generate(ctx, timer):
+    fh = file(ctx.dump, "w")
+    timer.start()
+    counts = ctx.corpus.write(fh)
+    fh.close()
+    timer.stop()
+
+    return counts
+
+def bench_parse(ctx, timer):
+    statements = 0
+
+    timer.start()
+    for statement in _parse_statements(file(ctx.dump)):
+        statements += 1
+    timer.stop()
+
+    return dict(statements=statements, bytes=os.lstat(ctx.dump).st_size)
+
+def bench_mysql2fs(ctx, timer):
+    os.mkdir(ctx.myfs)
+
+    timer.start()
+    databases = MyFS_Writer(ctx.myfs, compress=ctx.compress).fromfile(file(ctx.dump))
+    timer.stop()
+
+    return dict(statements=ctx.statements, bytes=os.lstat(ctx.dump).st_size,
+                databases=len(databases))
+
+def bench_fs2mysql(ctx, timer):
+    # like restoring the MyFS
+    fh = file(ctx.restore, "w")
+
+    timer.start()
+    MyFS_Reader(ctx.myfs, add_drop_database=True).tofile(fh)
+    fh.close()
+    timer.stop()
+
+    return dict(statements=ctx.statements, bytes=os.lstat(ctx.restore).st_size)
+
+STEPS = [ setup_generate, bench_parse, bench_mysql2fs, bench_fs2mysql ]
+
+def _name(step):
+    return step.__name__.split('_', 1)[1]
+
+def _rates(result):
+    if result['seconds']:
+        result['statements_per_second'] = int(result['statements'] / result['seconds'])
+        result['bytes_per_second'] = int(result['bytes'] / result['seconds'])
+
+def benchmark(workdir, corpus, dump=None, compress=False):
+    """Benchmark the dump we write with corpus (or an existing dump).
+    Returns (setup, results) dicts of step name -> results"""
+    path = tempfile.mkdtemp(dir=workdir)
+
+    ctx = Context(path, corpus)
+    ctx.compress = compress
+
+    steps = STEPS
+    if dump:
+        ctx.dump = dump
+        steps = STEPS[1:]
+
+    setup = {}
+    results = {}
+    try:
+        for step in steps:
+            name = _name(step)
+            result = run(step, ctx)
+
+            if step.__name__.startswith('setup_'):
+                setup[name] = result
+                print >> sys.stderr, "  %-10s %8.3fs  %10s" % (name, result['seconds'],
+                                                               fmt_size(result['bytes']))
+                continue
+
+            if ctx.statements is None:
+                ctx.statements = result['statements']
+
+            _rates(result)
+            results[name] = result
+
+            print >> sys.stderr, "  %-10s %8.3fs  %10s  %8d stmts/s  %10s/s" % \
+                                 (name, result['seconds'], fmt_size(result['peak_rss']),
+                                  result.get('statements_per_second', 0),
+                                  fmt_size(result.get('bytes_per_second', 0)))
+    finally:
+        shutil.rmtree(path)
+
+    return setup, results
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ] [ size ... ]" % sys.argv[0]
+    print >> sys.stderr, (__doc__ % dict(sizes=" ".join(map(str, SIZES)),
+                                         tolerance=TOLERANCE)).strip()
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                                       ['corpus=', 'compress',
+                                        'workdir=', 'keep', 'output=', 'baseline=', 'tolerance=',
+                                        'databases=', 'tables=', 'columns=', 'text-size=',
+                                        'blob-size=', 'blobs=', 'triggers=', 'views=', 'seed='])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    dump = None
+    compress = False
+    workdir = None
+    keep = False
+    output = "-"
+    baseline = None
+    tolerance = TOLERANCE
+
+    kws = {}
+    for opt, val in opts:
+        if opt == '-h':
+            usage()
+
+        elif opt == '--corpus':
+            dump = abspath(val)
+
+        elif opt == '--compress':
+            compress = True
+
+        elif opt == '--workdir':
+            workdir = val
+
+        elif opt == '--keep':
+            keep = True
+
+        elif opt == '--output':
+            output = val
+
+        elif opt == '--baseline':
+            baseline = simplejson.loads(file(val).read())
+
+        else:
+            try:
+                val = int(val)
+            except ValueError:
+                usage("illegal %s value '%s'" % (opt, val))
+
+            if opt == '--tolerance':
+                tolerance = val
+            else:
+                kws[opt[2:].replace('-', '_')] = val
+
+    try:
+        sizes = map(int, args) if args else SIZES
+    except ValueError, e:
+        usage(e)
+
+    if dump:
+        if args:
+            usage("--corpus is incompatible with sizes")
+        sizes = [ os.lstat(dump).st_size / (1024 * 1024) ]
+
+    if workdir:
+        if not exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="mysqlbench-")
+
+    params = MysqlCorpus(**kws).params()
+    del params['rows']
+    if dump:
+        params = dict(corpus=dump)
+    params['compress'] = compress
+
+    report = dict(created=time.time(),
+                  host=platform.node(),
+                  python=platform.python_version(),
+                  cpus=os.sysconf('SC_NPROCESSORS_ONLN'),
+                  params=params,
+                  setup={},
+                  results={})
+
+    try:
+        for size in sizes:
+            print >> sys.stderr, "%d MB:" % size
+
+            corpus = MysqlCorpus(**kws)
+            corpus.rows = corpus.rows_for_size(size * 1024 * 1024)
+
+            setup, results = benchmark(workdir, corpus, dump, compress)
+
+            report['setup'][str(size)] = setup
+            report['results'][str(size)] = results
+    finally:
+        if not keep:
+            shutil.rmtree(workdir)
+
+    if output == "-":
+        print simplejson.dumps(report, indent=2, sort_keys=True)
+    else:
+        file(output, "w").write(simplejson.dumps(report, indent=2, sort_keys=True) + "\n")
+
+    if baseline:
+        if baseline['params'] != report['params']:
+            print >> sys.stderr, "warning: baseline created with different parameters"
+
+        regressions = compare(baseline['results'], report['results'], tolerance)
+        for size, name, metric, old, new in regressions:
+            if metric == 'peak_rss':
+                old, new = fmt_size(old), fmt_size(new)
+            print >> sys.stderr, "REGRESSION: %s MB: %s %s %s -> %s" % (size, name, metric, old, new)
+
+        if regressions:
+            sys.exit(1)
+
+        print >> sys.stderr, "OK: no regressions"
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Write a deterministic synthetic mysqldump for benchmarking
+
+The output looks like what tklbam-backup gets from mysqldump --compact
+--skip-extended-insert: many databases and tables of wide rows with
+escaped TEXT and BLOB values, triggers and views. The same arguments
+(including the seed) always write the same dump.
+
+Options:
+    --databases=N      Number of databases                        default: %(databases)d
+    --tables=N         Tables per database                        default: %(tables)d
+    --rows=N           Rows per table                             default: %(rows)d
+    --columns=N        Columns per table (besides the id)         default: %(columns)d
+    --text-size=BYTES  Maximum size of TEXT values                default: %(text_size)d
+    --blob-size=BYTES  Maximum size of BLOB values                default: %(blob_size)d
+    --blobs=PERCENT    Percentage of rows with a BLOB value       default: %(blobs)d
+    --triggers=N       Triggers per table                         default: %(triggers)d
+    --views=N          Views per database                         default: %(views)d
+    --seed=N           Random seed                                default: %(seed)d
+
+    --size=MB          Instead of --rows, as many rows per table as it
+                       takes for a dump of about MB megabytes
+
+    --output=PATH      Where to write the dump (default: stdout)
+"""
+import sys
+import getopt
+import random
+
+class Error(Exception):
+    pass
+
+# like mysql_real_escape_string()
+ESCAPES = { '\0': '\\0', '\n': '\\n', '\r': '\\r', '\\': '\\\\',
+            "'": "\\'", '"': '\\"', '\x1a': '\\Z' }
+
+def escape(s):
+    return "".join([ ESCAPES.get(c, c) for c in s ])
+
+TPL_TABLE = """\
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `%(name)s` (
+  `id` int(10) unsigned NOT NULL AUTO_INCREMENT,
+%(columns)s
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+"""
+
+TPL_TRIGGERS_PRE = """\
+/*!50003 SET @saved_cs_client      = @@character_set_client */ ;
+/*!50003 SET @saved_cs_results     = @@character_set_results */ ;
+/*!50003 SET @saved_col_connection = @@collation_connection */ ;
+/*!50003 SET character_set_client  = utf8 */ ;
+/*!50003 SET character_set_results = utf8 */ ;
+/*!50003 SET collation_connection  = utf8_general_ci */ ;
+/*!50003 SET @saved_sql_mode       = @@sql_mode */ ;
+/*!50003 SET sql_mode              = '' */ ;
+DELIMITER ;;
+"""
+
+TPL_TRIGGER = """\
+/*!50003 CREATE*/ /*!50017 DEFINER=`root`@`localhost`*/ /*!50003 TRIGGER `%(name)s` BEFORE UPDATE ON `%(table)s` FOR EACH ROW BEGIN
+  SET NEW.`c0` = NEW.`c0` + %(i)d;
+  SET NEW.`c1` = CONCAT(OLD.`c1`, ';');
+END */;;
+"""
+
+TPL_TRIGGERS_POST = """\
+DELIMITER ;
+/*!50003 SET sql_mode              = @saved_sql_mode */ ;
+/*!50003 SET character_set_client  = @saved_cs_client */ ;
+/*!50003 SET character_set_results = @saved_cs_results */ ;
+/*!50003 SET collation_connection  = @saved_col_connection */ ;
+"""
+
+# stand-in table, so views of views can be created before their view
+TPL_VIEW_PRE = """\
+/*!50001 DROP VIEW IF EXISTS `%(name)s`*/;
+SET @saved_cs_client     = @@character_set_client;
+SET character_set_client = utf8;
+/*!50001 CREATE TABLE `%(name)s` (
+  `id` tinyint NOT NULL,
+  `c0` tinyint NOT NULL
+) ENGINE=MyISAM */;
+SET character_set_client = @saved_cs_client;
+"""
+
+TPL_VIEW_POST = """\
+/*!50001 DROP TABLE IF EXISTS `%(name)s`*/;
+/*!50001 DROP VIEW IF EXISTS `%(name)s`*/;
+/*!50001 SET @saved_cs_client          = @@character_set_client */;
+/*!50001 SET @saved_cs_results         = @@character_set_results */;
+/*!50001 SET @saved_col_connection     = @@collation_connection */;
+/*!50001 SET character_set_client      = utf8 */;
+/*!50001 SET character_set_results     = utf8 */;
+/*!50001 SET collation_connection      = utf8_general_ci */;
+/*!50001 CREATE ALGORITHM=UNDEFINED */
+/*!50013 DEFINER=`root`@`localhost` SQL SECURITY DEFINER */
+/*!50001 VIEW `%(name)s` AS select `%(table)s`.`id` AS `id`,`%(table)s`.`c0` AS `c0` from `%(table)s` where (`%(table)s`.`c0` > %(i)d) */;
+/*!50001 SET character_set_client      = @saved_cs_client */;
+/*!50001 SET character_set_results     = @saved_cs_results */;
+/*!50001 SET collation_connection      = @saved_col_connection */;
+"""
+
+# column types in the order they repeat. c0 is always an int and c1 a varchar
+COLUMN_TYPES = [ "int(11) DEFAULT NULL",
+                 "varchar(255) DEFAULT NULL",
+                 "text",
+                 "datetime DEFAULT NULL",
+                 "decimal(12,2) DEFAULT NULL",
+                 "bigint(20) NOT NULL DEFAULT '0'" ]
+
+class MysqlCorpus:
+    DATABASES = 4
+    TABLES = 8
+    ROWS = 10000
+    COLUMNS = 12
+    TEXT_SIZE = 1024
+    BLOB_SIZE = 64 * 1024
+    BLOBS = 5
+    TRIGGERS = 1
+    VIEWS = 2
+    SEED = 0
+
+    # we pick values from pools of these many pregenerated values
+    POOL = 256
+
+    def __init__(self, databases=DATABASES, tables=TABLES, rows=ROWS, columns=COLUMNS,
+                 text_size=TEXT_SIZE, blob_size=BLOB_SIZE, blobs=BLOBS,
+                 triggers=TRIGGERS, views=VIEWS, seed=SEED):
+        """blobs is a percentage of rows"""
+        self.databases = databases
+        self.tables = tables
+        self.rows = rows
+        self.columns = max(columns, 2)
+        self.text_size = text_size
+        self.blob_size = blob_size
+        self.blobs = blobs
+        self.triggers = triggers
+        self.views = views
+        self.seed = seed
+
+        rng = random.Random(seed)
+
+        # printable text with the characters that need escaping (and
+        # statement delimiters) sprinkled in, and utf-8
+        alphabet = [ chr(c) for c in range(32, 127) ] * 4 + \
+                   [ '\n', '\r', '\\', "'", '"', ';', '\t' ] + \
+                   [ u'\xe9'.encode('utf-8'), u'\u4e2d'.encode('utf-8') ]
+
+        def text(size):
+            return escape("".join([ rng.choice(alphabet) for i in xrange(size) ]))
+
+        self._strings = [ text(rng.randrange(256)) for i in range(self.POOL) ]
+        self._texts = [ text(rng.randrange(text_size + 1)) for i in range(self.POOL) ]
+        self._blobs = [ escape("".join([ chr(rng.randrange(256)) for i in xrange(rng.randrange(blob_size + 1)) ]))
+                        for i in range(self.POOL / 16) ]
+
+    def params(self):
+        return dict(databases=self.databases, tables=self.tables, rows=self.rows,
+                    columns=self.columns, text_size=self.text_size,
+                    blob_size=self.blob_size, blobs=self.blobs,
+                    triggers=self.triggers, views=self.views, seed=self.seed)
+
+    def _value(self, rng, column):
+        type = column % len(COLUMN_TYPES)
+        if type and rng.random() < 0.05:
+            return "NULL"
+
+        if type == 0:
+            return str(rng.randrange(-2**31, 2**31))
+        elif type == 1:
+            return "'%s'" % self._strings[rng.randrange(self.POOL)]
+        elif type == 2:
+            return "'%s'" % self._texts[rng.randrange(self.POOL)]
+        elif type == 3:
+            return "'20%02d-%02d-%02d %02d:%02d:%02d'" % (rng.randrange(100), rng.randrange(1, 13),
+                                                          rng.randrange(1, 29), rng.randrange(24),
+                                                          rng.randrange(60), rng.randrange(60))
+        elif type == 4:
+            return "%d.%02d" % (rng.randrange(10**9), rng.randrange(100))
+        else:
+            return str(rng.randrange(2**62))
+
+    def _row(self, rng, table, id):
+        values = [ str(id) ] + [ self._value(rng, column) for column in range(self.columns) ]
+        if rng.random() * 100 < self.blobs:
+            values.append("'%s'" % self._blobs[rng.randrange(len(self._blobs))])
+        else:
+            values.append("NULL")
+
+        return "INSERT INTO `%s` VALUES (%s);\n" % (table, ",".join(values))
+
+    def rows_for_size(self, size):
+        """how many rows per table a dump of about size bytes has"""
+        rng = random.Random(self.seed)
+        sample = 1000
+        row_size = sum([ len(self._row(rng, "t00", i)) for i in range(sample) ]) / float(sample)
+
+        return max(1, int(size / (row_size * self.databases * self.tables)))
+
+    def _table(self, name):
+        columns = [ "  `c%d` %s," % (column, COLUMN_TYPES[column % len(COLUMN_TYPES)])
+                    for column in range(self.columns) ]
+        columns.append("  `data` longblob,")
+
+        return TPL_TABLE % dict(name=name, columns="\n".join(columns))
+
+    def write(self, fh):
+        """write the dump to fh. Returns a dict of how many statements
+        and bytes were written"""
+        rng = random.Random(self.seed)
+        counts = dict(statements=0, bytes=0)
+
+        def write(s, statements=1):
+            fh.write(s)
+            counts['statements'] += statements
+            counts['bytes'] += len(s)
+
+        def dbname(i):
+            return "db%03d" % i
+
+        for i in range(self.databases):
+            write("CREATE DATABASE /*!32312 IF NOT EXISTS*/ `%s` /*!40100 DEFAULT CHARACTER SET utf8 */;\n\n" % dbname(i))
+            write("USE `%s`;\n" % dbname(i))
+
+            for j in range(self.tables):
+                table = "t%02d" % j
+                write(self._table(table), 4)
+
+                for id in xrange(1, self.rows + 1):
+                    write(self._row(rng, table, id))
+
+                if self.triggers:
+                    write(TPL_TRIGGERS_PRE, 8)
+                    for k in range(self.triggers):
+                        write(TPL_TRIGGER % dict(name="%s_bu%d" % (table, k), table=table, i=k))
+                    write(TPL_TRIGGERS_POST, 4)
+
+            for k in range(self.views):
+                write(TPL_VIEW_PRE % dict(name="v%02d" % k), 5)
+
+        for i in range(self.databases):
+            if not self.views:
+                continue
+
+            write("\nUSE `%s`;\n" % dbname(i))
+            for k in range(self.views):
+                write(TPL_VIEW_POST % dict(name="v%02d" % k, table="t%02d" % (k % self.tables), i=k), 12)
+
+        return counts
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ]" % sys.argv[0]
+    print >> sys.stderr, (__doc__ % dict(databases=MysqlCorpus.DATABASES, tables=MysqlCorpus.TABLES,
+                                         rows=MysqlCorpus.ROWS, columns=MysqlCorpus.COLUMNS,
+                                         text_size=MysqlCorpus.TEXT_SIZE, blob_size=MysqlCorpus.BLOB_SIZE,
+                                         blobs=MysqlCorpus.BLOBS, triggers=MysqlCorpus.TRIGGERS,
+                                         views=MysqlCorpus.VIEWS, seed=MysqlCorpus.SEED)).strip()
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                                       ['databases=', 'tables=', 'rows=', 'columns=',
+                                        'text-size=', 'blob-size=', 'blobs=',
+                                        'triggers=', 'views=', 'seed=', 'size=', 'output='])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    if args:
+        usage()
+
+    kws = {}
+    size = None
+    output = None
+    for opt, val in opts:
+        if opt == '-h':
+            usage()
+
+        if opt == '--output':
+            output = val
+            continue
+
+        try:
+            val = int(val)
+        except ValueError:
+            usage("illegal %s value '%s'" % (opt, val))
+
+        if opt == '--size':
+            size = val * 1024 * 1024
+        else:
+            kws[opt[2:].replace('-', '_')] = val
+
+    corpus = MysqlCorpus(**kws)
+    if size:
+        corpus.rows = corpus.rows_for_size(size)
+
+    fh = file(output, "w") if output else sys.stdout
+    counts = corpus.write(fh)
+    fh.close()
+
+    print >> sys.stderr, "statements=%d bytes=%d" % (counts['statements'], counts['bytes'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Create a deterministic synthetic filesystem tree for benchmarking
+
+The same arguments (including the seed) always create the same tree, and
+churn the same entries in the same way.
+
+Options:
+    --files=N          Number of entries (besides directories)  default: %(files)d
+    --depth=N          Depth of the directory tree              default: %(depth)d
+    --fanout=N         Subdirectories per directory             default: %(fanout)d
+    --symlinks=PERCENT Percentage of entries that are symlinks  default: %(symlinks)d
+    --sockets=PERCENT  Percentage of entries that are sockets   default: %(sockets)d
+    --max-size=BYTES   Maximum size of a file                   default: %(max_size)d
+    --seed=N           Random seed                              default: %(seed)d
+
+    --churn=PERCENT    Churn the entries of an existing tree created
+                       with the same arguments instead of creating it
+"""
+import os
+import sys
+import stat
+import errno
+import getopt
+import random
+import socket
+from os.path import *
+
+class Error(Exception):
+    pass
+
+# fixed mtimes, so indexes of the same tree are identical
+MTIME = 1000000000
+
+class SynthFS:
+    FILES = 10000
+    DEPTH = 3
+    FANOUT = 10
+    SYMLINKS = 5
+    SOCKETS = 1
+    MAX_SIZE = 1024
+    SEED = 0
+
+    def __init__(self, root, files=FILES, depth=DEPTH, fanout=FANOUT,
+                 symlinks=SYMLINKS, sockets=SOCKETS, max_size=MAX_SIZE, seed=SEED):
+        """symlinks and sockets are percentages of files"""
+        self.root = root
+        self.files = files
+        self.depth = depth
+        self.fanout = fanout
+        self.symlinks = symlinks
+        self.sockets = sockets
+        self.max_size = max_size
+        self.seed = seed
+
+        rng = random.Random(seed)
+        self._data = "".join([ chr(rng.randrange(256)) for i in range(64 * 1024) ])
+
+    def params(self):
+        return dict(files=self.files, depth=self.depth, fanout=self.fanout,
+                    symlinks=self.symlinks, sockets=self.sockets,
+                    max_size=self.max_size, seed=self.seed)
+
+    def dirs(self):
+        """directories (relative to root) in creation order"""
+        dirs = [ "" ]
+        level = [ "" ]
+        for depth in range(self.depth):
+            level = [ join(parent, "d%02d" % i)
+                      for parent in level
+                      for i in range(self.fanout) ]
+            dirs += level
+
+        return dirs
+
+    def entries(self):
+        """yield (path, type, size) of the entries (relative to root).
+        type is 'f' (file), 'l' (symlink) or 's' (socket)"""
+        rng = random.Random(self.seed)
+        dirs = self.dirs()
+
+        for i in xrange(self.files):
+            dir = dirs[rng.randrange(len(dirs))]
+            r = rng.random() * 100
+
+            if r < self.sockets:
+                yield join(dir, "s%07d" % i), 's', 0
+            elif r < self.sockets + self.symlinks:
+                yield join(dir, "l%07d" % i), 'l', 0
+            else:
+                yield join(dir, "f%07d" % i), 'f', rng.randrange(self.max_size + 1)
+
+    def _write(self, path, size, offset=0):
+        fh = file(path, "w")
+        while size:
+            start = offset % len(self._data)
+            chunk = self._data[start:start + size]
+            fh.write(chunk)
+
+            size -= len(chunk)
+            offset += len(chunk)
+        fh.close()
+
+    @staticmethod
+    def _mksocket(path):
+        # socket paths are limited to ~108 characters
+        cwd = os.getcwd()
+        os.chdir(dirname(path))
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(basename(path))
+            sock.close()
+        finally:
+            os.chdir(cwd)
+
+    def create(self):
+        if exists(self.root) and os.listdir(self.root):
+            raise Error("%s is not empty" % self.root)
+
+        for dir in self.dirs():
+            path = join(self.root, dir)
+            if not exists(path):
+                os.mkdir(path)
+
+        for i, (path, type, size) in enumerate(self.entries()):
+            path = join(self.root, path)
+
+            if type == 'f':
+                self._write(path, size, i)
+                os.utime(path, (MTIME, MTIME + i))
+
+            elif type == 'l':
+                # a relative link to a sibling, which may or may not exist
+                os.symlink("f%07d" % (i - 1), path)
+
+            elif type == 's':
+                self._mksocket(path)
+
+    def churn(self, percent):
+        """change percent of the entries (edit, touch, chmod or delete)
+        and add as many new files as one in four of those. Returns a dict
+        of how many entries were changed each way."""
+
+        rng = random.Random(self.seed + 1)
+
+        entries = [ (path, size) for path, type, size in self.entries() if type == 'f' ]
+        count = min(len(entries), int(self.files * percent / 100))
+
+        counts = dict(edit=0, touch=0, chmod=0, delete=0, new=0)
+        for i in sorted(rng.sample(xrange(len(entries)), count)):
+            path, size = entries[i]
+            path = join(self.root, path)
+
+            op = rng.choice(('edit', 'touch', 'chmod', 'delete'))
+            if op == 'edit':
+                self._write(path, size + 1 + rng.randrange(self.max_size + 1), i + 1)
+            elif op == 'touch':
+                os.utime(path, (MTIME, MTIME - i - 1))
+            elif op == 'chmod':
+                os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) ^ 0070)
+            elif op == 'delete':
+                os.remove(path)
+
+            counts[op] += 1
+
+        dirs = self.dirs()
+        for i in range(count / 4):
+            path = join(self.root, dirs[rng.randrange(len(dirs))], "n%07d" % i)
+            self._write(path, rng.randrange(self.max_size + 1), i)
+            counts['new'] += 1
+
+        return counts
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [ -options ] path" % sys.argv[0]
+    print >> sys.stderr, (__doc__ % dict(files=SynthFS.FILES, depth=SynthFS.DEPTH,
+                                         fanout=SynthFS.FANOUT, symlinks=SynthFS.SYMLINKS,
+                                         sockets=SynthFS.SOCKETS, max_size=SynthFS.MAX_SIZE,
+                                         seed=SynthFS.SEED)).strip()
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                                       ['files=', 'depth=', 'fanout=', 'symlinks=',
+                                        'sockets=', 'max-size=', 'seed=', 'churn='])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    kws = {}
+    churn = None
+    for opt, val in opts:
+        if opt == '-h':
+            usage()
+
+        try:
+            val = int(val)
+        except ValueError:
+            usage("illegal %s value '%s'" % (opt, val))
+
+        if opt == '--churn':
+            churn = val
+        else:
+            kws[opt[2:].replace('-', '_')] = val
+
+    if len(args) != 1:
+        usage()
+
+    synthfs = SynthFS(args[0], **kws)
+    if churn is None:
+        synthfs.create()
+    else:
+        counts = synthfs.churn(churn)
+        print " ".join([ "%s=%d" % (op, counts[op]) for op in sorted(counts) ])
+
+if __name__ == "__main__":
+    main()
@@ -12,13 +12,17 @@ import sys
 import os
 from os.path import *
 
-import types
-
-from dirindex import DirIndex
+from dirindex import DirIndex, diff_sorted
+from dirwalk import DirWalker, _get
 from pathmap import PathMap
 
 import stat
 import errno
+import time
+
+import threading
+import Queue
+from itertools import islice
 
 import pwd
 import grp
@@ -55,8 +59,14 @@ class Change:
         if isinstance(change, Change.Deleted):
             assert change.OP == 'd'
 
+        # build a change from a DirIndex.Record without lstat()ing again
+        change = Change.Stat.fromrecord(rec)
+
+    Changes use __slots__ so big fsdeltas are cheap to hold in memory.
     """
-    class Base:
+    class Base(object):
+        __slots__ = ('path', '_stat')
+
         OP = None
         def __init__(self, path):
             self.path = path
@@ -80,10 +90,17 @@ class Change:
             args = line.rstrip().split('\t')
             return cls(*args)
 
+        @classmethod
+        def fromrecord(cls, rec):
+            return cls(rec.path)
+
     class Deleted(Base):
+        __slots__ = ()
         OP = 'd'
 
     class Overwrite(Base):
+        __slots__ = ('uid', 'gid')
+
         OP = 'o'
         def __init__(self, path, uid=None, gid=None):
             Change.Base.__init__(self, path)
@@ -101,30 +118,46 @@ class Change:
         def __str__(self):
             return self.fmt(self.uid, self.gid)
 
+        @classmethod
+        def fromrecord(cls, rec):
+            return cls(rec.path, rec.uid, rec.gid)
+
     class Stat(Overwrite):
+        __slots__ = ('mode',)
+
         OP = 's'
         def __init__(self, path, uid=None, gid=None, mode=None):
             Change.Overwrite.__init__(self, path, uid, gid)
             if mode is None:
                 self.mode = self.stat.st_mode
             else:
-                if isinstance(mode, int):
-                    self.mode = mode
+                if isinstance(mode, (int, long)):
+                    self.mode = int(mode)
                 else:
                     self.mode = int(mode, 8)
 
         def __str__(self):
             return self.fmt(self.uid, self.gid, oct(self.mode))
 
+        @classmethod
+        def fromrecord(cls, rec):
+            return cls(rec.path, rec.uid, rec.gid, rec.mod)
+
     @classmethod
     def parse(cls, line):
-        op2class = dict((val.OP, val) for val in cls.__dict__.values()
-                        if isinstance(val, types.ClassType))
         op = line[0]
-        if op not in op2class:
+        if op not in cls.OPS:
             raise Error("illegal change line: " + line)
 
-        return op2class[op].fromline(line[2:])
+        return cls.OPS[op].fromline(line[2:])
+
+Change.OPS = dict((c.OP, c) for c in (Change.Deleted, Change.Overwrite, Change.Stat))
+
+class _TransparentMap(dict):
+    def __getitem__(self, key):
+        if key in self:
+            return dict.__getitem__(self, key)
+        return key
 
 def mkdir(path):
     try:
@@ -133,13 +166,41 @@ def mkdir(path):
         if e.errno != errno.EEXIST:
             raise
 
-class Changes(list):
-    """
-    A list of Change instances, which we can load from a file and write
-    back to a file.
+class ChangesWriter:
+    """Buffered writer of Change()s to a changes file"""
+
+    BUFSIZE = 1024 * 1024
+
+    def __init__(self, f):
+        self.fh = file(f, "w", self.BUFSIZE)
+
+    def write(self, change):
+        self.fh.write(str(change) + "\n")
+
+    def close(self):
+        self.fh.close()
 
+def iterchanges(f, paths=None):
+    """Parse a changes file (- for stdin) line by line and yield its
+    Change()s. If paths are passed, changes to paths outside them are
+    skipped before they're parsed."""
+    fh = sys.stdin if f == '-' else file(f)
+    pathmap = PathMap(paths) if paths else None
+
+    parse = Change.parse
+    for line in fh:
+        if pathmap is not None:
+            end = line.find('\t', 2)
+            path = line[2:end] if end != -1 else line[2:].rstrip()
+            if path not in pathmap:
+                continue
+
+        yield parse(line)
+
+class _ChangesBase:
+    """
     The smarts is in statfixes() and deleted() methods which compare the
-    list of changes to the current filesystem and yield Action() instances.
+    changes to the current filesystem and yield Action() instances.
 
     Action()s can be printed (e.g., for simulation or verbosity) or called
     to run the operation that needs to be performed.
@@ -170,100 +231,340 @@ class Changes(list):
                 path, = args
                 return "mkdir -p " + path
 
+    def tofile(self, f):
+        writer = ChangesWriter(f)
+        for change in self:
+            writer.write(change)
+        writer.close()
+
+    @classmethod
+    def deleted_actions(cls, change, optimized=True):
+        """return list of Action()s that delete change"""
+        if change.OP != 'd':
+            return []
+
+        if optimized:
+            if not lexists(change.path):
+                return []
+
+            if not islink(change.path) and isdir(change.path):
+                return []
+
+        return [ cls.Action(os.remove, change.path) ]
+
+    @classmethod
+    def statfix_actions(cls, change, uidmap, gidmap, optimized=True):
+        """return list of Action()s that fix the ownership and permissions
+        of change, in the order they need to run. uidmap and gidmap are
+        _TransparentMap()s"""
+        actions = []
+
+        if not optimized or not lexists(change.path):
+            # backwards compat: old backups only stored IMODE in fsdelta, so we assume S_ISDIR
+            if change.OP == 's' and (stat.S_IMODE(change.mode) == change.mode or stat.S_ISDIR(change.mode)):
+                actions.append(cls.Action(mkdir, change.path))
+                actions.append(cls.Action(os.lchown, change.path, uidmap[change.uid], gidmap[change.gid]))
+                actions.append(cls.Action(os.chmod, change.path, stat.S_IMODE(change.mode)))
+
+            if optimized:
+                return actions
+
+        if change.OP == 'd':
+            return actions
+
+        # optimization: if not remapped we can skip 'o' changes
+        if change.OP == 'o' and \
+           change.uid not in uidmap and change.gid not in gidmap:
+            return actions
+
+        st = os.lstat(change.path)
+        if change.OP in ('s', 'o'):
+            if not optimized or \
+               (st.st_uid != uidmap[change.uid] or \
+                st.st_gid != gidmap[change.gid]):
+
+                actions.append(cls.Action(os.lchown, change.path,
+                                          uidmap[change.uid], gidmap[change.gid]))
+
+        if change.OP == 's':
+            if not optimized or \
+                (not islink(change.path) and \
+                 stat.S_IMODE(st.st_mode) != stat.S_IMODE(change.mode)):
+                actions.append(cls.Action(os.chmod, change.path, stat.S_IMODE(change.mode)))
+
+        return actions
+
+    def deleted(self, optimized=True):
+        for change in self:
+            for action in self.deleted_actions(change, optimized):
+                yield action
+
+    def statfixes(self, uidmap={}, gidmap={}, optimized=True):
+        uidmap = _TransparentMap(uidmap)
+        gidmap = _TransparentMap(gidmap)
+
+        for change in self:
+            for action in self.statfix_actions(change, uidmap, gidmap, optimized):
+                yield action
+
+class Changes(_ChangesBase, list):
+    """
+    A list of Change instances, which we can load from a file and write
+    back to a file.
+    """
     def __add__(self, other):
         cls = type(self)
         return cls(list.__add__(self, other))
 
     @classmethod
     def fromfile(cls, f, paths=None):
-        if f == '-':
-            fh = sys.stdin
-        else:
-            fh = file(f)
+        return cls(iterchanges(f, paths))
 
-        changes = [ Change.parse(line) for line in fh.readlines() ]
-        if paths:
-            pathmap = PathMap(paths)
-            changes = [ change for change in changes
-                        if change.path in pathmap ]
+class ChangesFile(_ChangesBase):
+    """
+    Like Changes, but reads the changes file every time it's iterated
+    instead of holding it in memory, so it can be used on big fsdeltas.
 
-        return cls(changes)
+    Example usage::
 
-    def tofile(self, f):
-        file(f, "w").writelines((str(change) + "\n" for change in self))
+        changes = ChangesFile(path, limits)
+        for action in changes.statfixes(uidmap, gidmap):
+            action()
+    """
+    def __init__(self, f, paths=None):
+        self.path = f
+        self.paths = paths
 
-    def deleted(self, optimized=True):
-        for change in self:
-            if change.OP != 'd':
-                continue
+    def __iter__(self):
+        return iterchanges(self.path, self.paths)
 
-            if optimized:
-                if not lexists(change.path):
-                    continue
+class Executor:
+    """Run the Action()s of changes with a bounded pool of threads, so the
+    metadata syscalls of many paths are in flight at the same time.
 
-                if not islink(change.path) and isdir(change.path):
-                    continue
+    Changes are handed to the threads in batches. The actions of a change
+    run in order in the same thread (e.g., mkdir before chown and chmod),
+    and results are yielded in the order of the changes, so the output is
+    the same as running serially.
 
-            yield self.Action(os.remove, change.path)
+    Changes are sorted by path, so a parent comes before its children. A
+    batch with a path under a path of a batch that's still running waits
+    until that batch is done, so a parent is always fixed before its
+    children (e.g., a child's mkdir -p doesn't race its parent's mkdir,
+    chown and chmod).
 
-    def statfixes(self, uidmap={}, gidmap={}, optimized=True):
-        class TransparentMap(dict):
-            def __getitem__(self, key):
-                if key in self:
-                    return dict.__getitem__(self, key)
-                return key
+    A failed action doesn't stop the others. Its error is yielded with it
+    and counted in errors, which the caller must check.
 
-        uidmap = TransparentMap(uidmap)
-        gidmap = TransparentMap(gidmap)
+    Example usage::
 
-        for change in self:
+        executor = Executor()
+        for action, error in executor.statfixes(changes, uidmap, gidmap):
+            if error:
+                print >> sys.stderr, "error: %s" % error
 
-            if not optimized or not lexists(change.path):
-                # backwards compat: old backups only stored IMODE in fsdelta, so we assume S_ISDIR
-                if change.OP == 's' and (stat.S_IMODE(change.mode) == change.mode or stat.S_ISDIR(change.mode)):
-                    yield self.Action(mkdir, change.path)
-                    yield self.Action(os.lchown, change.path, uidmap[change.uid], gidmap[change.gid])
-                    yield self.Action(os.chmod, change.path, stat.S_IMODE(change.mode))
+        print executor
+    """
 
-                if optimized:
-                    continue
+    THREADS = 8
+    BATCH = 256
 
-            if change.OP == 'd':
-                continue
+    def __init__(self, threads=THREADS, batch=BATCH, simulate=False):
+        self.threads = threads
+        self.batch = batch
+        self.simulate = simulate
 
-            # optimization: if not remapped we can skip 'o' changes
-            if change.OP == 'o' and \
-               change.uid not in uidmap and change.gid not in gidmap:
-                continue
+        self.actions = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        rate = self.actions / self.elapsed if self.elapsed else 0
+        return "%d actions in %.1f seconds (%d/s), %d errors" % \
+               (self.actions, self.elapsed, rate, self.errors)
+
+    def statfixes(self, changes, uidmap={}, gidmap={}, optimized=True):
+        """like Changes.statfixes(), but runs the actions. Yields (action, error)"""
+        uidmap = _TransparentMap(uidmap)
+        gidmap = _TransparentMap(gidmap)
 
-            st = os.lstat(change.path)
-            if change.OP in ('s', 'o'):
-                if not optimized or \
-                   (st.st_uid != uidmap[change.uid] or \
-                    st.st_gid != gidmap[change.gid]):
+        def actions(change):
+            return _ChangesBase.statfix_actions(change, uidmap, gidmap, optimized)
 
-                    yield self.Action(os.lchown, change.path,
-                                        uidmap[change.uid], gidmap[change.gid])
+        return self.run(changes, actions)
 
-            if change.OP == 's':
-                if not optimized or \
-                    (not islink(change.path) and \
-                     stat.S_IMODE(st.st_mode) != stat.S_IMODE(change.mode)):
-                    yield self.Action(os.chmod, change.path, stat.S_IMODE(change.mode))
+    def deleted(self, changes, optimized=True):
+        """like Changes.deleted(), but runs the actions. Yields (action, error)"""
+        def actions(change):
+            return _ChangesBase.deleted_actions(change, optimized)
 
-def whatchanged(di_path, paths):
+        return self.run(changes, actions)
+
+    def _run_batch(self, batch, actions):
+        results = []
+        for item in batch:
+            try:
+                item_actions = actions(item)
+            except EnvironmentError, e:
+                results.append((None, e))
+                continue
+
+            for action in item_actions:
+                try:
+                    if not self.simulate:
+                        action()
+                except EnvironmentError, e:
+                    # later actions of the same change depend on this one
+                    results.append((action, e))
+                    break
+
+                results.append((action, None))
+
+        return results
+
+    @staticmethod
+    def _path(item):
+        # a Change() or an Action() on a path
+        return item.path if isinstance(item, Change.Base) else item.args[0]
+
+    def run(self, items, actions=None):
+        """run the actions of items (by default items are Action()s).
+        Yields (action, error) tuples in order. action is None if the error
+        happened while working out what to do"""
+        if actions is None:
+            actions = lambda action: [ action ]
+
+        todo = Queue.Queue()
+        done = Queue.Queue()
+
+        def worker():
+            while True:
+                job = todo.get()
+                if job is None:
+                    return
+
+                i, batch = job
+                try:
+                    done.put((i, self._run_batch(batch, actions), None))
+                except:
+                    done.put((i, None, sys.exc_info()))
+
+        workers = [ threading.Thread(target=worker)
+                    for i in range(self.threads) ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        items = iter(items)
+        started = time.time()
+
+        # results of batches that finished before the ones ahead of them
+        finished = {}
+        submitted = 0
+        yielded = 0
+        exhausted = False
+
+        # path -> index of the running batch it's in
+        running = {}
+        batches = {}
+
+        # next batch, held back until the batches its paths are under are done
+        batch = None
+
+        def waits_for(batch):
+            for item in batch:
+                path = dirname(self._path(item))
+                while path not in ('', '/'):
+                    if path in running:
+                        return True
+                    path = dirname(path)
+
+            return False
+
+        try:
+            while True:
+                # bound the number of batches in flight
+                while not exhausted and submitted - yielded < self.threads * 2:
+                    if batch is None:
+                        batch = list(islice(items, self.batch))
+                        if not batch:
+                            exhausted = True
+                            break
+
+                    if running and waits_for(batch):
+                        break
+
+                    paths = [ self._path(item) for item in batch ]
+                    for path in paths:
+                        running[path] = submitted
+                    batches[submitted] = paths
+
+                    todo.put((submitted, batch))
+                    submitted += 1
+                    batch = None
+
+                if yielded == submitted:
+                    break
+
+                i, results, exc_info = _get(done)
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                for path in batches.pop(i):
+                    if running.get(path) == i:
+                        del running[path]
+
+                finished[i] = results
+                while yielded in finished:
+                    for action, error in finished.pop(yielded):
+                        if action:
+                            self.actions += 1
+                        if error:
+                            self.errors += 1
+
+                        yield action, error
+
+                    yielded += 1
+
+        finally:
+            self.elapsed += time.time() - started
+
+            try:
+                while True:
+                    todo.get_nowait()
+            except Queue.Empty:
+                pass
+
+            for thread in workers:
+                todo.put(None)
+
+            for thread in workers:
+                thread.join()
+
+def whatchanged(di_path, paths, readdir_cache=None, di_fs=None, digests=None):
     """Compared current filesystem with a saved dirindex from before.
+       If di_fs (an up to date DirIndex of paths) isn't passed we walk paths.
+       If digests (a DigestCache) is passed, edited files with the same
+       content as before are stat-only changes.
        Returns a Changes() list."""
 
     di_saved = DirIndex(di_path)
-    di_fs = DirIndex()
-    di_fs.walk(*paths)
+    if di_fs is None:
+        di_fs = DirIndex()
+        di_fs.walk(readdir_cache=readdir_cache, *paths)
 
     new, edited, statfix = di_saved.diff(di_fs)
+    if digests:
+        same = digests.unchanged(di_saved, di_fs, edited)
+        if same:
+            edited = [ path for path in edited if path not in same ]
+            statfix += sorted(same)
+
     changes = Changes()
 
-    changes += [ Change.Overwrite(path) for path in new + edited ]
-    changes += [ Change.Stat(path) for path in statfix ]
+    # the walk already lstat()ed everything, so use its records
+    changes += [ Change.Overwrite.fromrecord(di_fs[path]) for path in new + edited ]
+    changes += [ Change.Stat.fromrecord(di_fs[path]) for path in statfix ]
 
     di_saved.prune(*paths)
     deleted = set(di_saved) - set(di_fs)
@@ -271,3 +572,25 @@ def whatchanged(di_path, paths):
 
     return changes
 
+
+def iter_whatchanged(di_path, paths, readdir_cache=None):
+    """Like whatchanged(), but merges a sorted walk of the filesystem with
+       the saved dirindex as it goes, so memory use doesn't grow with the
+       number of paths. Yields Change()s sorted by path."""
+
+    pathmap = PathMap(paths)
+
+    di_saved = DirIndex.iterfile(di_path)
+    di_fs = ( DirIndex.Record.fromstat(path, st, symlink)
+              for path, st, symlink in DirWalker(paths, sort=True,
+                                                 cache=readdir_cache) )
+
+    for op, rec in diff_sorted(di_saved, di_fs):
+        if op == 'o':
+            yield Change.Overwrite.fromrecord(rec)
+
+        elif op == 's':
+            yield Change.Stat.fromrecord(rec)
+
+        elif rec.path in pathmap:
+            yield Change.Deleted(rec.path)
@@ -0,0 +1,476 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""Track filesystem changes between backups with inotify.
+
+The change tracker is a long running process that watches the backup
+paths and appends the paths that change to a journal. A backup can then
+bring the index of its previous walk up to date by lstat()ing only the
+journaled paths, instead of walking the whole filesystem.
+
+If the tracker wasn't running for the whole interval since the previous
+backup, or events were lost, the journal is unusable and the backup
+falls back to a full walk.
+"""
+import os
+import re
+import stat
+import errno
+import time
+import struct
+import ctypes
+import ctypes.util
+from os.path import *
+
+from paths import Paths
+from pathmap import PathMap
+from dirindex import DirIndex
+from dirwalk import DirWalker
+
+class Error(Exception):
+    pass
+
+class Unusable(Error):
+    pass
+
+def _escape(path):
+    return path.replace("\\", "\\\\").replace("\n", "\\n")
+
+def _unescape(path):
+    return re.sub(r'\\(.)', lambda m: "\n" if m.group(1) == "n" else m.group(1), path)
+
+def _subpaths(pathmap, root):
+    """return paths that walk root with the includes/excludes under it"""
+    prefix = root.rstrip('/') + '/'
+
+    excludes = [ path for path in pathmap.excludes if path.startswith(prefix) ]
+
+    # globs are matched lazily so they may match under root wherever they start
+    excludes += [ glob.pattern for glob in pathmap.globs
+                  if not glob.sign and glob.pattern not in excludes ]
+
+    return [ root ] + \
+           [ path for path in pathmap.includes if path.startswith(prefix) ] + \
+           [ '-' + path for path in excludes ]
+
+class Inotify:
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    # struct inotify_event: wd, mask, cookie, len (followed by the name)
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise Error("inotify not supported")
+
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise Error("inotify_init: " + os.strerror(ctypes.get_errno()))
+
+        self._libc = libc
+        self.fd = fd
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+
+        return wd
+
+    def read(self):
+        """block until there are events and return them as a list of
+        (wd, mask, name) tuples"""
+        buf = os.read(self.fd, 64 * 1024)
+
+        events = []
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, length = self.EVENT.unpack_from(buf, i)
+            i += self.EVENT.size
+
+            name = buf[i:i + length].rstrip('\0')
+            i += length
+
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Journal:
+    """Append-only journal of changed paths (text, one entry per line):
+
+        # tklbam-change-journal 1 <session> <pid>
+        # <path>\t<path>...
+
+        s /path         the entry changed (e.g., written to, chmod)
+        w /path         the subtree changed (e.g., created, deleted, moved)
+        !overflow       events were lost
+        !stopped        the tracker stopped
+
+    Backslashes and newlines in paths are escaped (\\\\ and \\n). An entry
+    we can't parse makes the journal unusable.
+    """
+
+    MAGIC = "# tklbam-change-journal 2"
+
+    def __init__(self, path):
+        try:
+            fh = file(path)
+        except IOError:
+            raise Unusable("no change journal")
+
+        header = fh.readline().split()
+        if len(header) != 5 or " ".join(header[:3]) != self.MAGIC:
+            raise Unusable("bad change journal header")
+
+        self.path = path
+        self.session = header[3]
+        self.pid = int(header[4])
+
+        self.paths = fh.readline()[2:].rstrip("\n").split("\t")
+        self.start = fh.tell()
+
+    def is_running(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+
+        return True
+
+    def end(self):
+        """return offset after the last complete entry"""
+        fh = file(self.path)
+        fh.seek(0, 2)
+        size = fh.tell()
+
+        offset = size
+        while offset > self.start:
+            block = min(4096, offset - self.start)
+            fh.seek(offset - block)
+
+            i = fh.read(block).rfind("\n")
+            if i != -1:
+                return offset - block + i + 1
+
+            offset -= block
+
+        return self.start
+
+    def entries(self, offset, end):
+        """return list of (op, path) entries between offsets"""
+        fh = file(self.path)
+        fh.seek(offset)
+
+        entries = []
+        for line in fh.read(end - offset).splitlines():
+            if line.startswith("!"):
+                raise Unusable("change tracker " + line[1:])
+
+            try:
+                op, path = line.split(" ", 1)
+            except ValueError:
+                op, path = None, None
+
+            if op not in ('s', 'w') or not path.startswith('/'):
+                raise Unusable("bad change journal entry %s" % `line`)
+
+            entries.append((op, _unescape(path)))
+
+        return entries
+
+    @classmethod
+    def create(cls, path, session, paths):
+        """atomically start a new journal and return a file handle to append to"""
+        path_tmp = path + ".tmp"
+
+        fh = file(path_tmp, "w")
+        print >> fh, "%s %s %d" % (cls.MAGIC, session, os.getpid())
+        print >> fh, "# " + "\t".join(paths)
+        fh.close()
+
+        os.rename(path_tmp, path)
+        return file(path, "a")
+
+class TrackerPaths(Paths):
+    files = [ 'journal', 'dirindex', 'state' ]
+
+class ChangeTracker:
+    """Watch paths with inotify and journal changes until interrupted.
+
+    A new journal session is started once all the directories are watched.
+    Running out of inotify watches is fatal because we can't tell which
+    changes we'd miss.
+    """
+
+    MASK = Inotify.IN_MODIFY | Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE | \
+           Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | \
+           Inotify.IN_CREATE | Inotify.IN_DELETE | \
+           Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF | \
+           Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW
+
+    SUBTREE_EVENTS = Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO | \
+                     Inotify.IN_CREATE | Inotify.IN_DELETE | \
+                     Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF
+
+    # start a new session (and so a full walk) when the journal gets this big
+    MAX_JOURNAL = 64 * 1024 * 1024
+
+    def __init__(self, path, paths, log=None):
+        self.paths = TrackerPaths(path)
+        if not exists(self.paths):
+            os.makedirs(self.paths)
+
+        self.backup_paths = paths
+        self.pathmap = PathMap(paths)
+        self.log = log
+
+        self.inotify = Inotify()
+        self.watches = {}
+
+        self.journal = None
+        self.journaled = set()
+
+    def _log(self, s):
+        if self.log:
+            self.log(s)
+
+    def _watch(self, dir):
+        try:
+            wd = self.inotify.add_watch(dir, self.MASK)
+        except OSError, e:
+            # vanished already, a subtree event covers it
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+
+            raise Error("can't watch %s: %s" % (dir, e.strerror))
+
+        self.watches[wd] = dir
+
+    def _watch_tree(self, root):
+        # retry if the tree changes under us (the changes are journaled)
+        for attempt in range(3):
+            try:
+                for path, st, symlink in DirWalker(_subpaths(self.pathmap, root)):
+                    if stat.S_ISDIR(st.st_mode):
+                        self._watch(path)
+                return
+
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+
+        raise Error("can't watch %s: changing too fast" % root)
+
+    def _start_session(self):
+        if self.journal:
+            self.journal.close()
+
+        session = "%d.%d" % (time.time(), os.getpid())
+        self.journal = Journal.create(self.paths.journal, session, self.backup_paths)
+        self.journaled = set()
+
+        self._log("started change journal session " + session)
+
+    def _append(self, op, path):
+        entry = "%s %s" % (op, _escape(path))
+        if entry in self.journaled:
+            return
+
+        self.journaled.add(entry)
+        print >> self.journal, entry
+
+    def _handle(self, wd, mask, name):
+        if mask & Inotify.IN_Q_OVERFLOW:
+            print >> self.journal, "!overflow"
+            self.journaled = set()
+            return
+
+        dir = self.watches.get(wd)
+        if dir is None:
+            return
+
+        if mask & Inotify.IN_IGNORED:
+            del self.watches[wd]
+            return
+
+        path = join(dir, name) if name else dir
+        if path not in self.pathmap:
+            return
+
+        if mask & self.SUBTREE_EVENTS:
+            if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and \
+               mask & Inotify.IN_ISDIR:
+                self._watch_tree(path)
+
+            self._append('w', path)
+        else:
+            self._append('s', path)
+
+    def run(self):
+        for root in self.pathmap.includes:
+            # the parent tells us if root itself is created or deleted
+            self._watch(dirname(root))
+
+            if isdir(root) and not islink(root):
+                self._watch_tree(root)
+
+        self._log("watching %d directories" % len(self.watches))
+        self._start_session()
+
+        try:
+            while True:
+                try:
+                    events = self.inotify.read()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                for wd, mask, name in events:
+                    self._handle(wd, mask, name)
+
+                # only dedup within a batch: a backup may read the journal
+                # between batches and needs to see later changes again
+                self.journal.flush()
+                self.journaled = set()
+
+                if self.journal.tell() > self.MAX_JOURNAL:
+                    self._start_session()
+
+        finally:
+            print >> self.journal, "!stopped"
+            self.journal.close()
+            self.inotify.close()
+
+class TrackedIndex:
+    """The index of the previous backup's walk, kept up to date with the
+    change tracker's journal.
+
+    Raises Unusable if the change tracker isn't running with the same paths.
+    The journal offset is recorded when we're created, so create an instance
+    before walking the filesystem.
+
+    Example usage::
+
+        tracked = TrackedIndex(registry.path.change_tracker, paths)
+        try:
+            di = tracked.load()
+        except Unusable:
+            di = DirIndex()
+            di.walk(*paths)
+        tracked.save(di)
+    """
+
+    def __init__(self, path, paths):
+        self.paths = TrackerPaths(path)
+        self.backup_paths = paths
+
+        journal = Journal(self.paths.journal)
+        if not journal.is_running():
+            raise Unusable("change tracker not running")
+
+        if journal.paths != list(paths):
+            raise Unusable("change tracker watching different paths")
+
+        self.journal = journal
+        self.cutoff = journal.end()
+
+        self.changed = None
+
+    def load(self):
+        """Return a DirIndex of the filesystem.
+        Raises Unusable if the journal doesn't cover all changes"""
+        try:
+            session, offset = file(self.paths.state).read().split()
+            offset = int(offset)
+        except (IOError, ValueError):
+            raise Unusable("no index from a previous backup")
+
+        if session != self.journal.session:
+            raise Unusable("change tracker restarted since the previous backup")
+
+        entries = self.journal.entries(offset, self.cutoff)
+
+        di = DirIndex(self.paths.dirindex)
+        self._apply(di, entries)
+        di.prune(*self.backup_paths)
+
+        self.changed = len(entries)
+        return di
+
+    def _apply(self, di, entries):
+        pathmap = PathMap(self.backup_paths)
+
+        subtrees = set()
+        paths = set()
+        for op, path in entries:
+            if op == 'w':
+                subtrees.add(path)
+            else:
+                paths.add(path)
+
+        # creating or deleting an entry changes the mtime of its parent
+        paths.update([ dirname(path) for path in subtrees ])
+
+        def covered(path):
+            while path not in ('', '/'):
+                path = dirname(path)
+                if path in subtrees:
+                    return True
+
+            return False
+
+        roots = [ path for path in subtrees if not covered(path) ]
+        di.remove(*roots)
+        for root in roots:
+            if root in pathmap and lexists(root):
+                di.walk(*_subpaths(pathmap, root))
+
+        for path in paths:
+            if path not in pathmap:
+                continue
+
+            try:
+                di.add_path(path)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+
+                di.remove(path)
+
+    def save(self, di):
+        """save di as the index to bring up to date in the next backup"""
+        path_tmp = self.paths.dirindex + ".tmp"
+        di.save(path_tmp)
+        os.rename(path_tmp, self.paths.dirindex)
+
+        path_tmp = self.paths.state + ".tmp"
+        fh = file(path_tmp, "w")
+        print >> fh, "%s %d" % (self.journal.session, self.cutoff)
+        fh.close()
+        os.rename(path_tmp, self.paths.state)
@@ -54,6 +54,10 @@ Options:
     --logfile=PATH                 Path of file to log verbosely to
                                    default: $LOGFILE
 
+    --statsfile=PATH               Path of file the timing and resource metrics
+                                   of each phase are appended to as a line of JSON
+                                   default: $STATSFILE
+
     --debug                        Run $$SHELL before Duplicity
 
 Configurable options:
@@ -82,6 +86,52 @@ Configurable options:
     --skip-database                Don't backup databases
     --skip-packages                Don't backup new packages
 
+    --stream-fsdelta               Compare the filesystem to the backup profile
+                                   in a single sorted pass, writing changes as
+                                   they're found. Uses less memory on big
+                                   filesystems, but doesn't walk in parallel.
+                                   Ignored with --change-tracker while the
+                                   tracker is running (it needs a full index)
+
+    --content-digests              Don't upload edited files if their content
+                                   is the same as in the backup profile (e.g.,
+                                   they were just touched). Digests of files
+                                   that match the profile are learned up to
+                                   64 MB per backup. File digests are cached
+                                   so unchanged files aren't re-read.
+                                   Ignored with --stream-fsdelta
+
+    --readdir-cache                Reuse the directory listings of the last
+                                   backup for directories that haven't changed
+                                   since. Saves reading directories on big
+                                   filesystems, but holds every listing in
+                                   memory. Ignored with --stream-fsdelta
+
+    --change-tracker               Only lstat the paths the change tracker
+                                   (tklbam-internal change-tracker) journaled
+                                   since the last backup, instead of walking
+                                   the filesystem. Falls back to a walk if the
+                                   tracker wasn't running all along
+
+    --one-filesystem               Don't walk into other filesystems mounted
+                                   under the backed up paths, unless they're
+                                   explicitly included. Pseudo (e.g., proc,
+                                   tmpfs), network and bind mounts are always
+                                   skipped unless explicitly included
+
+    --compress-databases           Compress database dumps as they're produced,
+                                   so staging them in /TKLBAM takes less disk
+                                   space (incrementals are larger). Restoring
+                                   them requires this version of TKLBAM or later
+
+    --mysql-parallel=N             Number of mysqldump sessions that dump
+                                   MySQL tables in parallel, from the same
+                                   consistent snapshot. Writes are blocked
+                                   while the sessions start (if
+                                   that takes too long, a single
+                                   session dumps MySQL instead)
+                                   default: $CONF_MYSQL_PARALLEL
+
     --force-profile=PROFILE_ID     Force backup profile (e.g., "core")
                                    default: cat /etc/turnkey_version
 
@@ -138,6 +188,7 @@ from pidlock import PidLock
 
 import hub
 import backup
+import dirwalk
 import duplicity
 
 import hooks
@@ -148,10 +199,12 @@ from version import detect_profile_id
 from stdtrap import UnitedStdTrap
 
 from utils import is_writeable, fmt_title, fmt_timestamp, path_global_or_local
+from metrics import metrics
 
 import traceback
 
 PATH_LOGFILE = path_global_or_local("/var/log/tklbam-backup", registry.path.backup_log)
+PATH_STATSFILE = path_global_or_local("/var/log/tklbam-backup.json", registry.path.backup_json)
 PATH_PIDLOCK = path_global_or_local("/var/run/tklbam-backup.pid", registry.path.backup_pid)
 
 def usage(e=None):
@@ -168,7 +221,9 @@ def usage(e=None):
                                     CONF_VOLSIZE=conf.volsize,
                                     CONF_FULL_BACKUP=conf.full_backup,
                                     CONF_S3_PARALLEL_UPLOADS=conf.s3_parallel_uploads,
-                                    LOGFILE=PATH_LOGFILE)
+                                    CONF_MYSQL_PARALLEL=conf.backup_mysql_parallel,
+                                    LOGFILE=PATH_LOGFILE,
+                                    STATSFILE=PATH_STATSFILE)
     sys.exit(1)
 
 def warn(e):
@@ -195,10 +250,11 @@ def main():
                                        ['help',
                                         'dump=',
                                         'raw-upload=',
-                                        'skip-files', 'skip-database', 'skip-packages',
+                                        'skip-files', 'skip-database', 'skip-packages', 'stream-fsdelta', 'content-digests',
+                                        'readdir-cache', 'change-tracker', 'one-filesystem', 'compress-databases', 'mysql-parallel=',
                                         'debug',
                                         'resume', 'disable-resume',
-                                        'logfile=',
+                                        'logfile=', 'statsfile=',
                                         'simulate', 'quiet',
                                         'force-profile=', 'secretfile=', 'address=',
                                         'volsize=', 's3-parallel-uploads=', 'full-backup='])
@@ -214,6 +270,7 @@ def main():
     opt_resume = None
     opt_disable_resume = False
     opt_logfile = PATH_LOGFILE
+    opt_statsfile = PATH_STATSFILE
 
     conf = Conf()
     conf.secretfile = registry.path.secret
@@ -277,6 +334,11 @@ def main():
                 fatal("logfile '%s' is not writeable" % val)
             opt_logfile = val
 
+        elif opt == '--statsfile':
+            if not is_writeable(val):
+                fatal("statsfile '%s' is not writeable" % val)
+            opt_statsfile = val
+
         elif opt == '--debug':
             opt_debug = True
 
@@ -289,6 +351,27 @@ def main():
         elif opt == '--skip-packages':
             conf.backup_skip_packages = True
 
+        elif opt == '--stream-fsdelta':
+            conf.backup_stream_fsdelta = True
+
+        elif opt == '--content-digests':
+            conf.backup_content_digests = True
+
+        elif opt == '--readdir-cache':
+            conf.backup_readdir_cache = True
+
+        elif opt == '--change-tracker':
+            conf.backup_change_tracker = True
+
+        elif opt == '--one-filesystem':
+            conf.backup_one_filesystem = True
+
+        elif opt == '--compress-databases':
+            conf.backup_compress_databases = True
+
+        elif opt == '--mysql-parallel':
+            conf.backup_mysql_parallel = val
+
         elif opt in ('-h', '--help'):
             usage()
 
@@ -323,57 +406,61 @@ def main():
     if conf.s3_parallel_uploads > 1 and conf.s3_parallel_uploads > (conf.volsize / 5):
         warn("s3-parallel-uploads > volsize / 5 (minimum upload chunk is 5MB)")
 
+    metrics.command = "backup"
+
     if not raw_upload_path:
-        try:
-            update_profile(conf.force_profile)
-        except hub.Backups.NotInitialized, e:
-            fatal("you need a profile to backup, run tklbam-init first")
+        with metrics.phase('profile'):
+            try:
+                update_profile(conf.force_profile)
+            except hub.Backups.NotInitialized, e:
+                fatal("you need a profile to backup, run tklbam-init first")
 
     credentials = None
     if not conf.address and not dump_path:
-        try:
-            hb = hub_backups()
-        except hub.Backups.NotInitialized, e:
-            fatal(str(e) + "\n" +
-                  "tip: you can still use tklbam-backup with --dump or --address")
+        with metrics.phase('hub'):
+            try:
+                hb = hub_backups()
+            except hub.Backups.NotInitialized, e:
+                fatal(str(e) + "\n" +
+                      "tip: you can still use tklbam-backup with --dump or --address")
 
-        try:
-            registry.credentials = hb.get_credentials()
-        except hb.Error, e:
-            # asking for get_credentials() might fail if the hub is down.
-            # But If we already have the credentials we can survive that.
+            try:
+                registry.credentials = hb.get_credentials()
+            except hb.Error, e:
+                # asking for get_credentials() might fail if the hub is down.
+                # But If we already have the credentials we can survive that.
 
-            if isinstance(e, hub.NotSubscribed) or \
-                    not registry.credentials or \
-                    registry.credentials.type == 'iamrole':
-                fatal(e)
+                if isinstance(e, hub.NotSubscribed) or \
+                        not registry.credentials or \
+                        registry.credentials.type == 'iamrole':
+                    fatal(e)
 
-            warn("using cached backup credentials: " + e.description)
+                warn("using cached backup credentials: " + e.description)
 
-        credentials = registry.credentials
+            credentials = registry.credentials
 
-        if registry.hbr:
-            try:
-                registry.hbr = hb.get_backup_record(registry.hbr.backup_id)
-            except hb.Error, e:
-                # if the Hub is down we can hope that the cached address
-                # is still valid and warn and try to backup anyway.
-                #
-                # But if we reach the Hub and it tells us the backup is invalid
-                # we must invalidate the cached backup record and start over.
+            if registry.hbr:
+                try:
+                    registry.hbr = hb.get_backup_record(registry.hbr.backup_id)
+                except hb.Error, e:
+                    # if the Hub is down we can hope that the cached address
+                    # is still valid and warn and try to backup anyway.
+                    #
+                    # But if we reach the Hub and it tells us the backup is invalid
+                    # we must invalidate the cached backup record and start over.
 
-                if isinstance(e, hub.InvalidBackupError):
-                    warn("old backup record deleted, creating new ... ")
-                    registry.hbr = None
-                else:
-                    warn("using cached backup record: " + str(e))
+                    if isinstance(e, hub.InvalidBackupError):
+                        warn("old backup record deleted, creating new ... ")
+                        registry.hbr = None
+                    else:
+                        warn("using cached backup record: " + str(e))
 
-        if not registry.hbr:
-            registry.hbr = hb.new_backup_record(registry.key,
-                                                detect_profile_id(),
-                                                get_server_id())
+            if not registry.hbr:
+                registry.hbr = hb.new_backup_record(registry.key,
+                                                    detect_profile_id(),
+                                                    get_server_id())
 
-        conf.address = registry.hbr.address
+            conf.address = registry.hbr.address
 
     if opt_resume:
         conf = registry.backup_resume_conf
@@ -415,6 +502,7 @@ def main():
             except hb.Error, e:
                 warn("can't update Hub of backup %s: %s" % ("in progress" if bool else "completed", str(e)))
 
+    status = "failed"
     try:
         backup_inprogress(True)
 
@@ -437,10 +525,17 @@ def main():
 
         else:
             hooks.backup.pre()
+            dirwalk.DirWalker.ONE_FILESYSTEM = conf.backup_one_filesystem
             b = backup.Backup(registry.profile,
                               conf.overrides,
                               conf.backup_skip_files, conf.backup_skip_packages, conf.backup_skip_database,
-                              opt_resume, True, dump_path if dump_path else "/")
+                              opt_resume, True, dump_path if dump_path else "/",
+                              stream_fsdelta=conf.backup_stream_fsdelta,
+                              readdir_cache=registry.path.readdir_cache if conf.backup_readdir_cache else None,
+                              change_tracker=registry.path.change_tracker if conf.backup_change_tracker else None,
+                              digest_cache=registry.path.digest_cache if conf.backup_content_digests else None,
+                              compress_databases=conf.backup_compress_databases,
+                              mysql_parallel=conf.backup_mysql_parallel)
 
             hooks.backup.inspect(b.extras_paths.path)
 
@@ -471,6 +566,8 @@ def main():
                 if not dump_path:
                     shutil.rmtree(b.extras_paths.path)
 
+        status = "ok"
+
     except:
         if trap:
             print >> log_fh
@@ -480,6 +577,17 @@ def main():
 
     finally:
         backup_inprogress(False)
+
+        print "\n" + fmt_title("Backup phases", '-')
+        print metrics
+
+        # even for --simulate, --debug and --dump runs. Don't hide the
+        # error we may be raising
+        try:
+            metrics.tofile(opt_statsfile, status)
+        except Exception, e:
+            warn("can't write metrics to %s: %s" % (opt_statsfile, e))
+
         if trap:
             sys.stdout.flush()
             sys.stderr.flush()
@@ -495,6 +603,9 @@ def main():
             stats = m.group(1)
             print stats.strip()
 
+        print "\n" + fmt_title("Backup phases", '-')
+        print metrics
+
     registry.backup_resume_conf = None
 
     if not (opt_simulate or dump_path):
@@ -0,0 +1,94 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Apply an overlay of files to a destination (like restoring the fsdelta-olist)
+
+Arguments:
+    <overlay>                  Directory the paths are copied from
+    <dest>                     Directory the paths are copied to
+    <olist>                    File with a list of paths (- for stdin)
+
+Options:
+    -u --uid-map=<mapspec>     Old to new UID map
+    -g --gid-map=<mapspec>     Old to new GID map
+
+    -m --move                  Move files into place instead of copying them
+
+    -t --threads=N             Number of threads to apply paths with
+                               (default: %d)
+
+    <mapspec> := <key>,<val>[:<key>,<val> ...]
+"""
+
+import sys
+import getopt
+from os.path import abspath
+
+import overlay
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [-options] overlay dest olist|-" % sys.argv[0]
+    print >> sys.stderr, (__doc__ % overlay.THREADS).strip()
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:g:t:mh',
+                                       ['uid-map=', 'gid-map=', 'threads=', 'move'])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    move = False
+    threads = overlay.THREADS
+
+    uidmap = {}
+    gidmap = {}
+
+    def parse_idmap(line):
+        return dict([ map(int, val.split(',', 1)) for val in line.split(':') ])
+
+    for opt, val in opts:
+        if opt in ('-u', '--uid-map'):
+            uidmap = parse_idmap(val)
+        elif opt in ('-g', '--gid-map'):
+            gidmap = parse_idmap(val)
+        elif opt in ('-m', '--move'):
+            move = True
+        elif opt in ('-t', '--threads'):
+            try:
+                threads = int(val)
+            except ValueError:
+                usage("illegal --threads value '%s'" % val)
+        else:
+            usage()
+
+    if len(args) != 3:
+        usage()
+
+    src, dst, olist = args
+    src = abspath(src)
+    dst = abspath(dst)
+
+    fh = file(olist) if olist != '-' else sys.stdin
+    paths = fh.read().splitlines()
+
+    try:
+        overlay.apply_overlay(src, dst, paths, uidmap, gidmap, move, threads)
+    except overlay.Error, e:
+        print >> sys.stderr, "error: " + str(e)
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python2
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""
+Journal filesystem changes so backups don't need to walk the filesystem
+
+Watches the paths in the backup profile's dirindex.conf and the filesystem
+overrides with inotify until interrupted. While it keeps running, backups
+with the backup-change-tracker option (--change-tracker) only lstat the
+paths in the journal. Otherwise they fall back to a full walk.
+
+Run it from your init system. Overrides passed on the command line must
+match the ones passed to tklbam-backup.
+
+Options:
+    -q --quiet          Don't log to stderr
+"""
+import sys
+import signal
+import getopt
+from os.path import exists
+
+from registry import registry
+from conf import Conf
+from backup import ProfilePaths
+from dirindex import read_paths
+
+import dirwalk
+import changetracker
+
+def usage(e=None):
+    if e:
+        print >> sys.stderr, "error: " + str(e)
+
+    print >> sys.stderr, "Syntax: %s [-options] [ override ... ]" % sys.argv[0]
+    print >> sys.stderr, __doc__.strip()
+    sys.exit(1)
+
+def fatal(e):
+    print >> sys.stderr, "error: " + str(e)
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'qh', ['quiet', 'help'])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    opt_verbose = True
+    for opt, val in opts:
+        if opt in ('-h', '--help'):
+            usage()
+
+        elif opt in ('-q', '--quiet'):
+            opt_verbose = False
+
+    if not registry.profile:
+        fatal("no backup profile")
+
+    conf = Conf()
+    conf.overrides += args
+
+    profile_paths = ProfilePaths(registry.profile.path)
+    dirindex_conf = profile_paths.dirindex_conf if exists(profile_paths.dirindex_conf) else "/dev/null"
+
+    paths = read_paths(file(dirindex_conf))
+    paths += conf.overrides.fs
+
+    dirwalk.DirWalker.ONE_FILESYSTEM = conf.backup_one_filesystem
+
+    def log(s):
+        print >> sys.stderr, "change-tracker: " + s
+
+    def terminate(sig, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    try:
+        tracker = changetracker.ChangeTracker(registry.path.change_tracker, paths,
+                                              log if opt_verbose else None)
+        tracker.run()
+    except changetracker.Error, e:
+        fatal(e)
+    except KeyboardInterrupt:
+        pass
+
+if __name__=="__main__":
+    main()
@@ -74,6 +74,10 @@ Options:
     --root=PATH     Use this as the root path, instead of /
                     This is useful for generating backup profiles for chroot filesystems
 
+    --text          Write the dirindex in the text format instead of the binary format
+
+                    Older versions of TKLBAM can only read text indexes.
+
 
 Usage examples:
 
@@ -94,7 +98,6 @@ import re
 
 import dirindex
 from backup import ProfilePaths
-from temp import TempFile
 
 class Error(Exception):
     pass
@@ -121,12 +124,15 @@ class ProfileGenerator:
         paths = [ re.sub(r'^(-?)', '\\1' + path_rootfs, path) 
                   for path in paths ]
 
-        tmp = TempFile()
-        dirindex.create(tmp.path, paths)
+        di = dirindex.DirIndex()
+        di.walk(*paths)
 
-        filtered = [ re.sub(r'^' + path_rootfs, '', line) 
-                            for line in file(tmp.path).readlines() ]
-        return "".join(filtered)
+        filtered = dirindex.DirIndex()
+        for rec in di.records():
+            rec.path = re.sub(r'^' + path_rootfs, '', rec.path)
+            filtered[rec.path] = rec
+
+        return filtered
 
     @staticmethod
     def _get_packages(path_rootfs):
@@ -156,7 +162,7 @@ class ProfileGenerator:
         packages.sort()
         return packages
 
-    def __init__(self, conf_paths, path_output, rootfs="/", packages=True, dirindex=True):
+    def __init__(self, conf_paths, path_output, rootfs="/", packages=True, dirindex=True, text=False):
 
         paths = ProfilePaths(path_output)
 
@@ -166,7 +172,7 @@ class ProfileGenerator:
 
         if dirindex:
             di = self._get_dirindex(paths.dirindex_conf, rootfs)
-            file(paths.dirindex, "w").write(di)
+            di.save(paths.dirindex, text)
 
         if packages:
             packages = self._get_packages(rootfs)
@@ -199,13 +205,15 @@ def main():
         opts, args = getopt.gnu_getopt(sys.argv[1:], 'fh', ['force', 'help', 
                                                             'root=',
                                                             'no-dirindex', 
-                                                            'no-packages'])
+                                                            'no-packages',
+                                                            'text'])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_force = False
     opt_dirindex = True
     opt_packages = True
+    opt_text = False
     opt_root = "/"
 
     for opt, val in opts:
@@ -224,6 +232,9 @@ def main():
         if opt == '--root':
             opt_root = val
 
+        if opt == '--text':
+            opt_text = True
+
     if not args:
         usage()
 
@@ -247,7 +258,7 @@ def main():
     except Error, e:
         fatal(e)
 
-    profile = ProfileGenerator(conf_paths, path_output, opt_root, packages=opt_packages, dirindex=opt_dirindex)
+    profile = ProfileGenerator(conf_paths, path_output, opt_root, packages=opt_packages, dirindex=opt_dirindex, text=opt_text)
 
     title = "Custom profile written to %s" % profile.paths.path
     print title
@@ -16,30 +16,54 @@ Options:
     -i --input=PATH     Read a list of paths from a file (- for stdin)
 
     -c --create         Create index
+       --text           Create index in the text format (default: binary)
+
+    -e --export         Print index in the text format
+
+    -t --threads=N      Number of threads to walk the filesystem with
+                        (default: %d)
+
+       --tracker=PATH   Compare with the index the change tracker keeps in
+                        PATH, brought up to date with its journal, instead
+                        of walking (falls back to a walk if unusable)
+
+       --digest-cache=PATH
+                        Compare the content of edited files with the digests
+                        cached in PATH (see tklbam-backup --content-digests)
 """
 import sys
 import getopt
 
 import dirindex
 import changes
+import changetracker
+import digestcache
+
+from dirwalk import DirWalker
 
 def usage(e=None):
     if e:
         print >> sys.stderr, "error: " + str(e)
 
     print >> sys.stderr, "Syntax: %s [-options] index path1 ... pathN" % sys.argv[0]
-    print >> sys.stderr, __doc__.strip()
+    print >> sys.stderr, (__doc__ % DirWalker.THREADS).strip()
     sys.exit(1)
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'i:ch', 
-                                       ['create', 'input='])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'i:cet:h', 
+                                       ['create', 'text', 'export',
+                                        'input=', 'threads=', 'tracker=',
+                                        'digest-cache='])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_create = False
+    opt_text = False
+    opt_export = False
     opt_input = None
+    opt_tracker = None
+    opt_digest_cache = None
 
     for opt, val in opts:
         if opt in ('-h', '--help'):
@@ -48,9 +72,34 @@ def main():
         elif opt in ('-c', '--create'):
             opt_create = True
 
+        elif opt == '--text':
+            opt_text = True
+
+        elif opt in ('-e', '--export'):
+            opt_export = True
+
         elif opt in ('-i', '--input'):
             opt_input = val
 
+        elif opt == '--tracker':
+            opt_tracker = val
+
+        elif opt == '--digest-cache':
+            opt_digest_cache = val
+
+        elif opt in ('-t', '--threads'):
+            try:
+                dirindex.DirIndex.WALK_THREADS = int(val)
+            except ValueError:
+                usage("illegal --threads value '%s'" % val)
+
+    if opt_export:
+        if len(args) != 1:
+            usage("--export needs a single index argument")
+
+        dirindex.DirIndex(args[0]).save('-', text=True)
+        return
+
     if not args or (not opt_input and len(args) < 2):
         usage()
 
@@ -62,11 +111,23 @@ def main():
         paths = dirindex.read_paths(fh) + paths
 
     if opt_create:
-        dirindex.create(path_index, paths)
+        dirindex.create(path_index, paths, opt_text)
         return
 
-    for change in changes.whatchanged(path_index, paths):
+    di_fs = None
+    if opt_tracker:
+        try:
+            di_fs = changetracker.TrackedIndex(opt_tracker, paths).load()
+        except changetracker.Unusable, e:
+            print >> sys.stderr, "can't use change journal (%s), walking filesystem" % e
+
+    digests = digestcache.DigestCache(opt_digest_cache) if opt_digest_cache else None
+
+    for change in changes.whatchanged(path_index, paths, di_fs=di_fs, digests=digests):
         print change
 
+    if digests:
+        digests.save()
+
 if __name__=="__main__":
     main()
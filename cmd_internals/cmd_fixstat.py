@@ -18,6 +18,9 @@ Options:
 
     -v --verbose               Print list of fixes
     -s --simulate              Print list of fixes, don't apply them
+
+    -t --threads=N             Number of fixes to run in parallel
+                               (default: %d)
     
     <mapspec> := <key>,<val>[:<key>,<val> ...]
 """
@@ -26,25 +29,26 @@ import os
 import sys
 import getopt
 
-from changes import Changes
+from changes import ChangesFile, Executor
 
 def usage(e=None):
     if e:
         print >> sys.stderr, "error: " + str(e)
 
     print >> sys.stderr, "Syntax: %s [-options] delta|- [path ...]" % sys.argv[0]
-    print >> sys.stderr, __doc__.strip()
+    print >> sys.stderr, (__doc__ % Executor.THREADS).strip()
     sys.exit(1)
 
 def main():
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:g:svh', 
-                                       ['uid-map=', 'gid-map=', 'simulate', 'verbose'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'u:g:t:svh', 
+                                       ['uid-map=', 'gid-map=', 'threads=', 'simulate', 'verbose'])
     except getopt.GetoptError, e:
         usage(e)
 
     verbose = False
     simulate = False
+    threads = Executor.THREADS
 
     uidmap = {}
     gidmap = {}
@@ -61,6 +65,11 @@ def main():
             simulate = True
         elif opt in ('-v', '--verbose'):
             verbose = True
+        elif opt in ('-t', '--threads'):
+            try:
+                threads = int(val)
+            except ValueError:
+                usage("illegal --threads value '%s'" % val)
         else:
             usage()
 
@@ -70,16 +79,23 @@ def main():
     delta = args[0]
     paths = args[1:]
 
-    changes = Changes.fromfile(delta, paths)
+    changes = ChangesFile(delta, paths)
     if simulate:
         verbose = True
 
-    for action in changes.statfixes(uidmap, gidmap):
-        if verbose:
+    executor = Executor(threads, simulate=simulate)
+    for action, error in executor.statfixes(changes, uidmap, gidmap):
+        if action and verbose:
             print action
 
-        if not simulate:
-            action()
+        if error:
+            print >> sys.stderr, "error: " + str(error)
+
+    # stdout is the list of actions (if any), so keep the timing out of it
+    print >> sys.stderr, executor
+
+    if executor.errors:
+        sys.exit(1)
 
 if __name__=="__main__":
     main()
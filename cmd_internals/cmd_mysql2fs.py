@@ -16,6 +16,8 @@ Options:
     -D --delete             Delete contents of output dir
     --fromfile=PATH         Read mysqldump output from file (- for STDIN)
                             Requires: --all-databases --skip-extended-insert
+    --parallel=N            Dump tables with N parallel mysqldump sessions
+                            (see tklbam-backup --mysql-parallel)
 
     -v --verbose            Turn on verbosity
 
@@ -53,13 +55,14 @@ def usage(e=None):
 def main():
     try:
         opts, args = getopt.gnu_getopt(sys.argv[1:], 'Du:p:v', 
-                                       ['verbose', 'delete', 'fromfile=',
+                                       ['verbose', 'delete', 'fromfile=', 'parallel=',
                                         'user=', 'password=', 'defaults-file=', 'host='])
     except getopt.GetoptError, e:
         usage(e)
 
     opt_verbose = False
     opt_fromfile = None
+    opt_parallel = None
     opt_delete = False
     myconf = {}
     for opt, val in opts:
@@ -67,6 +70,13 @@ def main():
             opt_verbose = True
         elif opt == '--fromfile':
             opt_fromfile = val
+        elif opt == '--parallel':
+            try:
+                opt_parallel = int(val)
+                if opt_parallel < 1:
+                    raise ValueError
+            except ValueError:
+                usage("illegal --parallel value '%s'" % val)
         elif opt in ('-D', "--delete"):
             opt_delete = True
         elif opt in ('-u', '--user'):
@@ -89,12 +99,23 @@ def main():
     if opt_fromfile and myconf:
         fatal("--fromfile incompatible with mysqldump options")
 
+    if opt_fromfile and opt_parallel:
+        fatal("--fromfile incompatible with --parallel")
+
     if opt_delete and isdir(outdir):
         shutil.rmtree(outdir)
 
     if not exists(outdir):
         os.mkdir(outdir)
 
+    if opt_parallel:
+        try:
+            mysql.mysql2fs_parallel(outdir, opt_parallel, limits,
+                                    callback=mysql.cb_print() if opt_verbose else None, **myconf)
+        except mysql.Error, e:
+            fatal(e)
+        return
+
     if opt_fromfile:
         if opt_fromfile == '-':
             mysqldump_fh = sys.stdin
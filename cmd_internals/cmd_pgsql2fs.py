@@ -11,11 +11,19 @@
 # 
 """
 Dump PostgreSQL databases to a filesystem path.
+
+Options:
+    --checkpoints=PATH  Keep the databases listed in PATH (dumped to
+                        the output path before) and add the databases
+                        we dump to it, like a resumed backup
 """
 from os.path import *
 
 import sys
+import getopt
+
 import pgsql
+from backup import Checkpoints
 
 def fatal(e):
     print >> sys.stderr, "fatal: " + str(e)
@@ -25,20 +33,35 @@ def usage(e=None):
     if e:
         print >> sys.stderr, "error: " + str(e)
 
-    print >> sys.stderr, "Syntax: %s path/to/output [ -?database/table ... ] " % sys.argv[0]
+    print >> sys.stderr, "Syntax: %s [ -options ] path/to/output [ -?database/table ... ] " % sys.argv[0]
     print >> sys.stderr, __doc__.strip()
     sys.exit(1)
 
 def main():
-    args = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['checkpoints='])
+    except getopt.GetoptError, e:
+        usage(e)
+
+    checkpoints = None
+    for opt, val in opts:
+        if opt == '-h':
+            usage()
+
+        elif opt == '--checkpoints':
+            checkpoints = Checkpoints(val)
+            checkpoints.create()
+
     if not args:
         usage()
 
     outdir = args[0]
     limits = args[1:]
 
-    pgsql.backup(outdir, limits)
+    try:
+        pgsql.backup(outdir, limits, checkpoints=checkpoints)
+    except pgsql.Error, e:
+        fatal(e)
 
 if __name__ == "__main__":
     main()
-
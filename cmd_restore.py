@@ -78,6 +78,11 @@ Options / System restore:
     --logfile=PATH                    Path to log file
                                       default: /var/log/tklbam-restore
 
+    --statsfile=PATH                  Path of file the timing and resource
+                                      metrics of each phase are appended to
+                                      as a line of JSON
+                                      default: /var/log/tklbam-restore.json
+
     --no-rollback                     Disable rollback
     --silent                          Disable feedback
 
@@ -154,6 +159,7 @@ from registry import registry, update_profile, hub_backups
 
 from version import TurnKeyVersion
 from utils import is_writeable, fmt_timestamp, fmt_title, path_global_or_local
+from metrics import metrics
 
 from conf import Conf
 
@@ -161,6 +167,7 @@ import backup
 import traceback
 
 PATH_LOGFILE = path_global_or_local("/var/log/tklbam-restore", registry.path.restore_log)
+PATH_STATSFILE = path_global_or_local("/var/log/tklbam-restore.json", registry.path.restore_json)
 
 class Error(Exception):
     pass
@@ -293,6 +300,7 @@ def main():
     opt_key = None
     opt_address = None
     opt_logfile = PATH_LOGFILE
+    opt_statsfile = PATH_STATSFILE
 
     skip_files = False
     skip_database = False
@@ -309,7 +317,7 @@ def main():
                                         'help',
                                         'simulate',
                                         'limits=', 'address=', 'keyfile=',
-                                        'logfile=',
+                                        'logfile=', 'statsfile=',
                                         'restore-cache-size=', 'restore-cache-dir=',
                                         'force',
                                         'time=',
@@ -371,6 +379,11 @@ def main():
                 fatal("logfile '%s' is not writeable" % val)
             opt_logfile = val
 
+        elif opt == '--statsfile':
+            if not is_writeable(val):
+                fatal("statsfile '%s' is not writeable" % val)
+            opt_statsfile = val
+
         elif opt == '--noninteractive':
             interactive = False
 
@@ -471,7 +484,10 @@ def main():
             raw_download_path = TempDir(prefix="tklbam-")
             os.chmod(raw_download_path, 0700)
 
-    update_profile(conf.force_profile, strict=False)
+    metrics.command = "restore"
+
+    with metrics.phase('profile'):
+        update_profile(conf.force_profile, strict=False)
 
     if not (opt_simulate or opt_debug):
         log_fh = file(opt_logfile, "a")
@@ -485,11 +501,16 @@ def main():
     else:
         trap = None
 
+    status = "failed"
     try:
         hooks.restore.pre()
 
+        # we can move files out of a backup extract we downloaded ourselves,
+        # unless a hook may look for them in TKLBAM_BACKUP_EXTRACT_PATH
+        extract_disposable = False
         if not backup_extract_path:
             backup_extract_path = get_backup_extract()
+            extract_disposable = not hooks.restore.exist()
 
         extras_paths = backup.ExtrasPaths(backup_extract_path)
 
@@ -501,7 +522,8 @@ def main():
         if not silent:
             print fmt_title("Restoring system from backup extract at " + backup_extract_path)
 
-        restore = Restore(backup_extract_path, limits=opt_limits, rollback=not no_rollback, simulate=opt_simulate)
+        restore = Restore(backup_extract_path, limits=opt_limits, rollback=not no_rollback, simulate=opt_simulate,
+                          move_overlay=extract_disposable)
 
         if restore.conf:
             os.environ['TKLBAM_RESTORE_PROFILE_ID'] = restore.conf.profile_id
@@ -532,6 +554,17 @@ def main():
         print
         hooks.restore.post()
 
+        status = "ok"
+
+    except Restore.Error, e:
+        # an expected failure (e.g., some post-overlay fixes failed), so
+        # there's no traceback worth logging
+        fatal(e)
+
+    except SystemExit:
+        # fatal() already said why
+        raise
+
     except:
         if trap:
             print >> log_fh
@@ -540,6 +573,17 @@ def main():
         raise
 
     finally:
+        if not silent:
+            print "\n" + fmt_title("Restore phases", '-')
+            print metrics
+
+        # even for --simulate and --debug runs. Don't hide the error we
+        # may be raising
+        try:
+            metrics.tofile(opt_statsfile, status)
+        except Exception, e:
+            warn("can't write metrics to %s: %s" % (opt_statsfile, e))
+
         if trap:
             sys.stdout.flush()
             sys.stderr.flush()
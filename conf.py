@@ -119,13 +119,28 @@ class Conf(AttrDict):
             except ValueError:
                 raise self.Error("s3-parallel-uploads not a number (%s)" % val)
 
+        if name == 'backup_mysql_parallel':
+            try:
+                val = int(val)
+            except ValueError:
+                raise self.Error("backup-mysql-parallel not a number (%s)" % val)
+
+            if val < 1:
+                raise self.Error("backup-mysql-parallel must be at least 1 (%d)" % val)
+
         if name == 'restore_cache_size':
             if not re.match(r'^\d+(%|mb?|gb?)?$', val, re.IGNORECASE):
                 raise self.Error("bad restore-cache value (%s)" % val)
 
         backup_skip_options = [ 'backup_skip_' + opt
                                 for opt in ('files', 'database', 'packages') ]
-        if name in backup_skip_options:
+        bool_options = backup_skip_options + [ 'backup_stream_fsdelta',
+                                               'backup_content_digests',
+                                               'backup_readdir_cache',
+                                               'backup_change_tracker',
+                                               'backup_one_filesystem',
+                                               'backup_compress_databases' ]
+        if name in bool_options:
             if val not in (True, False):
                 if re.match(r'^true|1|yes$', val, re.IGNORECASE):
                     val = True
@@ -134,7 +149,7 @@ class Conf(AttrDict):
                 else:
                     raise self.Error("bad bool value '%s'" % val)
 
-            if val:
+            if val and name in backup_skip_options:
                 os.environ['TKLBAM_' + name.upper()] = 'yes'
 
         AttrDict.__setitem__(self, name, val)
@@ -163,6 +178,14 @@ class Conf(AttrDict):
         self.backup_skip_database = False
         self.backup_skip_packages = False
 
+        self.backup_stream_fsdelta = False
+        self.backup_content_digests = False
+        self.backup_readdir_cache = False
+        self.backup_change_tracker = False
+        self.backup_one_filesystem = False
+        self.backup_compress_databases = False
+        self.backup_mysql_parallel = 1
+
         if not exists(self.paths.conf):
             return
 
@@ -179,7 +202,11 @@ class Conf(AttrDict):
             try:
                 if opt in ('full-backup', 'volsize', 's3-parallel-uploads',
                            'restore-cache-size', 'restore-cache-dir',
-                           'backup-skip-files', 'backup-skip-packages', 'backup-skip-database', 'force-profile'):
+                           'backup-skip-files', 'backup-skip-packages', 'backup-skip-database', 'force-profile',
+                           'backup-stream-fsdelta', 'backup-content-digests',
+                           'backup-readdir-cache', 'backup-change-tracker',
+                           'backup-one-filesystem', 'backup-compress-databases',
+                           'backup-mysql-parallel'):
 
                     attrname = opt.replace('-', '_')
                     setattr(self, attrname, val)
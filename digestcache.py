@@ -0,0 +1,269 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+import os
+import sys
+import stat
+import errno
+import marshal
+import hashlib
+
+import threading
+import Queue
+
+from dirwalk import _get
+
+def _key(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+def _digest(path):
+    """return (key, digest) of a regular file or None if it isn't one or
+    it changed while we read it"""
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK | getattr(os, 'O_NOFOLLOW', 0))
+    except OSError, e:
+        if e.errno in (errno.ENOENT, errno.ELOOP, errno.EACCES):
+            return None
+        raise
+
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        h = hashlib.sha256()
+        while True:
+            buf = os.read(fd, 1024 * 1024)
+            if not buf:
+                break
+            h.update(buf)
+
+        if _key(os.fstat(fd)) != _key(st):
+            return None
+
+        return _key(st), h.hexdigest()
+
+    finally:
+        os.close(fd)
+
+class DigestCache:
+    """Persistent cache of file content digests.
+
+    Digests are keyed by (dev, inode, size, mtime, ctime) so an unchanged
+    file is never hashed twice.
+
+    An edited file can only be backed up as a stat-only change if its
+    content is still the backup profile's, so each backup stores a
+    baseline: the digests of files taken while their size and mtime still
+    matched the profile. The next backup hashes only the edited files (the
+    overlay candidates) and compares them with that baseline. The baseline
+    is learned a little at a time (at most LEARN_BYTES per backup, smallest
+    files first), so enabling digests doesn't read the whole tree at once.
+
+    Example usage::
+
+        digests = DigestCache("/var/lib/tklbam/digest-cache")
+        same = digests.unchanged(di_profile, di_fs, edited)
+        digests.save()
+    """
+
+    VERSION = 1
+    THREADS = 4
+
+    LEARN_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, path=None, threads=THREADS, learn_bytes=LEARN_BYTES):
+        self.path = path
+        self.threads = threads
+        self.learn_bytes = learn_bytes
+
+        self.cached = {}
+        self.baseline = {}
+        if path:
+            self._load(path)
+
+        self.digests = {}
+
+    def _load(self, path):
+        try:
+            version, cached, baseline = marshal.load(file(path, "rb"))
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+
+        if version != self.VERSION:
+            return
+
+        self.cached = cached
+        self.baseline = baseline
+
+    def save(self, path=None):
+        """save digests used in this run and the baseline (atomically)"""
+        if path is None:
+            path = self.path
+
+        path_tmp = path + ".tmp"
+        fh = file(path_tmp, "wb")
+        marshal.dump((self.VERSION, self.digests, self.baseline), fh)
+        fh.close()
+
+        os.rename(path_tmp, path)
+
+    def _hash(self, paths):
+        todo = Queue.Queue()
+        done = Queue.Queue()
+
+        def worker():
+            while True:
+                path = todo.get()
+                if path is None:
+                    return
+
+                try:
+                    done.put((path, _digest(path), None))
+                except:
+                    done.put((path, None, sys.exc_info()))
+
+        workers = [ threading.Thread(target=worker)
+                    for i in range(min(self.threads, len(paths))) ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        for path in paths:
+            todo.put(path)
+
+        try:
+            for i in xrange(len(paths)):
+                path, result, exc_info = _get(done)
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                yield path, result
+
+        finally:
+            try:
+                while True:
+                    todo.get_nowait()
+            except Queue.Empty:
+                pass
+
+            for thread in workers:
+                todo.put(None)
+
+            for thread in workers:
+                thread.join()
+
+    def digest(self, paths):
+        """return dict of path -> digest of regular files in paths.
+        Only files that changed since they were last hashed are read."""
+        digests = {}
+
+        todo = []
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except OSError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise
+                continue
+
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            cached = self.cached.get(path)
+            if cached and cached[0] == _key(st):
+                self.digests[path] = cached
+                digests[path] = cached[1]
+            else:
+                todo.append(path)
+
+        for path, result in self._hash(todo):
+            if result:
+                self.digests[path] = result
+                digests[path] = result[1]
+
+        return digests
+
+    def unchanged(self, di_saved, di_fs, edited):
+        """Return set of paths in edited (the overlay candidates of a diff
+        of di_saved and di_fs) whose content is the same as in di_saved
+        (e.g., the backup profile's index), going by the baseline the
+        previous backup stored. Only the paths in edited are hashed.
+
+        Also drops paths that aren't in di_fs any more from the baseline
+        and learns the digests of more files that still match di_saved."""
+        baseline = self.baseline
+
+        for path in baseline.keys():
+            if path not in di_fs:
+                del baseline[path]
+
+        candidates = []
+        for path in edited:
+            if path not in baseline:
+                continue
+
+            saved = di_saved[path]
+            if baseline[path][:2] != (saved.size, saved.mtime):
+                # the profile changed, so we learn its version again
+                del baseline[path]
+                continue
+
+            candidates.append(path)
+
+        same = set([ path for path, digest in self.digest(candidates).items()
+                     if digest == baseline[path][2] ])
+
+        self._learn(di_saved, di_fs, edited)
+
+        return same
+
+    def _learn(self, di_saved, di_fs, edited):
+        """add the digests of files that match di_saved to the baseline,
+        smallest files first, reading at most learn_bytes"""
+        unlearned = set(di_fs)
+        unlearned.difference_update(self.baseline)
+        unlearned.difference_update(edited)
+
+        todo = []
+        for path in unlearned:
+            if path not in di_saved:
+                continue
+
+            rec = di_fs[path]
+            if not stat.S_ISREG(rec.mod):
+                continue
+
+            saved = di_saved[path]
+            if (saved.size, saved.mtime) != (rec.size, rec.mtime):
+                continue
+
+            todo.append((rec.size, path))
+
+        todo.sort()
+
+        budget = self.learn_bytes
+        profile_stat = {}
+        for size, path in todo:
+            if size > budget:
+                break
+
+            budget -= size
+            profile_stat[path] = (size, di_saved[path].mtime)
+
+        for path, result in self._hash(profile_stat.keys()):
+            if not result:
+                continue
+
+            key, digest = result
+
+            # the file may have been edited since the walk
+            if (key[2], int(key[3])) == profile_stat[path]:
+                self.baseline[path] = profile_stat[path] + (digest,)
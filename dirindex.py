@@ -10,16 +10,48 @@
 #
 import re
 import os
+import sys
 import stat
 from os.path import *
 
+import mmap
+import struct
+
+from array import array
+from bisect import bisect_left
+from operator import itemgetter, eq, ne, or_, not_
+from itertools import compress, imap, islice
+
 from pathmap import PathMap
+from dirwalk import DirWalker
 
 class Error(Exception):
     pass
 
-class DirIndex(dict):
-    class Record:
+def _gather(column, rows):
+    """return a tuple of column values at rows, in bulk"""
+    if not rows:
+        return ()
+
+    if len(rows) == 1:
+        return (column[rows[0]],)
+
+    return itemgetter(*rows)(column)
+
+class DirIndex(object):
+    """Index of file metadata, keyed by path.
+
+    The index is stored in columns: a sorted list of interned paths and
+    parallel arrays of mod, uid, gid, size and mtime values. Records are only
+    created when they are looked up, so a large index costs a few arrays
+    instead of an object per file, and diff() compares whole columns at once.
+
+    Mtimes are whole seconds, like in the saved formats, so an index
+    compares the same before and after a save and load.
+    """
+    class Record(object):
+        __slots__ = ('path', 'mod', 'uid', 'gid', 'size', 'mtime', 'symlink')
+
         def __init__(self, path, mod, uid, gid, size, mtime,
                      symlink=None):
             self.path = path
@@ -30,6 +62,14 @@ class DirIndex(dict):
             self.mtime = mtime
             self.symlink = symlink
 
+        @classmethod
+        def fromstat(cls, path, st, symlink=None):
+            return cls(path,
+                       st.st_mode,
+                       st.st_uid, st.st_gid,
+                       st.st_size, int(st.st_mtime),
+                       symlink)
+
         @classmethod
         def frompath(cls, path):
             st = os.lstat(path)
@@ -37,12 +77,7 @@ class DirIndex(dict):
             symlink = os.readlink(path) \
                       if stat.S_ISLNK(st.st_mode) else None
 
-            rec = cls(path,
-                      st.st_mode,
-                      st.st_uid, st.st_gid,
-                      st.st_size, st.st_mtime,
-                      symlink)
-            return rec
+            return cls.fromstat(path, st, symlink)
 
         @classmethod
         def fromline(cls, line):
@@ -71,125 +106,476 @@ class DirIndex(dict):
             return "DirIndex.Record(%s, mod=%s, uid=%d, gid=%d, size=%d, mtime=%d)" % \
                     (`self.path`, oct(self.mod), self.uid, self.gid, self.size, self.mtime)
 
+    WALK_THREADS = DirWalker.THREADS
+
     @classmethod
-    def create(cls, path_index, paths):
+    def create(cls, path_index, paths, text=False):
         """create index from paths"""
         di = cls()
         di.walk(*paths)
-        di.save(path_index)
+        di.save(path_index, text)
 
         return di
 
-    def __init__(self, fromfile=None):
-        if fromfile:
-            for line in file(fromfile).readlines():
-                if not line.strip():
-                    continue
+    @classmethod
+    def load(cls, path):
+        """Return a read-only index of path. Binary indexes are mmap'd and
+        searched in place, text indexes are parsed into a DirIndex."""
+        if MappedIndex.is_binary(path):
+            return MappedIndex(path)
 
-                rec = DirIndex.Record.fromline(line)
-                self[rec.path] = rec
+        return cls(path)
 
-    def add_path(self, path):
-        """add a single path to the DirIndex"""
-        self[path] = DirIndex.Record.frompath(path)
+    @classmethod
+    def iterfile(cls, path):
+        """Yield the Records of an index file sorted by path, without
+        loading the whole index into memory. Raises Error if the index
+        isn't sorted (saved indexes always are)."""
+        if MappedIndex.is_binary(path):
+            for rec in MappedIndex(path).records():
+                yield rec
+            return
+
+        last = None
+        for line in file(path):
+            if not line.strip():
+                continue
 
-    def walk(self, *paths):
-        """walk paths and add files to index"""
-        pathmap = PathMap(paths)
+            rec = DirIndex.Record.fromline(line)
+            if last is not None and rec.path <= last:
+                raise Error("index not sorted by path: %s (%s)" % (path, rec.path))
 
-        def _walk(dir):
-            dentries = []
+            last = rec.path
+            yield rec
 
-            for dentry in os.listdir(dir):
-                path = join(dir, dentry)
-                if path in pathmap.excludes:
-                    continue
+    def _clear(self):
+        self._paths = []
+        self._mod = array('L')
+        self._uid = array('L')
+        self._gid = array('L')
 
-                dentries.append(dentry)
+        # doubles hold sizes beyond 4GB and mtimes beyond 2038 on 32-bit
+        self._size = array('d')
+        self._mtime = array('d')
 
-                if not islink(path) and isdir(path):
-                    for val in _walk(path):
-                        yield val
+        # symlinks are rare so we don't waste a column on them
+        self._symlinks = {}
+        self._sorted = True
 
-            yield dir, dentries
+    def __init__(self, fromfile=None):
+        self._clear()
 
-        for path in pathmap.includes:
-            if not lexists(path):
-                continue
+        if not fromfile:
+            return
 
-            self.add_path(path)
+        if MappedIndex.is_binary(fromfile):
+            for rec in MappedIndex(fromfile).records():
+                self[rec.path] = rec
+            return
 
-            if islink(path) or not isdir(path):
+        for line in file(fromfile).readlines():
+            if not line.strip():
                 continue
 
-            for dpath, dentries in _walk(path):
-                for dentry in dentries:
-                    path = join(dpath, dentry)
+            rec = DirIndex.Record.fromline(line)
+            self[rec.path] = rec
+
+    def _append(self, path, mod, uid, gid, size, mtime, symlink):
+        paths = self._paths
+        if self._sorted and paths and path <= paths[-1]:
+            self._sorted = False
+
+        paths.append(intern(path))
+        self._mod.append(mod)
+        self._uid.append(uid)
+        self._gid.append(gid)
+        self._size.append(size)
+        self._mtime.append(int(mtime))
+
+        if symlink:
+            self._symlinks[path] = symlink
+        elif path in self._symlinks:
+            del self._symlinks[path]
+
+    def _select(self, rows):
+        """keep only rows (a sequence of sorted row numbers)"""
+        self._paths = list(_gather(self._paths, rows))
+        for attr in ('_mod', '_uid', '_gid', '_size', '_mtime'):
+            column = getattr(self, attr)
+            setattr(self, attr, array(column.typecode, _gather(column, rows)))
+
+        if self._symlinks:
+            symlinks = self._symlinks
+            self._symlinks = dict((path, symlinks[path])
+                                  for path in self._paths if path in symlinks)
+
+    def _sort(self):
+        if self._sorted:
+            return
+
+        paths = self._paths
+        rows = sorted(xrange(len(paths)), key=paths.__getitem__)
+
+        # paths added more than once (e.g., nested includes): last one wins
+        sorted_paths = _gather(paths, rows)
+        if any(imap(eq, sorted_paths, islice(sorted_paths, 1, None))):
+            rows = [ row for i, row in enumerate(rows)
+                     if i + 1 == len(rows) or
+                        sorted_paths[i] != sorted_paths[i + 1] ]
+
+        del sorted_paths
+        self._select(rows)
+        self._sorted = True
+
+    def _find(self, path):
+        self._sort()
+
+        paths = self._paths
+        i = bisect_left(paths, path)
+        if i < len(paths) and paths[i] == path:
+            return i
+
+        return None
+
+    def _record(self, i):
+        path = self._paths[i]
+        return DirIndex.Record(path, self._mod[i], self._uid[i], self._gid[i],
+                               int(self._size[i]), int(self._mtime[i]),
+                               self._symlinks.get(path))
+
+    def __len__(self):
+        self._sort()
+        return len(self._paths)
+
+    def __iter__(self):
+        self._sort()
+        return iter(self._paths)
+
+    def keys(self):
+        self._sort()
+        return self._paths[:]
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def __getitem__(self, path):
+        i = self._find(path)
+        if i is None:
+            raise KeyError(path)
+
+        return self._record(i)
+
+    def __setitem__(self, path, rec):
+        self._append(path, rec.mod, rec.uid, rec.gid, rec.size, rec.mtime, rec.symlink)
+
+    def records(self):
+        """yield Records sorted by path"""
+        self._sort()
+        for i in xrange(len(self._paths)):
+            yield self._record(i)
+
+    def add_path(self, path):
+        """add a single path to the DirIndex"""
+        self[path] = DirIndex.Record.frompath(path)
+
+    def remove(self, *paths):
+        """remove paths and everything under them from the index"""
+        self._sort()
 
-                    self.add_path(path)
+        keep = [ True ] * len(self._paths)
+        for path in paths:
+            i = self._find(path)
+            if i is not None:
+                keep[i] = False
+
+            # everything under path sorts between path + '/' and path + '0'
+            prefix = path.rstrip('/')
+            lo = bisect_left(self._paths, prefix + '/')
+            hi = bisect_left(self._paths, prefix + '0')
+            keep[lo:hi] = [ False ] * (hi - lo)
+
+        if all(keep):
+            return
+
+        self._select(list(compress(xrange(len(keep)), keep)))
+
+    def walk(self, *paths, **kws):
+        """walk paths and add files to index.
+        Accepts a readdir_cache=ReaddirCache() keyword argument"""
+        readdir_cache = kws.get('readdir_cache')
+        for path, st, symlink in DirWalker(paths, self.WALK_THREADS,
+                                           cache=readdir_cache):
+            self._append(path,
+                         st.st_mode, st.st_uid, st.st_gid,
+                         st.st_size, st.st_mtime,
+                         symlink)
 
     def prune(self, *paths):
         """prune index down to paths that are included AND not excluded"""
+        self._sort()
 
         pathmap = PathMap(paths)
-        for path in self.keys():
-            if not path in pathmap:
-                del self[path]
-
-    def save(self, tofile):
-        fh = file(tofile, "w")
-        paths = self.keys()
-        paths.sort()
-        for path in paths:
-            print >> fh, self[path].fmt()
+        included = map(pathmap.__contains__, self._paths)
+        if all(included):
+            return
+
+        self._select(list(compress(xrange(len(included)), included)))
+
+    def save(self, tofile, text=False):
+        """save index in the binary format, or the text format if text=True
+        (- for stdout)"""
+        fh = sys.stdout if tofile == '-' else file(tofile, "w")
+        if text:
+            for rec in self.records():
+                print >> fh, rec.fmt()
+        else:
+            MappedIndex.write(fh, self.records(), len(self))
 
     def diff(self, other):
-        a = set(self)
-        b = set(other)
+        """compare with a newer index of the same paths.
+        Returns (files_new, files_edited, paths_stat) lists of paths"""
+        self._sort()
+        other._sort()
+
+        a = self
+        b = other
+
+        # rows of b that aren't in a, and rows of the paths in both (in the
+        # same order, because both indexes are sorted)
+        in_a = set(a._paths)
+        in_both = map(in_a.__contains__, b._paths)
+        del in_a
+
+        b_new = compress(xrange(len(b._paths)), imap(not_, in_both))
+        b_rows = list(compress(xrange(len(b._paths)), in_both))
+        del in_both
+
+        in_b = set(b._paths)
+        a_rows = list(compress(xrange(len(a._paths)), imap(in_b.__contains__, a._paths)))
+        del in_b
 
         files_new = []
         paths_stat = []
 
-        for path in (b - a):
-            mod = other[path].mod
+        for j in b_new:
+            mod = b._mod[j]
 
             # ignore Unix sockets
             if stat.S_ISSOCK(mod):
                 continue
 
             if stat.S_ISDIR(mod):
-                paths_stat.append(path)
+                paths_stat.append(b._paths[j])
             else:
-                files_new.append(path)
+                files_new.append(b._paths[j])
 
-        paths_in_both = b & a
-        files_edited = []
-        def attrs_equal(attrs, a, b):
-            for attr in attrs:
-                if getattr(a, attr) != getattr(b, attr):
-                    return False
+        def changed(attr):
+            return map(ne,
+                       _gather(getattr(a, attr), a_rows),
+                       _gather(getattr(b, attr), b_rows))
 
-            return True
+        data_changed = map(or_, changed('_size'), changed('_mtime'))
+        stat_changed = map(or_, map(or_, changed('_mod'), changed('_uid')), changed('_gid'))
 
-        def symlink_equal(a, b):
-            if a.symlink and (a.symlink == b.symlink):
+        def symlink_equal(path):
+            symlink = a._symlinks.get(path)
+            if symlink and (symlink == b._symlinks.get(path)):
                 return True
 
             return False
 
-        for path in paths_in_both:
-            if not attrs_equal(('size', 'mtime'), self[path], other[path]):
-                mod = other[path].mod
+        files_edited = []
+        for i in compress(xrange(len(b_rows)), imap(or_, data_changed, stat_changed)):
+            j = b_rows[i]
+            path = b._paths[j]
+
+            if data_changed[i]:
+                mod = b._mod[j]
                 if not (stat.S_ISDIR(mod) or stat.S_ISSOCK(mod)) \
-                   and not symlink_equal(self[path], other[path]):
+                   and not symlink_equal(path):
                     files_edited.append(path)
                     continue
 
-            if not attrs_equal(('mod', 'uid', 'gid'), self[path], other[path]):
+            if stat_changed[i]:
                 paths_stat.append(path)
 
         return files_new, files_edited, paths_stat
 
+class MappedIndex:
+    """Read-only, memory-mapped view of a binary dirindex.
+
+    The binary format is versioned and consists of fixed-width parts so
+    a lookup doesn't have to parse the whole index (little-endian):
+
+        header      magic, version, record count, string table offset
+        records     fixed-width records, sorted by path
+        strings     string table with the paths and symlink targets
+
+    Records refer to their path and symlink by offset and length into the
+    string table, so the sorted records double as an offset table we can
+    binary search.
+    """
+
+    MAGIC = "TKLBAMDI"
+    VERSION = 1
+
+    HEADER = struct.Struct("<8sIQQ")
+
+    # path offset, path length, symlink offset, symlink length,
+    # mod, uid, gid, size, mtime
+    RECORD = struct.Struct("<QIQIIIIQq")
+    RECORD_PATH = struct.Struct("<QI")
+
+    @classmethod
+    def is_binary(cls, path):
+        return file(path, "rb").read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, fh, records, count):
+        """write count Records, which must be sorted by path"""
+        fh.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, count,
+                                 cls.HEADER.size + count * cls.RECORD.size))
+
+        strings = []
+        offset = 0
+        for rec in records:
+            path_offset = offset
+            strings.append(rec.path)
+            offset += len(rec.path)
+
+            symlink_offset = offset
+            symlink = rec.symlink if rec.symlink else ""
+            if symlink:
+                strings.append(symlink)
+                offset += len(symlink)
+
+            fh.write(cls.RECORD.pack(path_offset, len(rec.path),
+                                     symlink_offset, len(symlink),
+                                     rec.mod, rec.uid, rec.gid,
+                                     int(rec.size), int(rec.mtime)))
+
+        for s in strings:
+            fh.write(s)
+
+        fh.flush()
+
+    def __init__(self, path):
+        fh = file(path, "rb")
+        self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        fh.close()
+
+        if len(self._map) < self.HEADER.size:
+            raise Error("truncated binary index: " + path)
+
+        magic, version, count, strings = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise Error("not a binary index: " + path)
+
+        if version != self.VERSION:
+            raise Error("unsupported binary index version %d: %s" % (version, path))
+
+        if len(self._map) < strings:
+            raise Error("truncated binary index: " + path)
+
+        self._count = count
+        self._strings = strings
+
+    def _offset(self, i):
+        return self.HEADER.size + i * self.RECORD.size
+
+    def _string(self, offset, length):
+        offset += self._strings
+        return self._map[offset:offset + length]
+
+    def _path(self, i):
+        return self._string(*self.RECORD_PATH.unpack_from(self._map, self._offset(i)))
+
+    def _record(self, i):
+        path_offset, path_len, symlink_offset, symlink_len, \
+            mod, uid, gid, size, mtime = self.RECORD.unpack_from(self._map, self._offset(i))
+
+        symlink = self._string(symlink_offset, symlink_len) if symlink_len else None
+        return DirIndex.Record(self._string(path_offset, path_len),
+                               mod, uid, gid, size, mtime, symlink)
+
+    def _find(self, path):
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path(mid) < path:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self._count and self._path(lo) == path:
+            return lo
+
+        return None
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, path):
+        return self._find(path) is not None
+
+    def __getitem__(self, path):
+        i = self._find(path)
+        if i is None:
+            raise KeyError(path)
+
+        return self._record(i)
+
+    def __iter__(self):
+        for i in xrange(self._count):
+            yield self._path(i)
+
+    def records(self):
+        """yield Records sorted by path"""
+        for i in xrange(self._count):
+            yield self._record(i)
+
+def diff_sorted(old, new):
+    """Streaming equivalent of DirIndex.diff() for two iterables of Records
+    that are sorted by path (e.g., DirIndex.iterfile() and a sorted walk).
+
+    Merges both sides in lockstep and yields (op, rec) tuples in path order:
+
+        'o': rec of new is a new or edited file
+        's': rec of new is a new directory or only its stat changed
+        'd': rec of old isn't in new
+    """
+    old = iter(old)
+    new = iter(new)
+
+    a = next(old, None)
+    b = next(new, None)
+
+    while a or b:
+        if b is None or (a is not None and a.path < b.path):
+            yield 'd', a
+            a = next(old, None)
+            continue
+
+        if a is None or b.path < a.path:
+            # ignore Unix sockets
+            if not stat.S_ISSOCK(b.mod):
+                yield ('s' if stat.S_ISDIR(b.mod) else 'o'), b
+
+            b = next(new, None)
+            continue
+
+        if (a.size, a.mtime) != (b.size, b.mtime) and \
+           not (stat.S_ISDIR(b.mod) or stat.S_ISSOCK(b.mod)) and \
+           not (a.symlink and a.symlink == b.symlink):
+            yield 'o', b
+
+        elif (a.mod, a.uid, a.gid) != (b.mod, b.uid, b.gid):
+            yield 's', b
+
+        a = next(old, None)
+        b = next(new, None)
+
 create = DirIndex.create
 
 def read_paths(fh):
@@ -0,0 +1,412 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+import os
+import sys
+import stat
+import errno
+from os.path import *
+
+import time
+import marshal
+import heapq
+import threading
+import Queue
+
+from pathmap import PathMap
+from mounts import Mounts
+from metrics import metrics
+
+def _lstat(path):
+    st = os.lstat(path)
+    symlink = os.readlink(path) if stat.S_ISLNK(st.st_mode) else None
+
+    return path, st, symlink
+
+def _get(queue):
+    # a blocking get() without a timeout can't be interrupted by signals
+    return queue.get(True, 0xffff)
+
+class ReaddirCache:
+    """Directory listings from a previous walk, so we don't need to re-read
+    directories that haven't changed since.
+
+    A listing is only reused if the directory's device, inode, mtime and
+    ctime are all unchanged. Listings of directories that were modified
+    shortly before the cache was created aren't saved, because they may
+    change again without a visible change in mtime.
+
+    A missing, unreadable or outdated cache file is the same as an empty
+    cache (i.e., a full walk).
+
+    A listing is dropped from the loaded cache once the walk reads its
+    directory, and only listings of directories the walk read are saved.
+    So the cache holds about one listing per directory walked, and
+    directories that are no longer walked age out.
+
+    Example usage::
+
+        cache = ReaddirCache("/var/lib/tklbam/readdir-cache")
+        for path, st, symlink in DirWalker(['/etc'], cache=cache):
+            pass
+        cache.save()
+    """
+
+    VERSION = 1
+
+    # timestamp granularity of the least precise filesystem we care about
+    MARGIN = 2
+
+    def __init__(self, path=None):
+        self.path = path
+        self.started = time.time()
+
+        self.cached = self._load(path) if path else {}
+        self.listings = {}
+
+    @classmethod
+    def _load(cls, path):
+        try:
+            version, listings = marshal.load(file(path, "rb"))
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}
+
+        if version != cls.VERSION or not isinstance(listings, dict):
+            return {}
+
+        return listings
+
+    @staticmethod
+    def _key(st):
+        return (st.st_dev, st.st_ino, st.st_mtime, st.st_ctime)
+
+    def get(self, dir, st):
+        """return cached list of names in dir or None if stale"""
+        cached = self.cached.pop(dir, None)
+        if cached and cached[0] == self._key(st):
+            return cached[1]
+
+        return None
+
+    def set(self, dir, st, names):
+        if max(st.st_mtime, st.st_ctime) < self.started - self.MARGIN:
+            self.listings[dir] = (self._key(st), names)
+
+    def save(self, path=None):
+        """save listings set during this walk (atomically)"""
+        if path is None:
+            path = self.path
+
+        path_tmp = path + ".tmp"
+        fh = file(path_tmp, "wb")
+        marshal.dump((self.VERSION, self.listings), fh)
+        fh.close()
+
+        os.rename(path_tmp, path)
+
+class DirWalker:
+    """Walk the includes of a list of paths and yield (path, st, symlink)
+    tuples for every entry that isn't excluded.
+
+    Every entry is lstat()ed exactly once. Directories are read by a pool of
+    threads, so entries are yielded in no particular order, unless sort=True
+    in which case directories are read one at a time and entries are yielded
+    sorted by path. A sorted walk only holds the directories on the current
+    path in memory.
+
+    If a ReaddirCache is passed, directories that haven't changed since
+    the cache was saved aren't listed again. Their known entries are still
+    lstat()ed.
+
+    Mount points under a walked path are yielded but not descended into if
+    they are pseudo filesystems (e.g., proc, tmpfs), network filesystems
+    or bind mounts, or if one_filesystem=True. Including a mount point
+    explicitly opts it back in. A parallel walk hands its threads to the
+    devices it walks in turn, and while several devices are walked none of
+    them gets more than half the threads, so a slow disk doesn't hold up
+    the others.
+
+    Example usage::
+
+        for path, st, symlink in DirWalker(['/etc', '-/etc/.git']):
+            print path, st.st_mode
+    """
+
+    THREADS = 8
+    ONE_FILESYSTEM = False
+
+    def __init__(self, paths, threads=THREADS, sort=False, cache=None,
+                 one_filesystem=None):
+        self.pathmap = PathMap(paths)
+        self.threads = threads
+        self.sort = sort
+        self.cache = cache
+
+        if one_filesystem is None:
+            one_filesystem = self.ONE_FILESYSTEM
+        self.one_filesystem = one_filesystem
+
+        self._mounts = None
+        self._includes = set(self.pathmap.includes)
+
+    def _crosses(self, subdir):
+        """should we descend into a mount point?"""
+        path = subdir[0]
+        if path in self._includes:
+            return True
+
+        if self.one_filesystem:
+            return False
+
+        if self._mounts is None:
+            self._mounts = Mounts()
+
+        mount = self._mounts.get(path)
+        return not (mount and mount.is_virtual())
+
+    @staticmethod
+    def _lstat_names(dir, names, excluded):
+        entries = []
+        subdirs = []
+
+        for name in names:
+            if name in excluded:
+                continue
+
+            path = join(dir, name)
+
+            entry = _lstat(path)
+            entries.append(entry)
+
+            if stat.S_ISDIR(entry[1].st_mode):
+                subdirs.append(entry)
+
+        return entries, subdirs
+
+    def _filter_mounts(self, st, subdirs):
+        dev = st.st_dev
+        if all(subdir[1].st_dev == dev for subdir in subdirs):
+            return subdirs
+
+        return [ subdir for subdir in subdirs
+                 if subdir[1].st_dev == dev or self._crosses(subdir) ]
+
+    def _readdir(self, dir):
+        """dir is a (path, st, symlink) tuple. Returns a list of entries
+        in the directory and a list of the entries that are directories"""
+        path, st = dir[:2]
+        cache = self.cache
+
+        excluded = self.pathmap.excluded_names(path)
+
+        names = cache.get(path, st) if cache else None
+        if names is not None:
+            try:
+                entries, subdirs = self._lstat_names(path, names, excluded)
+                cache.set(path, st, names)
+
+                metrics.count('dirs_cached')
+                metrics.count('files_stat', len(entries))
+                return entries, self._filter_mounts(st, subdirs)
+            except OSError, e:
+                # directory changed since we lstat()ed it
+                if e.errno != errno.ENOENT:
+                    raise
+
+        names = os.listdir(path)
+        if cache:
+            cache.set(path, st, names)
+
+        entries, subdirs = self._lstat_names(path, names, excluded)
+
+        metrics.count('dirs_read')
+        metrics.count('files_stat', len(entries))
+
+        return entries, self._filter_mounts(st, subdirs)
+
+    def _walk_serial(self, dirs):
+        dirs = list(dirs)
+        while dirs:
+            entries, subdirs = self._readdir(dirs.pop())
+            dirs += subdirs
+
+            for entry in entries:
+                yield entry
+
+    def _walk_parallel(self, dirs):
+        # a fixed pool of threads reads the directories of all devices
+        todo = Queue.Queue()
+        done = Queue.Queue()
+
+        def worker():
+            while True:
+                dir = todo.get()
+                if dir is None:
+                    return
+
+                try:
+                    done.put((dir, self._readdir(dir), None))
+                except:
+                    done.put((dir, None, sys.exc_info()))
+
+        workers = [ threading.Thread(target=worker)
+                    for i in range(self.threads) ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        # directories waiting to be read, and how many are being read, per
+        # active device (i.e., one with directories waiting or being read)
+        waiting = {}
+        reading = {}
+        share = max(1, self.threads / 2)
+
+        def put(dir):
+            dev = dir[1].st_dev
+            waiting.setdefault(dev, []).append(dir)
+            reading.setdefault(dev, 0)
+
+        for dir in dirs:
+            put(dir)
+
+        busy = 0
+        try:
+            while True:
+                # hand free threads to the waiting devices in turn. While
+                # other devices are active, a device gets no more than its
+                # share of the threads, so a slow disk doesn't hold up the
+                # others
+                while busy < self.threads and waiting:
+                    shared = len(reading) > 1
+                    scheduled = False
+
+                    for dev in waiting.keys():
+                        if busy == self.threads:
+                            break
+
+                        if shared and reading[dev] >= share:
+                            continue
+
+                        pending = waiting[dev]
+                        todo.put(pending.pop())
+                        if not pending:
+                            del waiting[dev]
+
+                        reading[dev] += 1
+                        busy += 1
+                        scheduled = True
+
+                    if not scheduled:
+                        break
+
+                if not busy:
+                    break
+
+                dir, result, exc_info = _get(done)
+                busy -= 1
+
+                dev = dir[1].st_dev
+                reading[dev] -= 1
+                if not reading[dev] and dev not in waiting:
+                    del reading[dev]
+
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                entries, subdirs = result
+                for subdir in subdirs:
+                    put(subdir)
+
+                for entry in entries:
+                    yield entry
+
+        finally:
+            # on error don't let the workers finish the walk
+            try:
+                while True:
+                    todo.get_nowait()
+            except Queue.Empty:
+                pass
+
+            for thread in workers:
+                todo.put(None)
+
+            for thread in workers:
+                thread.join()
+
+    def _walk_sorted_root(self, root):
+        def readdir(dir):
+            entries, subdirs = self._readdir(dir)
+
+            # a subtree sorts after its path + '/' which isn't necessarily
+            # right after the directory itself (e.g., a < a.txt < a/b)
+            items = [ (entry[0], False, entry) for entry in entries ]
+            items += [ (subdir[0] + '/', True, subdir) for subdir in subdirs ]
+            items.sort()
+
+            return iter(items)
+
+        entry = _lstat(root)
+        yield root, entry
+
+        if not stat.S_ISDIR(entry[1].st_mode):
+            return
+
+        stack = [ readdir(entry) ]
+        while stack:
+            for path, subtree, entry in stack[-1]:
+                if subtree:
+                    stack.append(readdir(entry))
+                    break
+
+                yield path, entry
+            else:
+                stack.pop()
+
+    def _walk_sorted(self):
+        roots = [ path for path in self.pathmap.includes if lexists(path) ]
+
+        # includes may overlap (e.g., /a -/a/b /a/b/c)
+        last = None
+        for path, entry in heapq.merge(*[ self._walk_sorted_root(root)
+                                          for root in roots ]):
+            if path == last:
+                continue
+
+            last = path
+            yield entry
+
+    def __iter__(self):
+        if self.sort:
+            for entry in self._walk_sorted():
+                yield entry
+            return
+
+        dirs = []
+        for path in self.pathmap.includes:
+            if not lexists(path):
+                continue
+
+            entry = _lstat(path)
+            yield entry
+
+            if stat.S_ISDIR(entry[1].st_mode):
+                dirs.append(entry)
+
+        if not dirs:
+            return
+
+        if self.threads > 1:
+            walk = self._walk_parallel
+        else:
+            walk = self._walk_serial
+
+        for entry in walk(dirs):
+            yield entry
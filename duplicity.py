@@ -17,6 +17,7 @@ from subprocess import *
 from squid import Squid
 
 from utils import AttrDict, iamroot
+from metrics import metrics
 
 import resource
 RLIMIT_NOFILE_MAX = 8192
@@ -150,6 +151,7 @@ class Downloader(AttrDict):
         self.cache_size = cache_size
         self.cache_dir = cache_dir
 
+    @metrics.timed('download')
     def __call__(self, download_path, target, debug=False, log=None, force=False):
         if log is None:
             log = lambda s: None
@@ -219,6 +221,7 @@ class Uploader(AttrDict):
         self.include_filelist = include_filelist
         self.excludes = excludes
 
+    @metrics.timed('upload')
     def __call__(self, source_dir, target, force_cleanup=True, dry_run=False, debug=False, log=None):
         if log is None:
             log = lambda s: None
@@ -5,6 +5,7 @@ import executil
 from registry import registry
 
 from conf import Conf
+from metrics import metrics
 
 class HookError(Exception):
     pass
@@ -20,7 +21,7 @@ def _is_signed(fpath, keyring):
     except:
         return False
 
-def _run_hooks(path, args, keyring=None):
+def _list_hooks(path, keyring=None):
     if not isdir(path):
         return
 
@@ -35,6 +36,10 @@ def _run_hooks(path, args, keyring=None):
         if keyring and not _is_signed(fpath, keyring):
             continue
 
+        yield fpath
+
+def _run_hooks(path, args, keyring=None):
+    for fpath in _list_hooks(path, keyring):
         try:
             executil.system(fpath, *args)
         except executil.ExecError, e:
@@ -68,11 +73,25 @@ class Hooks:
     def __init__(self, name):
         self.name = name
 
-    def _run(self, state):
-
-        _run_hooks(self.LOCAL_HOOKS, (self.name, state))
+    def _paths(self):
+        paths = [ (self.LOCAL_HOOKS, None) ]
         if registry.profile:
-            _run_hooks(join(registry.profile, self.BASENAME), (self.name, state), keyring=self.PROFILE_KEYRING)
+            paths.append((join(registry.profile, self.BASENAME), self.PROFILE_KEYRING))
+
+        return paths
+
+    def exist(self):
+        """are there any hooks to run?"""
+        for path, keyring in self._paths():
+            for fpath in _list_hooks(path, keyring):
+                return True
+
+        return False
+
+    def _run(self, state):
+        with metrics.phase("hooks." + state):
+            for path, keyring in self._paths():
+                _run_hooks(path, (self.name, state), keyring=keyring)
 
     def pre(self):
         self._run("pre")
@@ -0,0 +1,265 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""Timing and resource metrics of the phases of a backup or restore.
+
+Phases are begun and ended by name (or timed with phase() or timed()) and may overlap (e.g., the stages of
+creating the backup extras run in parallel) or nest, even if they have
+the same name. Counters (e.g., files_stat, dirs_read, bytes_staged) are
+process wide. Each phase records how much they grew while it ran.
+
+Memory is process wide too. The peak_rss of a phase is the highest RSS of
+the whole process while the phase ran, which includes the memory of the
+phases running at the same time. It's sampled every SAMPLE_INTERVAL
+seconds, so shorter spikes can be missed. The peak_rss of the run is the
+high water mark of the process. children_peak_rss is the RSS of the
+biggest child process (e.g., duplicity, mysqldump) waited for so far.
+"""
+
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+from utils import fmt_size
+
+PATH_STATUS = "/proc/self/status"
+
+SAMPLE_INTERVAL = 0.5
+
+def _status(field):
+    try:
+        for line in file(PATH_STATUS).readlines():
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    except (EnvironmentError, ValueError, IndexError):
+        pass
+
+    return None
+
+def _peak_rss():
+    peak_rss = _status("VmHWM")
+    if peak_rss is not None:
+        return peak_rss
+
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def _rss():
+    rss = _status("VmRSS")
+    if rss is not None:
+        return rss
+
+    # without /proc the best we have is the high water mark
+    return _peak_rss()
+
+def _children_peak_rss():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+def _fmt_elapsed(seconds):
+    if seconds is None:
+        return "-"
+
+    if seconds < 60:
+        return "%.1fs" % seconds
+
+    return "%dm%02ds" % divmod(int(seconds), 60)
+
+class Phase:
+    def __init__(self, name, start, counters):
+        self.name = name
+        self.thread = threading.current_thread()
+
+        # seconds since metrics started
+        self.start = start
+        self.elapsed = None
+
+        self.peak_rss = None
+        self.children_peak_rss = None
+
+        # how much the counters grew while the phase ran
+        self.counters = {}
+        self.counters_before = counters
+
+    def todict(self):
+        return dict(name=self.name,
+                    start=round(self.start, 3),
+                    elapsed=round(self.elapsed, 3) if self.elapsed is not None else None,
+                    peak_rss=self.peak_rss,
+                    children_peak_rss=self.children_peak_rss,
+                    counters=self.counters)
+
+class Metrics:
+    def __init__(self, command=None):
+        self.command = command
+        self.started = time.time()
+
+        # in the order they began
+        self.phases = []
+        self.active = []
+
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.sampler = None
+
+    def _sample(self):
+        # called with the lock held
+        rss = _rss()
+        for phase in self.active:
+            phase.peak_rss = max(phase.peak_rss, rss)
+
+    def _sampler(self):
+        try:
+            while True:
+                time.sleep(SAMPLE_INTERVAL)
+
+                self.lock.acquire()
+                try:
+                    if not self.active:
+                        self.sampler = None
+                        return
+
+                    self._sample()
+                finally:
+                    self.lock.release()
+        except:
+            # e.g., the interpreter is exiting
+            pass
+
+    def begin(self, name):
+        """begin a phase. Returns it so it can be passed to end()"""
+        self.lock.acquire()
+        try:
+            phase = Phase(name, time.time() - self.started, self.counters.copy())
+            self.phases.append(phase)
+            self.active.append(phase)
+            self._sample()
+
+            if not self.sampler:
+                self.sampler = threading.Thread(target=self._sampler, name="metrics")
+                self.sampler.daemon = True
+                self.sampler.start()
+
+            return phase
+        finally:
+            self.lock.release()
+
+    def _find(self, name):
+        # the phase named name that began last, in this thread if any
+        phases = [ phase for phase in reversed(self.active) if phase.name == name ]
+        for phase in phases:
+            if phase.thread is threading.current_thread():
+                return phase
+
+        if phases:
+            return phases[0]
+
+    def end(self, phase):
+        """end a phase (as returned by begin) or the last phase begun by
+        that name"""
+        self.lock.acquire()
+        try:
+            if not isinstance(phase, Phase):
+                phase = self._find(phase)
+
+            if phase not in self.active:
+                return
+
+            self._sample()
+            self.active.remove(phase)
+
+            phase.elapsed = time.time() - self.started - phase.start
+            phase.children_peak_rss = _children_peak_rss()
+
+            before = phase.counters_before
+            phase.counters = dict([ (counter, val - before.get(counter, 0))
+                                    for counter, val in self.counters.items()
+                                    if val != before.get(counter, 0) ])
+        finally:
+            self.lock.release()
+
+    @contextmanager
+    def phase(self, name):
+        """context manager that times a block as a phase, which ends even
+        if the block raises (e.g., SystemExit from fatal())"""
+        phase = self.begin(name)
+        try:
+            yield phase
+        finally:
+            self.end(phase)
+
+    def timed(self, name):
+        """decorator that times calls of a function as a phase"""
+        def decorator(func):
+            def wrapper(*args, **kws):
+                with self.phase(name):
+                    return func(*args, **kws)
+
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+
+        return decorator
+
+    def count(self, counter, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+        finally:
+            self.lock.release()
+
+    def todict(self, status=None):
+        """phases that didn't end (e.g., because of an error) have no
+        elapsed time"""
+        return dict(command=self.command,
+                    started=self.started,
+                    elapsed=round(time.time() - self.started, 3),
+                    status=status,
+                    rss_sample_interval=SAMPLE_INTERVAL,
+                    peak_rss=_peak_rss(),
+                    children_peak_rss=_children_peak_rss(),
+                    counters=self.counters,
+                    phases=[ phase.todict() for phase in self.phases ])
+
+    def tofile(self, path, status=None):
+        """append a report of the run to path as a line of JSON"""
+
+        # not needed by the low-level modules that count things
+        import simplejson
+
+        fh = file(path, "a")
+        print >> fh, simplejson.dumps(self.todict(status))
+        fh.close()
+
+    def fmt_summary(self):
+        rows = [ ("Phase", "Start", "Elapsed", "Peak RSS", "Counters") ]
+        for phase in self.phases:
+            counters = " ".join([ "%s=%s" % (counter, fmt_size(val) if counter.startswith("bytes_") else val)
+                                  for counter, val in sorted(phase.counters.items()) ])
+
+            rows.append((phase.name,
+                         _fmt_elapsed(phase.start),
+                         _fmt_elapsed(phase.elapsed),
+                         fmt_size(phase.peak_rss) if phase.peak_rss is not None else "-",
+                         counters))
+
+        widths = [ max([ len(row[i]) for row in rows ]) for i in range(4) ]
+        lines = [ "  ".join([ col.ljust(width) for col, width in zip(row, widths) ] + [ row[4] ]).rstrip()
+                  for row in rows ]
+
+        lines.append("\n(Peak RSS: of the whole process while the phase ran, sampled every %ss)" % SAMPLE_INTERVAL)
+
+        return "\n".join(lines)
+
+    def __str__(self):
+        return self.fmt_summary()
+
+# the metrics of this run
+metrics = Metrics()
@@ -0,0 +1,74 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+import re
+
+# filesystems that don't hold data worth backing up
+PSEUDO = ('proc', 'sysfs', 'devtmpfs', 'devpts', 'tmpfs', 'ramfs',
+          'cgroup', 'cgroup2', 'debugfs', 'tracefs', 'securityfs',
+          'pstore', 'bpf', 'mqueue', 'hugetlbfs', 'configfs', 'fusectl',
+          'autofs', 'binfmt_misc', 'rpc_pipefs', 'nsfs', 'efivarfs',
+          'selinuxfs', 'overlay', 'aufs')
+
+# slow or unreliable to walk (and usually backed up elsewhere)
+NETWORK = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'ncpfs', 'afs', '9p',
+           'ceph', 'glusterfs', 'lustre', 'davfs', 'fuse.sshfs', 'fuse.s3fs',
+           'fuse.glusterfs', 'fuse.rclone', 'fuse.gcsfuse', 'fuse.davfs2')
+
+def _unescape(s):
+    # mount points escape space, tab, newline and backslash as octal
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), s)
+
+class Mount:
+    def __init__(self, path, fstype, source, root='/'):
+        self.path = path
+        self.fstype = fstype
+        self.source = source
+
+        # root of the mount inside its filesystem ('/' unless a bind mount)
+        self.root = root
+
+    def is_virtual(self):
+        """pseudo, network or bind mount of a subdirectory"""
+        return self.fstype in PSEUDO or self.fstype in NETWORK or self.root != '/'
+
+    def __repr__(self):
+        return "Mount(%s, %s, %s, root=%s)" % (`self.path`, `self.fstype`,
+                                               `self.source`, `self.root`)
+
+class Mounts(dict):
+    """Mount table (mount point -> Mount) from /proc/self/mountinfo.
+
+    If a mount point is mounted over, the last mount wins. On systems
+    without /proc the table is empty.
+    """
+
+    MOUNTINFO = "/proc/self/mountinfo"
+
+    def __init__(self, mountinfo=MOUNTINFO):
+        try:
+            lines = file(mountinfo).readlines()
+        except IOError:
+            return
+
+        for line in lines:
+            # id parent major:minor root mount-point options [optional...] - fstype source superopts
+            fields = line.split()
+            try:
+                sep = fields.index('-')
+            except ValueError:
+                continue
+
+            if sep < 5 or len(fields) < sep + 3:
+                continue
+
+            path = _unescape(fields[4])
+            self[path] = Mount(path, fields[sep + 1], _unescape(fields[sep + 2]),
+                               _unescape(fields[3]))
@@ -17,6 +17,10 @@ import signal
 import time
 
 import re
+import gzip
+import errno
+import commands
+import threading
 from paths import Paths as _Paths
 
 import shutil
@@ -32,8 +36,15 @@ from command import Command
 class Error(Exception):
     pass
 
+class LockError(Error):
+    pass
+
 PATH_DEBIAN_CNF = "/etc/mysql/debian.cnf"
 
+# rows are compressed as they're written (trading ratio for speed), if at all
+COMPRESSLEVEL = 1
+GZIP_MAGIC = '\x1f\x8b'
+
 def _mysql_opts(opts=[], defaults_file=None, **conf):
     def isreadable(path):
         try:
@@ -54,19 +65,125 @@ def _mysql_opts(opts=[], defaults_file=None, **conf):
 
     return " ".join([ "--" + opt for opt in opts ])
 
-def mysqldump(**conf):
-    opts = [ "all-databases", "skip-extended-insert", "single-transaction",
-             "compact", "quick" ]
+# not dumped by mysqldump --all-databases
+SYSTEM_DATABASES = ('information_schema', 'performance_schema', 'sys')
 
-    command = "mysqldump " + _mysql_opts(opts, **conf)
-    popen = Popen(command, shell=True, stderr=PIPE, stdout=PIPE)
+def _mysqldump(databases=None, ignore_tables=[], no_data=False, **conf):
+    opts = [ "skip-extended-insert", "single-transaction", "compact", "quick" ]
+    if databases is None:
+        opts.insert(0, "all-databases")
+    else:
+        opts.insert(0, "databases")
+
+    if no_data:
+        opts.append("no-data")
 
+    command = "mysqldump " + _mysql_opts(opts, **conf)
+    command += "".join([ commands.mkarg("--ignore-table=%s.%s" % (database, table))
+                         for database, table in ignore_tables ])
+    if databases:
+        command += "".join([ commands.mkarg(database) for database in databases ])
+
+    # parallel sessions mustn't inherit each other's pipes (e.g., to gzip),
+    # or those won't see EOF until this mysqldump exits
+    popen = Popen(command, shell=True, stderr=PIPE, stdout=PIPE, close_fds=True)
+
+    # with --compact there's no header, so the first line (the blank line
+    # before the first CREATE DATABASE) is only written after mysqldump
+    # started its transaction (--single-transaction). Once we've read it
+    # the snapshot is taken, which mysql2fs_parallel relies on
     firstline = popen.stdout.readline()
     if not firstline:
         returncode = popen.wait()
         raise Error("mysqldump error (%d): %s" % (returncode, popen.stderr.read()))
 
-    return popen.stdout
+    return popen
+
+def mysqldump(**conf):
+    return _mysqldump(**conf).stdout
+
+def list_databases(**conf):
+    command = "mysql " + _mysql_opts([ "batch", "skip-column-names" ], **conf)
+    command += " --execute='SHOW DATABASES'"
+
+    popen = Popen(command, shell=True, stderr=PIPE, stdout=PIPE)
+    output = popen.stdout.read()
+    returncode = popen.wait()
+    if returncode != 0:
+        raise Error("mysql error (%d): %s" % (returncode, popen.stderr.read()))
+
+    return output.splitlines()
+
+class ReadLock:
+    """A global read lock (FLUSH TABLES WITH READ LOCK) held by a mysql
+    session. Writes are blocked while it's held, so the InnoDB snapshots
+    of transactions started meanwhile (e.g., by mysqldump
+    --single-transaction) are consistent with each other.
+
+    Writes are also blocked while we wait for the lock, until queries
+    that are running finish. So we don't try if a query has been running
+    for more than long_query_guard seconds, and give up after
+    lock_wait_timeout seconds. Raises LockError if we don't get the lock."""
+
+    MARKER = "-- tklbam --"
+
+    LOCK_WAIT_TIMEOUT = 10
+    LONG_QUERY_GUARD = 60
+
+    def __init__(self, lock_wait_timeout=LOCK_WAIT_TIMEOUT, long_query_guard=LONG_QUERY_GUARD,
+                 **conf):
+        command = "mysql " + _mysql_opts([ "batch", "skip-column-names", "unbuffered" ], **conf)
+        self.popen = Popen(command, shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+        try:
+            long_queries = self.query("SELECT COUNT(*) FROM information_schema.processlist "
+                                      "WHERE command NOT IN ('Sleep', 'Binlog Dump') "
+                                      "AND time > %d AND id != CONNECTION_ID()" % long_query_guard)
+            if int(long_queries[0][0]):
+                raise LockError("%s queries running for more than %d seconds" %
+                                (long_queries[0][0], long_query_guard))
+
+            self.query("SET SESSION lock_wait_timeout = %d" % lock_wait_timeout)
+            self.query("FLUSH TABLES WITH READ LOCK")
+
+        except Error, e:
+            self.release()
+            raise LockError("can't lock tables: " + str(e))
+
+    def query(self, sql):
+        """run sql in the locked session. Returns the rows of output as
+        lists of columns"""
+        try:
+            self.popen.stdin.write("%s;\nSELECT '%s';\n" % (sql, self.MARKER))
+            self.popen.stdin.flush()
+        except IOError:
+            # mysql exited (e.g., access denied). We report why below
+            pass
+
+        rows = []
+        while True:
+            line = self.popen.stdout.readline()
+            if not line:
+                returncode = self.popen.wait()
+                raise Error("mysql error (%d): %s" % (returncode, self.popen.stderr.read()))
+
+            line = line.rstrip("\n")
+            if line == self.MARKER:
+                return rows
+
+            rows.append(line.split("\t"))
+
+    def release(self):
+        if self.popen.returncode is not None:
+            return
+
+        try:
+            self.popen.stdin.write("UNLOCK TABLES;\n")
+            self.popen.stdin.close()
+        except IOError:
+            pass
+
+        self.popen.wait()
 
 def mysql(**conf):
     command = "mysql " + _mysql_opts(**conf)
@@ -92,25 +209,93 @@ class MyFS:
         class Paths(_Paths):
             files = [ 'pre', 'post' ]
 
+class _GzipPipe:
+    """Write to path through gzip --rsyncable. A changed row only changes
+    the compressed output up to the next point gzip syncs on, so the
+    rsync deltas Duplicity uploads for an incremental backup stay small"""
+
+    def __init__(self, path):
+        self.fh = file(path, "w")
+        self.popen = Popen(["gzip", "--rsyncable", "-%d" % COMPRESSLEVEL],
+                           stdin=PIPE, stdout=self.fh, stderr=PIPE, close_fds=True)
+
+    def write(self, s):
+        try:
+            self.popen.stdin.write(s)
+        except IOError:
+            # gzip exited. We report why below
+            self.close()
+            raise
+
+    def close(self):
+        if self.popen.returncode is not None:
+            return
+
+        try:
+            self.popen.stdin.close()
+        except IOError:
+            pass
+
+        error = self.popen.stderr.read()
+        self.fh.close()
+
+        if self.popen.wait() != 0:
+            raise Error("gzip failed: %s" % error.strip())
+
+def _open(path):
+    """open a MyFS file for reading, uncompressing it if it's compressed"""
+    fh = file(path)
+    if fh.read(len(GZIP_MAGIC)) == GZIP_MAGIC:
+        fh.close()
+        return gzip.open(path)
+
+    fh.seek(0)
+    return fh
+
+RE_NAME = re.compile(r'`(.*?)`')
+RE_VIEW = re.compile(r'^/\*!50001 CREATE.* VIEW `(.*?)`', re.DOTALL)
+RE_VIEW_PRE = re.compile(r'^/\*!50001 CREATE TABLE')
+RE_TRIGGER = re.compile(r'^/\*!50003 CREATE.* TRIGGER ', re.DOTALL)
+RE_ROW = re.compile(r'.*?VALUES \((.*)\);')
+
 def _match_name(sql):
-    m = re.search(r'`(.*?)`', sql)
+    m = RE_NAME.search(sql)
     if m:
         return m.group(1)
     
 def _parse_statements(fh, delimiter=';'):
-    statement = ""
+    # lines of the statement so far. Most statements (e.g., a row with
+    # --skip-extended-insert) are a single line, so we only join lines
+    # for the rest
+    lines = []
     for line in fh.xreadlines():
         if line.startswith("--"):
             continue
-        if not line.strip():
+        stripped = line.rstrip()
+        if not stripped:
             continue
         if line.startswith("DELIMITER"):
             delimiter = line.split()[1]
             continue
-        statement += line
-        if statement.strip().endswith(delimiter):
-            yield statement.strip()
-            statement = ""
+
+        if not stripped.endswith(delimiter):
+            lines.append(line)
+            continue
+
+        if lines:
+            lines.append(stripped)
+            yield "".join(lines).strip()
+            lines = []
+        else:
+            yield stripped.lstrip()
+
+def _makedirs(path):
+    # parallel writers may create the same directories
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
 
 class MyFS_Writer(MyFS):
     class Database(MyFS.Database):
@@ -118,13 +303,13 @@ class MyFS_Writer(MyFS):
             def __init__(self, views_path, name):
                 paths = self.Paths(join(views_path, name))
                 if not exists(paths):
-                    os.makedirs(paths)
+                    _makedirs(paths)
                 self.paths = paths
 
         def __init__(self, outdir, name, sql):
             self.paths = self.Paths(join(outdir, name))
             if not exists(self.paths):
-                os.mkdir(self.paths)
+                _makedirs(self.paths)
 
             print >> file(self.paths.init, "w"), sql
             self.name = name
@@ -138,35 +323,113 @@ class MyFS_Writer(MyFS):
             print >> file(view.paths.post, "w"), sql
 
     class Table(MyFS.Table):
-        def __init__(self, database, name, sql):
+        # rows are written in chunks of about this many bytes
+        BUFSIZE = 1024 * 1024
+
+        def __init__(self, database, name, sql, compress=False):
             self.paths = self.Paths(join(database.paths.tables, name))
             if not exists(self.paths):
-                os.makedirs(self.paths)
+                _makedirs(self.paths)
 
             print >> file(self.paths.init, "w"), sql
             if exists(self.paths.triggers):
                 os.remove(self.paths.triggers)
 
-            self.rows_fh = file(self.paths.rows, "w")
+            if compress:
+                self.rows_fh = _GzipPipe(self.paths.rows)
+            else:
+                self.rows_fh = file(self.paths.rows, "w")
             self.name = name
             self.database = database
 
+            self.insert_prefix = "INSERT INTO `%s` VALUES (" % name
+
+            # we can slice the values out of a row instead of matching RE_ROW
+            # unless the earliest 'VALUES (' in it could be in the name
+            self._slice_rows = "VALUES (" not in name
+
+            self._rows = []
+            self._rows_size = 0
+
+        def _flush(self):
+            if self._rows:
+                self._rows.append("")
+                self.rows_fh.write("\n".join(self._rows))
+
+            self._rows = []
+            self._rows_size = 0
+
         def add_row(self, sql):
-            print >> self.rows_fh, re.sub(r'.*?VALUES \((.*)\);', '\\1', sql)
+            if self._slice_rows and sql.startswith(self.insert_prefix) and \
+               sql.endswith(");") and "\n" not in sql:
+                row = sql[len(self.insert_prefix):-2]
+            else:
+                row = RE_ROW.sub('\\1', sql)
+
+            self._rows.append(row)
+            self._rows_size += len(row) + 1
+            if self._rows_size >= self.BUFSIZE:
+                self._flush()
+
+        def close(self):
+            self._flush()
+            self.rows_fh.close()
 
         def add_trigger(self, sql):
             print >> file(self.paths.triggers, "a"), sql + "\n"
 
-    def __init__(self, outdir, limits=[]):
+    def __init__(self, outdir, limits=[], compress=False):
+        """If compress is True, table rows (usually the bulk of a database)
+        are compressed as they're written"""
         self.limits = DBLimits(limits)
         self.outdir = outdir
+        self.compress = compress
+
+    def fromfile(self, fh, callback=None, checkpoint=None):
+        """Write the databases in a mysqldump to the output directory.
+
+        If checkpoint is passed, it's called with the name of each database
+        as soon as it's been written completely (i.e., the dump moved on to
+        another database and none of its views are pending). The last
+        database is only complete once the dump is, so that's up to the
+        caller. Returns the names of the databases written."""
 
-    def fromfile(self, fh, callback=None):
         databases = {}
         database = None
         table = None
 
+        # views are created after all the tables, in a second pass
+        views_pending = {}
+        finished = set()
+
+        def finish(database):
+            if checkpoint is None or database.name in finished:
+                return
+
+            if views_pending.get(database.name):
+                return
+
+            finished.add(database.name)
+            checkpoint(database.name)
+
         for statement in _parse_statements(fh):
+            # most statements are rows, so we handle them first
+            if statement.startswith("INSERT INTO"):
+                if database and table and not table_ignore_inserts:
+                    assert statement.startswith(table.insert_prefix) or \
+                           _match_name(statement) == table.name
+                    table.add_row(statement)
+
+                continue
+
+            if statement.startswith("CREATE DATABASE") or statement.startswith("USE "):
+                if database and database.name != _match_name(statement):
+                    if table:
+                        table.close()
+                        table = None
+
+                    finish(database)
+
             if statement.startswith("CREATE DATABASE"):
                 database_name = _match_name(statement)
 
@@ -186,24 +449,32 @@ class MyFS_Writer(MyFS):
                 if not database:
                     continue
 
+                if table:
+                    table.close()
                 table = None
 
             if not database:
                 continue
 
-            m = re.match(r'^/\*!50001 CREATE.* VIEW `(.*?)`', statement, re.DOTALL)
+            m = RE_VIEW.match(statement)
             if m:
                 view_name = m.group(1)
                 database.add_view_post(view_name, statement)
+                views_pending[database.name] = views_pending.get(database.name, 0) - 1
 
-            elif re.match(r'^/\*!50001 CREATE TABLE', statement):
+            elif RE_VIEW_PRE.match(statement):
                 view_name = _match_name(statement)
                 database.add_view_pre(view_name, statement)
+                views_pending[database.name] = views_pending.get(database.name, 0) + 1
 
             elif statement.startswith("CREATE TABLE"):
                 table_name = _match_name(statement)
 
-                table = self.Table(database, table_name, statement)
+                # compressed rows aren't complete until they're closed
+                if table:
+                    table.close()
+
+                table = self.Table(database, table_name, statement, self.compress)
                 if (database.name, table_name) in self.limits:
                     if callback:
                         callback(table)
@@ -215,12 +486,13 @@ class MyFS_Writer(MyFS):
             if not table:
                 continue
 
-            if re.match(r'^/\*!50003 CREATE.* TRIGGER ', statement, re.DOTALL):
+            if RE_TRIGGER.match(statement):
                 table.add_trigger(statement)
 
-            elif not table_ignore_inserts and statement.startswith("INSERT INTO"):
-                assert _match_name(statement) == table.name
-                table.add_row(statement)
+        if table:
+            table.close()
+
+        return databases.keys()
 
 def mysql2fs(fh, outdir, limits=[], callback=None):
     MyFS_Writer(outdir, limits).fromfile(fh, callback)
@@ -399,12 +671,13 @@ DELIMITER ;
             return "Table(%s)" % `self.paths.path`
 
         def rows(self):
-            for line in file(self.paths.rows).xreadlines():
+            for line in _open(self.paths.rows):
                 yield line.strip()
 
         def has_rows(self):
             if exists(self.paths.rows) and os.lstat(self.paths.rows).st_size != 0:
-                return True
+                # a compressed file is never empty
+                return _open(self.paths.rows).read(1) != ""
             return False
 
         rows = property(rows)
@@ -537,12 +810,150 @@ def cb_print(fh=None):
 
     return func
 
-def backup(myfs, etc, **kws):
+def mysql2fs_parallel(outdir, parallel, limits=[], databases=None, callback=None, compress=False, **conf):
+    """Like mysql2fs, with parallel mysqldump sessions that dump different
+    tables straight into outdir. The tables in limits are balanced between
+    them by size. Another session dumps everything else each database
+    has (e.g., views, the schema of tables not in limits).
+
+    The sessions start their transactions while we hold a global read
+    lock, so they dump the same consistent snapshot. Raises LockError
+    (before anything is dumped) if we can't get the lock.
+
+    conf holds mysql options (e.g., user, password, defaults_file).
+
+    Dumps the databases (default: all) that are in limits. Returns the
+    names of the databases written."""
+
+    dblimits = DBLimits(limits)
+
+    lock = ReadLock(**conf)
+    popens = []
+    try:
+        if databases is None:
+            databases = [ row[0] for row in lock.query("SHOW DATABASES")
+                          if row[0] not in SYSTEM_DATABASES ]
+
+        databases = [ database for database in databases if database in dblimits ]
+        if not databases:
+            return []
+
+        tables = dict([ (database, []) for database in databases ])
+        for database, table, table_type, size in lock.query("SELECT table_schema, table_name, table_type, "
+                                                            "COALESCE(data_length + index_length, 0) "
+                                                            "FROM information_schema.tables"):
+            if database in tables:
+                tables[database].append((table, table_type, int(size)))
+
+        # biggest tables first, each to the session with the least to dump
+        data = [ (size, database, table)
+                 for database in databases
+                 for table, table_type, size in tables[database]
+                 if table_type != 'VIEW' and (database, table) in dblimits ]
+        data.sort(reverse=True)
+
+        jobs = [ set() for i in range(parallel) ]
+        loads = [ 0 ] * parallel
+        for size, database, table in data:
+            i = loads.index(min(loads))
+            jobs[i].add((database, table))
+            loads[i] += size
+
+        for job in jobs:
+            if not job:
+                continue
+
+            job_databases = sorted(set([ database for database, table in job ]))
+            ignore_tables = [ (database, table)
+                              for database in job_databases
+                              for table, table_type, size in tables[database]
+                              if (database, table) not in job ]
+
+            popens.append(_mysqldump(job_databases, ignore_tables, **conf))
+
+        popens.append(_mysqldump(databases, [ (database, table) for size, database, table in data ],
+                                 no_data=True, **conf))
+
+    except:
+        for popen in popens:
+            popen.stdout.close()
+            popen.wait()
+        raise
+
+    finally:
+        # _mysqldump() returns once a session has written its first line.
+        # Without a header (--compact) that's only after it started its
+        # transaction, so every snapshot is taken before writes resume.
+        # Don't drop --compact without syncing some other way
+        lock.release()
+
+    # each session dumps every database it has tables in, but we report
+    # each database once
+    progress = None
+    if callback:
+        progress_lock = threading.Lock()
+        reported = set()
+
+        def progress(val):
+            progress_lock.acquire()
+            try:
+                if isinstance(val, MyFS.Database):
+                    if val.name in reported:
+                        return
+                    reported.add(val.name)
+
+                callback(val)
+            finally:
+                progress_lock.release()
+
+    written = set()
+    errors = []
+
+    def write(popen):
+        try:
+            written.update(MyFS_Writer(outdir, limits, compress).fromfile(popen.stdout, progress))
+        except Exception, e:
+            errors.append(e)
+
+            # so mysqldump doesn't block writing to us
+            popen.stdout.close()
+
+    threads = [ threading.Thread(target=write, args=(popen,)) for popen in popens ]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    for popen in popens:
+        returncode = popen.wait()
+        if returncode != 0 and not errors:
+            errors.append(Error("mysqldump error (%d): %s" % (returncode, popen.stderr.read())))
+
+    if errors:
+        raise errors[0]
+
+    return list(written)
+
+def backup(myfs, etc, limits=[], callback=None, checkpoints=None, compress=False, parallel=1):
     """High level mysql backup command.
     Arguments:
 
         <myfs>      Directory we create to save MySQL backup
         <etc>       Directory where we save required MySQL etc configuration files (e.g., debian.cnf)
+
+        <checkpoints>   Optional checkpoints (e.g., backup.Checkpoints) of
+                        the databases a previous (aborted) backup saved to
+                        myfs. These are kept and only the other databases
+                        are dumped. Databases are added as they're saved.
+
+        <compress>      Compress table rows (with gzip --rsyncable) as
+                        they're dumped, so myfs takes less disk space
+
+        <parallel>      Number of mysqldump sessions that dump tables in
+                        parallel (see mysql2fs_parallel). If we can't get
+                        the read lock they need, a single session dumps
+                        everything instead
         """
 
     if not MysqlService.is_running():
@@ -553,12 +964,47 @@ def backup(myfs, etc, **kws):
         mna = MysqlNoAuth()
 
     try:
-        mysqldump_fh = mysqldump()
+        # None dumps all databases
+        databases = None
+
+        if checkpoints is not None and exists(myfs):
+            # discard databases we didn't finish saving
+            for name in os.listdir(myfs):
+                if name not in checkpoints:
+                    shutil.rmtree(join(myfs, name))
+
+            if os.listdir(myfs):
+                dblimits = DBLimits(limits)
+                databases = [ name for name in list_databases()
+                              if name in dblimits and name not in checkpoints
+                              and name not in SYSTEM_DATABASES ]
 
         if not exists(myfs):
             os.mkdir(myfs)
 
-        mysql2fs(mysqldump_fh, myfs, **kws)
+        if databases != []:
+            written = None
+            if parallel > 1:
+                # databases are only complete when all the sessions are done
+                try:
+                    written = mysql2fs_parallel(myfs, parallel, limits, databases, callback, compress)
+                except LockError, e:
+                    print >> sys.stderr, "warning: %s, dumping MySQL with a single session" % e
+
+            if written is None:
+                popen = _mysqldump(databases)
+
+                written = MyFS_Writer(myfs, limits, compress).fromfile(popen.stdout, callback,
+                                                             checkpoints.add if checkpoints is not None else None)
+
+                returncode = popen.wait()
+                if returncode != 0:
+                    raise Error("mysqldump error (%d): %s" % (returncode, popen.stderr.read()))
+
+            if checkpoints is not None:
+                for name in written:
+                    if name not in checkpoints:
+                        checkpoints.add(name)
 
         if not exists(etc):
             os.mkdir(etc)
@@ -0,0 +1,388 @@
+#
+# Copyright (c) 2010-2013 Liraz Siri <liraz@turnkeylinux.org>
+#
+# This file is part of TKLBAM (TurnKey GNU/Linux BAckup and Migration).
+#
+# TKLBAM is open source software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 3 of
+# the License, or (at your option) any later version.
+#
+"""Apply an overlay of files (e.g., extracted from a backup) to a
+destination, remapping ownership as each file is written.
+
+If the overlay is disposable its files can be moved into place with
+rename() instead of copied, which only falls back to copying across
+filesystems. Like tar, files that are hard links of each other in the
+overlay are hard links of each other in the destination.
+
+Paths are applied by a pool of threads. File data is copied in the kernel
+with copy_file_range() or sendfile() where available."""
+
+import os
+import sys
+import stat
+import errno
+from os.path import *
+
+import threading
+import Queue
+
+import ctypes
+import ctypes.util
+
+from dirwalk import _get
+
+class Error(Exception):
+    pass
+
+BUFSIZE = 1024 * 1024
+
+# largest chunk we ask the kernel to copy at once
+CHUNK = 64 * 1024 * 1024
+
+THREADS = 8
+BATCH = 64
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+def _libc_func(name, restype, argtypes):
+    func = getattr(_libc, name, None) if _libc else None
+    if func is None:
+        return None
+
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+# ssize_t copy_file_range(int fd_in, loff_t *off_in, int fd_out, loff_t *off_out, size_t len, unsigned flags)
+_copy_file_range = _libc_func('copy_file_range', ctypes.c_ssize_t,
+                              [ ctypes.c_int, ctypes.c_void_p,
+                                ctypes.c_int, ctypes.c_void_p,
+                                ctypes.c_size_t, ctypes.c_uint ])
+
+# ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count)
+_sendfile = _libc_func('sendfile', ctypes.c_ssize_t,
+                       [ ctypes.c_int, ctypes.c_int,
+                         ctypes.c_void_p, ctypes.c_size_t ])
+
+def _kernel_copy(fd_in, fd_out, size):
+    """copy up to size bytes from the current offset of fd_in without
+    passing the data through userspace. Returns the number of bytes copied,
+    which is less than size if the kernel can't do it (e.g., it's too old
+    or the filesystems don't support it) or the file shrank"""
+    copied = 0
+    for call in (_copy_file_range, _sendfile):
+        if call is None:
+            continue
+
+        while copied < size:
+            count = min(size - copied, CHUNK)
+            if call is _copy_file_range:
+                n = call(fd_in, None, fd_out, None, count, 0)
+            else:
+                n = call(fd_out, fd_in, None, count)
+
+            if n < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+
+                # try the next way
+                if err in (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                           errno.EOPNOTSUPP, errno.EBADF):
+                    break
+
+                raise OSError(err, os.strerror(err))
+
+            if n == 0:
+                return copied
+
+            copied += n
+
+        if copied >= size:
+            break
+
+    return copied
+
+def _unlink(path):
+    # like tar, replace files and empty directories but nothing else
+    try:
+        os.unlink(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return
+
+        if e.errno not in (errno.EISDIR, errno.EPERM):
+            raise
+
+        os.rmdir(path)
+
+def _copy_data(src, fd):
+    """copy the data of src to fd. Returns the number of bytes copied"""
+    fd_src = os.open(src, os.O_RDONLY)
+    try:
+        copied = _kernel_copy(fd_src, fd, os.fstat(fd_src).st_size)
+
+        # whatever the kernel didn't copy (or the file grew)
+        while True:
+            buf = os.read(fd_src, BUFSIZE)
+            if not buf:
+                break
+
+            while buf:
+                n = os.write(fd, buf)
+                copied += n
+                buf = buf[n:]
+
+        return copied
+
+    finally:
+        os.close(fd_src)
+
+def _makedirs(path):
+    # like os.makedirs(), but other threads may be creating the same path
+    if isdir(path):
+        return
+
+    _makedirs(dirname(path))
+    try:
+        os.mkdir(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def _rename(src, dst):
+    try:
+        os.rename(src, dst)
+    except OSError, e:
+        # rename() can replace a file, but not a directory
+        if e.errno not in (errno.EISDIR, errno.ENOTEMPTY, errno.EEXIST):
+            raise
+
+        _unlink(dst)
+        os.rename(src, dst)
+
+class _Links:
+    """Where we installed the first of several hard links to an inode, so
+    the others are linked to it instead of copied. Threads that install
+    other links to the inode wait until the first is installed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first = {}
+
+    def claim(self, st, dst):
+        """Returns the path of the first link to st's inode. If that's dst,
+        the caller must install it and then call done(). Otherwise the
+        first link has been installed (or None if that failed)"""
+        key = (st.st_dev, st.st_ino)
+
+        self.lock.acquire()
+        try:
+            first = self.first.get(key)
+            if first is None:
+                self.first[key] = [ dst, threading.Event() ]
+                return dst
+        finally:
+            self.lock.release()
+
+        path, installed = first
+
+        # a wait() without a timeout can't be interrupted by signals
+        while not installed.is_set():
+            installed.wait(0xffff)
+
+        return path
+
+    def done(self, st, ok):
+        first = self.first[(st.st_dev, st.st_ino)]
+        if not ok:
+            first[0] = None
+        first[1].set()
+
+def _link(src, dst):
+    """hard link dst to src. Returns False if we can't"""
+    _unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOENT):
+            raise
+        return False
+
+    return True
+
+def _install(src, dst, uidmap, gidmap, move=False, links=None):
+    """install src at dst. Returns the number of bytes copied"""
+    st = os.lstat(src)
+    mode = st.st_mode
+
+    uid = uidmap.get(st.st_uid, st.st_uid)
+    gid = gidmap.get(st.st_gid, st.st_gid)
+
+    # moved hard links are still hard links of each other
+    if move and not stat.S_ISDIR(mode):
+        try:
+            _rename(src, dst)
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+        else:
+            if (uid, gid) != (st.st_uid, st.st_gid):
+                os.lchown(dst, uid, gid)
+
+                # chown cleared setuid/setgid bits
+                if not stat.S_ISLNK(mode) and mode & (stat.S_ISUID | stat.S_ISGID):
+                    os.chmod(dst, stat.S_IMODE(mode))
+            return 0
+
+    # copied hard links are linked to the first one we copy
+    if links and st.st_nlink > 1 and not stat.S_ISDIR(mode):
+        first = links.claim(st, dst)
+        if first == dst:
+            ok = False
+            try:
+                copied = _install(src, dst, uidmap, gidmap)
+                ok = True
+            finally:
+                links.done(st, ok)
+
+            return copied
+
+        if first and _link(first, dst):
+            return 0
+
+    copied = 0
+    if stat.S_ISDIR(mode):
+        if islink(dst) or not isdir(dst):
+            _unlink(dst)
+            os.mkdir(dst, 0700)
+
+        for name in os.listdir(src):
+            copied += _install(join(src, name), join(dst, name), uidmap, gidmap, move, links)
+
+    else:
+        _unlink(dst)
+
+        if stat.S_ISREG(mode):
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            try:
+                copied = _copy_data(src, fd)
+            finally:
+                os.close(fd)
+
+        elif stat.S_ISLNK(mode):
+            os.symlink(os.readlink(src), dst)
+            os.lchown(dst, uid, gid)
+            return 0
+
+        elif stat.S_ISFIFO(mode):
+            os.mkfifo(dst, 0600)
+
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            os.mknod(dst, stat.S_IFMT(mode) | 0600, st.st_rdev)
+
+        else:
+            # sockets can't be restored
+            return 0
+
+    # chown before chmod, because chown clears setuid/setgid bits
+    os.lchown(dst, uid, gid)
+    os.chmod(dst, stat.S_IMODE(mode))
+    os.utime(dst, (st.st_atime, st.st_mtime))
+
+    return copied
+
+def _apply(src, dst, path, uidmap, gidmap, move, links):
+    path = path.lstrip('/')
+    path_src = join(src, path)
+    path_dst = join(dst, path)
+
+    try:
+        _makedirs(dirname(path_dst))
+        return _install(path_src, path_dst, uidmap, gidmap, move, links)
+
+    except EnvironmentError, e:
+        # like tar, warn about paths that disappeared and keep going
+        if e.errno == errno.ENOENT and not lexists(path_src):
+            print >> sys.stderr, "warning: overlay path '%s' doesn't exist" % path_src
+            return 0
+
+        raise Error("can't apply overlay path '%s': %s" % (path_src, e))
+
+def apply_overlay(src, dst, paths, uidmap={}, gidmap={}, move=False,
+                  threads=THREADS):
+    """Copy paths (absolute paths in the overlay) from src to dst.
+
+    Files keep their mode and mtime. Their owner and group are translated
+    with uidmap and gidmap (old id -> new id) as they are written, so
+    they don't need to be fixed up later. Missing parent directories are
+    created. Paths that are hard links of each other stay linked.
+
+    If move=True, files are renamed into place instead (leaving
+    directories in src behind) and only copied if src and dst are on
+    different filesystems.
+
+    Paths are split into batches that are applied by a pool of threads.
+    Returns the number of bytes copied."""
+
+    paths = list(paths)
+    batches = [ paths[i:i + BATCH] for i in xrange(0, len(paths), BATCH) ]
+
+    links = _Links()
+
+    if threads < 2 or len(batches) < 2:
+        return sum([ _apply(src, dst, path, uidmap, gidmap, move, links)
+                     for path in paths ])
+
+    todo = Queue.Queue()
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            batch = todo.get()
+            if batch is None:
+                return
+
+            try:
+                done.put((sum([ _apply(src, dst, path, uidmap, gidmap, move, links)
+                                for path in batch ]), None))
+            except:
+                done.put((None, sys.exc_info()))
+
+    workers = [ threading.Thread(target=worker)
+                for i in range(min(threads, len(batches))) ]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    for batch in batches:
+        todo.put(batch)
+
+    copied = 0
+    try:
+        for batch in batches:
+            size, exc_info = _get(done)
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+            copied += size
+
+    finally:
+        try:
+            while True:
+                todo.get_nowait()
+        except Queue.Empty:
+            pass
+
+        for thread in workers:
+            todo.put(None)
+
+        for thread in workers:
+            thread.join()
+
+    return copied
@@ -8,27 +8,190 @@
 # published by the Free Software Foundation; either version 3 of
 # the License, or (at your option) any later version.
 #
-import glob
+import os
+import re
 from os.path import *
 
-class PathMap(dict):
-    @staticmethod
-    def _expand(path):
-        def needsglob(path):
-            for c in ('*?[]'):
-                if c in path:
-                    return True
-            return False
-
-        path = abspath(path)
-        if needsglob(path):
-            return glob.glob(path)
+def _needsglob(path):
+    for c in ('*?[]'):
+        if c in path:
+            return True
+    return False
+
+def _translate(pat):
+    """translate a glob path component to a regexp (like fnmatch, but
+    wildcards don't match a leading dot, like glob)"""
+    i, n = 0, len(pat)
+    res = ''
+    while i < n:
+        c = pat[i]
+        i += 1
+        if c == '*':
+            res += '[^/]*'
+        elif c == '?':
+            res += '[^/]'
+        elif c == '[':
+            j = i
+            if j < n and pat[j] == '!':
+                j += 1
+            if j < n and pat[j] == ']':
+                j += 1
+            while j < n and pat[j] != ']':
+                j += 1
+            if j >= n:
+                res += '\\['
+            else:
+                stuff = pat[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res += '[%s]' % stuff
         else:
-            return [ path ]
+            res += re.escape(c)
+
+    if not pat.startswith('.'):
+        res = '(?!\\.)' + res
+
+    return res
+
+class _Glob:
+    """A glob override matched lazily against path components.
+
+    '**' matches zero or more directories. Like glob, wildcards don't match
+    names that start with a dot."""
+
+    def __init__(self, pattern, comps, sign, order):
+        self.pattern = pattern
+        self.comps = comps
+        self.sign = sign
+        self.order = order
+
+        regex = ''
+        for comp in comps:
+            if comp == '**':
+                regex += '(?:(?!\\.)[^/]+/)*'
+            elif _needsglob(comp):
+                regex += _translate(comp) + '/'
+            else:
+                regex += re.escape(comp) + '/'
+
+        self._regex = re.compile(regex + '$')
+        self.length = None if '**' in comps else len(comps)
+
+    def match(self, comps, i, j):
+        """does the glob match comps[i:j] exactly?"""
+        return self._regex.match('/'.join(comps[i:j]) + '/') is not None
+
+    def deepest(self, comps, i):
+        """return depth of the deepest j that matches comps[i:j] or None"""
+        if self.length is not None:
+            j = i + self.length
+            if j <= len(comps) and self.match(comps, i, j):
+                return j
+
+            return None
+
+        for j in xrange(len(comps), i - 1, -1):
+            if self.match(comps, i, j):
+                return j
+
+        return None
+
+    def expand(self, base):
+        """yield existing paths under base that match"""
+        def expand(base, comps):
+            if not comps:
+                yield base
+                return
+
+            comp = comps[0]
+            if comp == '**':
+                for path in expand(base, comps[1:]):
+                    yield path
+
+            elif not _needsglob(comp):
+                path = join(base, comp)
+                if lexists(path):
+                    for path in expand(path, comps[1:]):
+                        yield path
+                return
+
+            try:
+                names = os.listdir(base)
+            except OSError:
+                return
+
+            regex = re.compile(_translate(comp) + '$')
+            for name in names:
+                path = join(base, name)
+                if comp == '**':
+                    if not name.startswith('.') and isdir(path) and not islink(path):
+                        for path in expand(path, comps):
+                            yield path
+
+                elif regex.match(name):
+                    for path in expand(path, comps[1:]):
+                        yield path
+
+        return expand(base, self.comps)
+
+class _Excluded:
+    """Names of excluded entries in a directory, including glob matches"""
+
+    def __init__(self, pathmap, dir, node, globs):
+        self.pathmap = pathmap
+        self.comps = dir[1:].split('/') if dir != '/' else []
+        self.node = node
+        self.globs = globs
+
+    def __contains__(self, name):
+        comps = self.comps + [ name ]
+        depth = len(comps)
+
+        best = None
+        child = self.node[1].get(name) if self.node else None
+        if child and child[0] is not None:
+            best = (child[2], child[0])
+
+        for i, globs in self.globs:
+            for glob in globs:
+                if (best is None or glob.order > best[0]) and \
+                   glob.deepest(comps, i) == depth:
+                    best = (glob.order, glob.sign)
+
+        return best is not None and best[1] is False
+
+class PathMap(dict):
+    """Map of include (True) and exclude (False) paths.
+
+    A path is in the map if its nearest overridden ancestor (or itself) is
+    an include. Overrides of the same path: the last one wins.
+
+    Literal overrides are compiled into a trie of path components so a
+    lookup is a single descent. Glob overrides (e.g., -/home/*/.cache or
+    -/srv/**/node_modules) are attached to the trie node of their literal
+    prefix and matched lazily, so they match paths that didn't exist when
+    the map was created. The dict only holds literal overrides.
+
+    Don't modify a PathMap after it is created.
+    """
 
     def __init__(self, paths):
         self.default = True
-        for path in paths:
+        self.globs = []
+
+        # node := [ sign or None, { name: node }, order, [ glob, ... ] ]
+        self._trie = [ None, {}, None, [] ]
+
+        def get_node(comps):
+            node = self._trie
+            for name in comps:
+                node = node[1].setdefault(name, [ None, {}, None, [] ])
+            return node
+
+        for order, path in enumerate(paths):
             if path[0] == '-':
                 path = path[1:]
                 sign = False
@@ -36,21 +199,121 @@ class PathMap(dict):
                 self.default = False
                 sign = True
 
-            for expanded in self._expand(path):
-                self[expanded] = sign
+            path = abspath(path)
+            comps = [ comp for comp in path.split('/') if comp ]
+
+            if _needsglob(path):
+                for i, comp in enumerate(comps):
+                    if comp == '**' or _needsglob(comp):
+                        break
+
+                glob = _Glob(path, comps[i:], sign, order)
+                get_node(comps[:i])[3].append(glob)
+                self.globs.append(glob)
+                continue
+
+            self[path] = sign
+
+            node = get_node(comps)
+            node[0] = sign
+            node[2] = order
 
     def includes(self):
-        return [ path for path in self if self[path] ]
+        """literal includes and paths that currently match include globs,
+        except those shadowed by a later exclude glob (e.g., /var/www -/var/*)"""
+        includes = [ path for path in self if self[path] ]
+        for glob in self.globs:
+            if not glob.sign:
+                continue
+
+            base = '/' + '/'.join(glob.pattern[1:].split('/')[:-len(glob.comps)])
+            includes += [ path for path in glob.expand(base)
+                          if path not in includes ]
+
+        return [ path for path in includes if path in self ]
     includes = property(includes)
 
     def excludes(self):
-        return [ path for path in self if not self[path] ]
+        """literal excludes and exclude glob patterns"""
+        return [ path for path in self if not self[path] ] + \
+               [ glob.pattern for glob in self.globs if not glob.sign ]
     excludes = property(excludes)
 
-    def __contains__(self, path):
-        while path not in ('', '/'):
+    def _contains(self, path):
+        # dirname('//') == '//'
+        while path not in ('', '/', '//'):
             if dict.__contains__(self, path):
                 return self[path]
             path = dirname(path)
 
         return self.default
+
+    @staticmethod
+    def _is_normalized(path):
+        return path[:1] == '/' and path[-1:] != '/' and '//' not in path
+
+    def __contains__(self, path):
+        # globs only match normalized paths
+        if not self._is_normalized(path):
+            return self._contains(path)
+
+        comps = path[1:].split('/')
+
+        best = None
+        globs = []
+
+        node = self._trie
+        for i, name in enumerate(comps):
+            if node[3]:
+                globs.append((i, node[3]))
+
+            node = node[1].get(name)
+            if node is None:
+                break
+
+            if node[0] is not None:
+                best = (i + 1, node[2], node[0])
+        else:
+            if node[3]:
+                globs.append((len(comps), node[3]))
+
+        for i, patterns in globs:
+            for glob in patterns:
+                depth = glob.deepest(comps, i)
+                if depth and (best is None or (depth, glob.order) > best[:2]):
+                    best = (depth, glob.order, glob.sign)
+
+        if best is None:
+            return self.default
+
+        return best[2]
+
+    def excluded_names(self, dir):
+        """Return names of the excluded entries directly under dir, so a walk
+        can skip excluded subtrees without testing every entry's path"""
+        if not self._is_normalized(dir) and dir != '/':
+            return frozenset(basename(path) for path in self
+                             if not self[path] and dirname(path) == dir)
+
+        globs = []
+        node = self._trie
+        if dir != '/':
+            for i, name in enumerate(dir[1:].split('/')):
+                if node[3]:
+                    globs.append((i, node[3]))
+
+                node = node[1].get(name)
+                if node is None:
+                    break
+
+        if node and node[3]:
+            globs.append((len(dir[1:].split('/')) if dir != '/' else 0, node[3]))
+
+        if not globs:
+            if not node:
+                return frozenset()
+
+            return frozenset(name for name, child in node[1].items()
+                             if child[0] is False)
+
+        return _Excluded(self, dir, node, globs)
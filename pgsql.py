@@ -15,6 +15,7 @@ from os.path import *
 import re
 import commands
 import shutil
+from subprocess import Popen, PIPE
 
 from executil import system, getoutput, getoutput_popen
 
@@ -23,6 +24,10 @@ from dblimits import DBLimits
 FNAME_GLOBALS = ".globals.sql"
 FNAME_MANIFEST = "manifest.txt"
 
+# pg_dump tar, compressed instead of extracted
+FNAME_DUMP = "dump.tar.gz"
+COMPRESSLEVEL = 1
+
 class Error(Exception):
     pass
 
@@ -38,7 +43,23 @@ def list_databases():
         name = m.group(1)
         yield name
 
-def dumpdb(outdir, name, tlimits=[]):
+def _dump_compressed(command, path):
+    fh = file(path, "w")
+    try:
+        dump = Popen(command, shell=True, stdout=PIPE, stderr=PIPE, close_fds=True)
+
+        # --rsyncable keeps Duplicity's deltas of the dump small
+        compressor = Popen(["gzip", "--rsyncable", "-%d" % COMPRESSLEVEL],
+                           stdin=dump.stdout, stdout=fh, stderr=PIPE, close_fds=True)
+        dump.stdout.close()
+
+        error = dump.stderr.read() + compressor.stderr.read()
+        if dump.wait() != 0 or compressor.wait() != 0:
+            raise Error("%s failed: %s" % (command, error.strip()))
+    finally:
+        fh.close()
+
+def dumpdb(outdir, name, tlimits=[], compress=False):
     path = join(outdir, name)
     if isdir(path):
         shutil.rmtree(path)
@@ -53,13 +74,22 @@ def dumpdb(outdir, name, tlimits=[]):
             pg_dump += " --exclude-table=" + table
     pg_dump += " " + name
 
+    if compress:
+        _dump_compressed(su(pg_dump), join(path, FNAME_DUMP))
+        return
+
     manifest = getoutput(su(pg_dump) + " | tar xvC %s" % path)
     file(join(path, FNAME_MANIFEST), "w").write(manifest + "\n")
 
 def restoredb(dbdump, dbname, tlimits=[]):
-    manifest = file(join(dbdump, FNAME_MANIFEST)).read().splitlines()
-    # remove any malformed entries
-    manifest = [i for i in manifest if not i.endswith('Permission denied')]
+    if exists(join(dbdump, FNAME_DUMP)):
+        command = "zcat " + FNAME_DUMP
+    else:
+        manifest = file(join(dbdump, FNAME_MANIFEST)).read().splitlines()
+        # remove any malformed entries
+        manifest = [i for i in manifest if not i.endswith('Permission denied')]
+        command = "tar c %s 2>/dev/null" % " ".join(manifest)
+
     try:
         getoutput(su("dropdb " + dbname))
     except:
@@ -69,7 +99,6 @@ def restoredb(dbdump, dbname, tlimits=[]):
     os.chdir(dbdump)
 
     try:
-        command = "tar c %s 2>/dev/null" % " ".join(manifest)
         command += " | pg_restore --create --dbname=postgres --format=tar"
         for (table, sign) in tlimits:
             if sign:
@@ -80,17 +109,46 @@ def restoredb(dbdump, dbname, tlimits=[]):
     finally:
         os.chdir(orig_cwd)
 
-def pgsql2fs(outdir, limits=[], callback=None):
+def pgsql2fs(outdir, limits=[], callback=None, checkpoints=None, compress=False):
+    """If checkpoints (a set-like object with an add() method) is passed,
+    databases in it that are in outdir are skipped and dumped databases
+    are added to it. If a database fails to dump, only its partial dump is
+    removed and we go on with the others, then raise an Error.
+
+    The globals are written last, so outdir is only complete (and
+    restorable) if every database was dumped.
+
+    If compress is True, each database's dump is compressed as it's
+    produced instead of extracted"""
     limits = DBLimits(limits)
 
+    failed = []
+
     for dbname in list_databases():
         if dbname not in limits or dbname == 'postgres' or re.match(r'template\d', dbname):
             continue
 
+        if checkpoints is not None and dbname in checkpoints and \
+           isdir(join(outdir, dbname)):
+            continue
+
         if callback:
             callback(dbname)
 
-        dumpdb(outdir, dbname, limits[dbname])
+        try:
+            dumpdb(outdir, dbname, limits[dbname], compress)
+        except Exception, e:
+            if isdir(join(outdir, dbname)):
+                shutil.rmtree(join(outdir, dbname))
+
+            failed.append("%s (%s)" % (dbname, str(e).strip()))
+            continue
+
+        if checkpoints is not None:
+            checkpoints.add(dbname)
+
+    if failed:
+        raise Error("can't dump " + ", ".join(failed))
 
     globals = getoutput(su("pg_dumpall --globals"))
     file(join(outdir, FNAME_GLOBALS), "w").write(globals)
@@ -101,6 +159,10 @@ def fs2pgsql(outdir, limits=[], callback=None):
         if (database, table) not in limits:
             raise Error("can't exclude %s/%s: table excludes not supported for postgres" % (database, table))
 
+    # a database failed to dump, so the others may be missing roles
+    if not exists(join(outdir, FNAME_GLOBALS)):
+        raise Error("incomplete dump (no globals): " + outdir)
+
     # load globals first, suppress noise (e.g., "ERROR: role "postgres" already exists)
     globals = file(join(outdir, FNAME_GLOBALS)).read()
     getoutput_popen(su("psql -q -o /dev/null"), globals)
@@ -125,17 +187,34 @@ def cb_print(fh=None):
 
     return func
 
-def backup(outdir, limits=[], callback=None):
+def backup(outdir, limits=[], callback=None, checkpoints=None, compress=False):
+    """If checkpoints is passed, databases a previous (aborted) backup
+    finished dumping to outdir are kept and skipped. See pgsql2fs()
+
+    Without checkpoints, outdir is removed if we fail. With checkpoints,
+    only the databases we failed to dump are removed, so the caller can
+    resume. outdir is only complete (and restorable) if we succeed: the
+    globals are missing otherwise."""
+
     if isdir(outdir):
-        shutil.rmtree(outdir)
+        if checkpoints is None:
+            shutil.rmtree(outdir)
+        else:
+            # discard anything a previous backup didn't finish
+            for fname in os.listdir(outdir):
+                fpath = join(outdir, fname)
+                if not isdir(fpath):
+                    os.remove(fpath)
+                elif fname not in checkpoints:
+                    shutil.rmtree(fpath)
 
     if not exists(outdir):
         os.makedirs(outdir)
 
     try:
-        pgsql2fs(outdir, limits, callback)
+        pgsql2fs(outdir, limits, callback, checkpoints, compress)
     except Exception, e:
-        if isdir(outdir):
+        if isdir(outdir) and checkpoints is None:
             shutil.rmtree(outdir)
         raise Error("pgsql backup failed: " + str(e))
 
@@ -65,8 +65,8 @@ Run "tklbam-init --help" for further details.
     CUSTOM_PROFILE = "custom"
 
     class Paths(_Paths):
-        files = ['restore.log', 'backup.log', 'backup.pid',
-                 'backup-resume', 'sub_apikey', 'secret', 'key', 'credentials', 'hbr',
+        files = ['restore.log', 'backup.log', 'restore.json', 'backup.json', 'backup.pid',
+                 'backup-resume', 'readdir-cache', 'change-tracker', 'digest-cache', 'sub_apikey', 'secret', 'key', 'credentials', 'hbr',
                  'profile', 'profile/stamp', 'profile/profile_id']
 
     def __init__(self, path=None):
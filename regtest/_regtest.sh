@@ -44,12 +44,13 @@ done
 rm -rf ./testdir && tar xf $REF/testdir.tar
 
 # test index creation
-cmd dirindex --create index testdir
-cp ./index ./index.orig
+cmd dirindex --create index.bin testdir
+cp ./index.bin ./index.orig
+cmd dirindex --export index.bin > index
 testresult ./index "dirindex creation"
 
 # test index creation with limitation
-cmd dirindex --create index -- ./testdir/ -testdir/subdir/ testdir/subdir/subsubdir
+cmd dirindex --create --text index -- ./testdir/ -testdir/subdir/ testdir/subdir/subsubdir
 testresult ./index "dirindex creation with limitation"
 
 # test dirindex comparison
@@ -125,7 +126,7 @@ cmd delete -v ./delta.orig > delete
 testresult ./delete "delete repeated - nothing to do"
 
 rm -rf testdir
-rm -f index index.orig delta delta.orig fixstat delete
+rm -f index index.bin index.orig delta delta.orig fixstat delete
 
 cmd merge-userdb $REF/old-passwd $REF/old-group $REF/new-passwd $REF/new-group merged-passwd merged-group > merge-maps
 
@@ -156,3 +157,265 @@ testresult-exact fs2mysql-output "fs2mysql verbose output"
 testresult-exact sql "fs2mysql tofile=sql"
 
 rm -rf myfs myfs.tar myfs-md5 fs2mysql-output sql
+
+# test glob overrides that shadow literal includes
+rm -rf ./testdir && tar xf $REF/testdir.tar
+
+cmd dirindex --create --text index -- testdir/subdir '-testdir/*'
+testresult ./index "dirindex creation with include shadowed by exclude glob"
+
+cmd dirindex --create --text index -- '-testdir/*' testdir/subdir
+testresult ./index "dirindex creation with exclude glob overridden by include"
+
+cmd dirindex --create --text index -- testdir/subdir/subsubdir '-testdir/*'
+testresult ./index "dirindex creation with include under exclude glob"
+
+rm -rf testdir
+rm -f index
+
+# test dirindex comparison with a change journal. We write the journal
+# ourselves, like a change tracker watching testdir would
+rm -rf ./testdir && tar xf $REF/testdir.tar
+mkdir tracker
+cmd dirindex --create tracker/dirindex testdir
+cp tracker/dirindex index.orig
+
+echo "# tklbam-change-journal 2 regtest $$" > tracker/journal
+echo "# testdir" >> tracker/journal
+echo "regtest $(stat -c %s tracker/journal)" > tracker/state
+
+journal() {
+    op=$1
+    shift
+    for path; do
+        echo "$op $(/bin/pwd)/$path"
+    done >> tracker/journal
+}
+
+cd ./testdir/
+    mv {file,file-renamed}
+    ln -sf file-renamed link
+    mv emptydir emptydir-renamed
+    echo changed >> subdir/file2
+    chgrp 666 subdir/file2
+    echo foo > subdir/subsubdir/file4
+    chown 666 subdir/subsubdir/file4
+    rm subdir/subsubdir/file3
+    mkdir new
+    touch new/empty
+
+    chown 666 chown
+    chgrp 666 chgrp
+    chmod 000 chmod
+
+    chown 666:666 subdir
+
+    chmod 750 subdir/subsubdir
+cd ../
+
+journal w testdir/file testdir/file-renamed testdir/link \
+          testdir/emptydir testdir/emptydir-renamed \
+          testdir/subdir/subsubdir/file4 testdir/subdir/subsubdir/file3 \
+          testdir/new testdir/new/empty
+journal s testdir/subdir/file2 testdir/subdir/subsubdir/file4 \
+          testdir/chown testdir/chgrp testdir/chmod \
+          testdir/subdir testdir/subdir/subsubdir
+
+cmd dirindex --tracker=tracker ./index.orig testdir > delta
+testresult ./delta "dirindex comparison with change journal"
+
+echo '!overflow' >> tracker/journal
+cmd dirindex --tracker=tracker ./index.orig testdir > delta 2>&1
+testresult ./delta "dirindex comparison with unusable change journal"
+
+rm -rf testdir tracker
+rm -f index.orig delta
+
+# test applying an overlay with hard links
+mkdir -p overlay/d overlay/e
+echo data > overlay/d/a
+ln overlay/d/a overlay/d/b
+ln overlay/d/a overlay/e/c
+echo other > overlay/d/x
+chown 666:666 overlay/d/a overlay/d/x
+(cd overlay; find . ! -type d | sed 's|^\.||' | sort) > olist
+
+cmd apply-overlay -u 666,111 -g 666,222 overlay dest olist
+(cd dest; find . ! -type d -printf '%n %U:%G %p\n'; find . -samefile d/a) | sort > overlay-links
+testresult-exact ./overlay-links "apply-overlay with hard links"
+
+rm -rf overlay dest olist
+
+# enough paths for several batches, so they're applied in parallel
+mkdir -p overlay/d overlay/e
+for i in $(seq 100); do
+    echo $i > overlay/d/$i
+    ln overlay/d/$i overlay/e/$i
+done
+(cd overlay; find . ! -type d | sed 's|^\.||' | sort) > olist
+
+cmd apply-overlay overlay dest olist
+(cd dest; find . ! -type d -printf '%n\n' | sort | uniq -c; find . -samefile d/50) | sort > overlay-links
+testresult-exact ./overlay-links "apply-overlay with hard links in parallel"
+
+rm -rf overlay dest olist overlay-links
+
+# test fixstat creating nested directories in parallel batches
+for i in $(seq 20); do
+    printf "s\t%s\t666\t666\t040750\n" $(/bin/pwd)/tree/$i
+    for j in $(seq 30); do
+        printf "s\t%s\t0\t0\t040700\n" $(/bin/pwd)/tree/$i/$j
+    done
+done | sort > delta
+
+cmd fixstat -t 8 ./delta > /dev/null
+(cd tree; find . -mindepth 1 -printf '%m %U:%G %d\n') | sort | uniq -c > tree-stat
+testresult-exact ./tree-stat "fixstat of nested directories in parallel"
+
+rm -rf tree delta tree-stat
+
+# test that saved indexes compare the same as a walk with subsecond mtimes
+mkdir mtimes
+for i in 1 2 3; do
+    echo $i > mtimes/$i
+    touch -d "2020-01-01 00:00:0$i.5" mtimes/$i
+done
+
+cmd dirindex --create mtimes.bin mtimes
+cmd dirindex --create --text mtimes.txt mtimes
+(cmd dirindex ./mtimes.bin mtimes; cmd dirindex ./mtimes.txt mtimes) > delta
+testresult-exact ./delta "dirindex comparison with subsecond mtimes"
+
+rm -rf mtimes mtimes.bin mtimes.txt delta
+
+# test that touched files with the content they had in the index are
+# stat-only changes once the digest cache has learned them
+mkdir digests
+echo same > digests/touched
+echo old > digests/edited
+touch -d "2020-01-01 00:00:00" digests/touched digests/edited
+
+cmd dirindex --create digests.index digests
+cmd dirindex --digest-cache=digest-cache digests.index digests > /dev/null
+
+touch digests/touched
+echo new > digests/edited
+
+cmd dirindex --digest-cache=digest-cache digests.index digests > delta
+testresult ./delta "dirindex comparison with content digests"
+
+rm -rf digests digests.index digest-cache delta
+
+# test that a malformed change journal entry (e.g., a truncated line)
+# falls back to walking the filesystem
+rm -rf ./testdir && tar xf $REF/testdir.tar
+mkdir tracker
+cmd dirindex --create tracker/dirindex testdir
+cp tracker/dirindex index.orig
+
+echo "# tklbam-change-journal 2 regtest $$" > tracker/journal
+echo "# testdir" >> tracker/journal
+echo "regtest $(stat -c %s tracker/journal)" > tracker/state
+
+echo new > testdir/new
+echo "w" >> tracker/journal
+
+cmd dirindex --tracker=tracker ./index.orig testdir > delta 2>&1
+testresult ./delta "dirindex comparison with malformed change journal"
+
+rm -rf testdir tracker
+rm -f index.orig delta
+
+# test that a resumed PgSQL dump only redoes the databases that failed,
+# with fake PostgreSQL commands
+mkdir fakebin
+cat > fakebin/su <<'EOS'
+#!/bin/sh
+exec sh -c "$3"
+EOS
+cat > fakebin/psql <<'EOS'
+#!/bin/sh
+for db in db1 db2 db3; do
+    echo " $db | postgres | UTF8"
+done
+EOS
+cat > fakebin/pg_dump <<'EOS'
+#!/bin/sh
+for db; do :; done
+echo "pg_dump $db" >> pgsql-log
+if [ "$db" = "$PGSQL_FAIL" ]; then
+    echo "pg_dump: can't dump $db" >&2
+    exit 1
+fi
+mkdir -p fakedump/$db && echo $db > fakedump/$db/toc.dat
+tar cf - -C fakedump/$db toc.dat
+EOS
+cat > fakebin/pg_dumpall <<'EOS'
+#!/bin/sh
+echo "-- globals"
+EOS
+chmod +x fakebin/*
+
+pgsql_state() {
+    echo "# $1"
+    (cd pgfs; find . -mindepth 1 | sort)
+    sort checkpoints
+    cat pgsql-log
+    rm -f pgsql-log
+}
+
+PATH=$(/bin/pwd)/fakebin:$PATH PGSQL_FAIL=db2 cmd pgsql2fs --checkpoints=checkpoints pgfs 2>> pgsql-log
+pgsql_state "db2 fails" > pgsql-resume
+PATH=$(/bin/pwd)/fakebin:$PATH cmd pgsql2fs --checkpoints=checkpoints pgfs 2>> pgsql-log
+pgsql_state "resumed" >> pgsql-resume
+testresult-exact ./pgsql-resume "pgsql2fs resumed after a failed database"
+
+rm -rf fakebin fakedump pgfs checkpoints pgsql-resume
+
+# test how parallel mysqldump sessions split the tables between them,
+# with fake MySQL commands
+mkdir fakebin
+printf 'db1\tt1\tBASE TABLE\t300\ndb1\tt2\tBASE TABLE\t100\ndb1\tv1\tVIEW\t0\ndb2\tt3\tBASE TABLE\t200\ndb2\tt4\tBASE TABLE\t50\n' > mysql-tables
+cat > fakebin/mysql <<'EOS'
+#!/bin/sh
+while read sql; do
+    case "$sql" in
+        *processlist*) echo 0 ;;
+        "SHOW DATABASES;") printf 'information_schema\ndb1\ndb2\n' ;;
+        *information_schema.tables*) cat mysql-tables ;;
+        "SELECT '-- tklbam --';") echo "-- tklbam --" ;;
+    esac
+done
+EOS
+cat > fakebin/mysqldump <<'EOS'
+#!/bin/sh
+nodata=; databases=; ignore=
+for arg; do
+    case "$arg" in
+        --no-data) nodata=" --no-data" ;;
+        --ignore-table=*) ignore="$ignore ${arg#--ignore-table=}" ;;
+        --*) ;;
+        *) databases="$databases $arg" ;;
+    esac
+done
+echo "mysqldump$nodata$databases, ignore:$(for t in $ignore; do echo $t; done | sort | tr '\n' ' ')" >> mysql-log
+# like mysqldump --compact, starts with a blank line
+for db in $databases; do
+    echo
+    echo "CREATE DATABASE \`$db\`;"
+    echo "USE \`$db\`;"
+    while IFS="$(printf '\t')" read tdb table type size; do
+        [ "$tdb" = "$db" ] && [ "$type" != "VIEW" ] || continue
+        case " $ignore " in *" $db.$table "*) continue ;; esac
+        echo "CREATE TABLE \`$table\` (\`id\` int);"
+        [ -n "$nodata" ] || echo "INSERT INTO \`$table\` VALUES ($size);"
+    done < mysql-tables
+done
+EOS
+chmod +x fakebin/*
+
+PATH=$(/bin/pwd)/fakebin:$PATH cmd mysql2fs --parallel=2 myfs -- -db2/t4 > /dev/null
+(cat mysql-log; cd myfs; find . -name rows | sort | xargs grep -H .) > mysql-parallel
+testresult-exact ./mysql-parallel "mysql2fs with parallel sessions"
+
+rm -rf fakebin myfs mysql-tables mysql-log mysql-parallel
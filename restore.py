@@ -12,15 +12,18 @@ import sys
 
 import os
 from os.path import *
+from itertools import chain
 
 import userdb
 import pkgman
 
-from changes import Changes
+from changes import ChangesFile, Executor
 from pathmap import PathMap
 from rollback import Rollback
 
-from utils import AttrDict, fmt_title, apply_overlay
+from utils import AttrDict, fmt_title
+from overlay import apply_overlay
+from metrics import metrics
 
 import backup
 import conf
@@ -29,7 +32,6 @@ import pgsql
 
 import simplejson
 
-from temp import TempFile
 
 class Error(Exception):
     pass
@@ -44,7 +46,10 @@ class Restore:
 
     PACKAGES_BLACKLIST = ['linux-*', 'vmware-tools*']
 
-    def __init__(self, backup_extract_path, limits=[], rollback=True, simulate=False):
+    def __init__(self, backup_extract_path, limits=[], rollback=True, simulate=False,
+                 move_overlay=False):
+        """If move_overlay=True the backup extract is disposable, so files
+        are moved from it into place instead of copied"""
         self.extras = backup.ExtrasPaths(backup_extract_path)
         if not isdir(self.extras.path):
             raise self.Error("illegal backup_extract_path: can't find '%s'" % self.extras.path)
@@ -59,7 +64,9 @@ class Restore:
         self.rollback = Rollback.create() if rollback else None
         self.limits = conf.Limits(limits)
         self.backup_extract_path = backup_extract_path
+        self.move_overlay = move_overlay
 
+    @metrics.timed('database')
     def database(self):
         if not exists(self.extras.myfs) and not exists(self.extras.pgfs):
             return
@@ -92,6 +99,7 @@ class Restore:
             except pgsql.Error, e:
                 print "SKIPPING PGSQL DATABASE RESTORE: " + str(e)
 
+    @metrics.timed('packages')
     def packages(self):
         newpkgs_file = self.extras.newpkgs
         if not exists(newpkgs_file):
@@ -166,15 +174,7 @@ class Restore:
                  for fpath in file(fsdelta_olist_path).read().splitlines() 
                  if fpath in pathmap ] 
 
-    @staticmethod
-    def _apply_overlay(src, dst, olist):
-        tmp = TempFile("fsdelta-olist-")
-        for fpath in olist:
-            print >> tmp, fpath.lstrip('/')
-        tmp.close()
-
-        apply_overlay(src, dst, tmp.path)
-
+    @metrics.timed('files')
     def files(self):
         extras = self.extras
         if not exists(extras.fsdelta):
@@ -199,7 +199,7 @@ class Restore:
 
             print
 
-        changes = Changes.fromfile(extras.fsdelta, limits)
+        changes = ChangesFile(extras.fsdelta, limits)
         deleted = list(changes.deleted())
 
         if rollback:
@@ -211,30 +211,49 @@ class Restore:
             for fpath in fsdelta_olist:
                 print "  " + fpath
 
+            # the overlay is written with remapped owners, so it doesn't
+            # need statfixes
             if not simulate:
-                self._apply_overlay(overlay, '/', fsdelta_olist)
+                with metrics.phase('overlay'):
+                    size = apply_overlay(overlay, '/', fsdelta_olist, uidmap, gidmap,
+                                         move=self.move_overlay)
+
+                metrics.count('files_restored', len(fsdelta_olist))
+                metrics.count('bytes_restored', size)
 
             print
 
-        statfixes = list(changes.statfixes(uidmap, gidmap))
+        olist = set(fsdelta_olist)
+        statfix_changes = ( change for change in changes
+                            if change.path not in olist )
 
-        if statfixes or deleted:
-            print "POST-OVERLAY FIXES:\n"
+        # fixes run in parallel, so we only list them when simulating and
+        # otherwise report errors and a summary
+        executor = Executor(simulate=simulate)
+        fixes = executor.statfixes(statfix_changes, uidmap, gidmap)
 
-        for action in statfixes:
-            print "  " + str(action)
-            if not simulate:
-                action()
+        # rollback moves deleted to 'originals'
+        if simulate or not rollback:
+            fixes = chain(fixes, executor.run(deleted))
 
-        for action in deleted:
-            print "  " + str(action)
+        with metrics.phase('statfixes'):
+            header = False
+            for action, error in fixes:
+                if not header:
+                    print "POST-OVERLAY FIXES:\n"
+                    header = True
 
-            # rollback moves deleted to 'originals'
-            if not simulate and not rollback:
-                action()
+                if error:
+                    print "  error: " + (("%s: %s" % (action, error)) if action else str(error))
+                elif simulate:
+                    print "  " + str(action)
 
-        if statfixes or deleted:
-            print
+            if header:
+                if not simulate:
+                    print "  " + str(executor)
+                print
+
+        metrics.count('statfixes', executor.actions)
 
         def w(path, s):
             file(path, "w").write(str(s))
@@ -242,3 +261,8 @@ class Restore:
         if not simulate:
             w("/etc/passwd", passwd)
             w("/etc/group", group)
+
+        # like a failed fix used to, stop the restore, but only after we
+        # tried all of them
+        if executor.errors:
+            raise self.Error("%d post-overlay fixes failed" % executor.errors)
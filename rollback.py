@@ -21,7 +21,7 @@ from paths import Paths as _Paths
 import mysql
 import pgsql
 
-from changes import Changes
+from changes import ChangesFile
 from dirindex import DirIndex
 from pkgman import Packages
 
@@ -87,8 +87,8 @@ class Rollback:
         if not exists(self.paths.fsdelta):
             return
 
-        changes = Changes.fromfile(self.paths.fsdelta)
-        dirindex = DirIndex(self.paths.dirindex)
+        changes = ChangesFile(self.paths.fsdelta)
+        dirindex = DirIndex.load(self.paths.dirindex)
 
         exceptions = 0
         for change in changes:
@@ -11,7 +11,6 @@
 import os
 from os.path import *
 
-import executil
 import shutil
 import stat
 import datetime
@@ -65,13 +64,13 @@ def move(src, dst):
         shutil.move(src, dst)
         os.lchown(dst, st.st_uid, st.st_gid)
 
-def apply_overlay(src, dst, olist_path):
-    orig_cwd = os.getcwd()
-    os.chdir(src)
-    executil.getoutput("tar --create --files-from=%s | tar --extract --directory %s" %
-                       (olist_path, executil.mkarg(dst)))
-
-    os.chdir(orig_cwd)
+def fmt_size(size):
+    if size > 1024 * 1024 * 1024:
+        return "%.2f GB" % (float(size) / (1024 * 1024 * 1024))
+    elif size > 1024 * 1024:
+        return "%.2f MB" % (float(size) / (1024 * 1024))
+    else:
+        return "%.2f KB" % (float(size) / 1024)
 
 def fmt_title(title, c='='):
     return title + "\n" + c * len(title) + "\n"